@@ -0,0 +1,110 @@
+# Batch artifacts: the (query, rows) batches of a converted source (see cypher_generator.convert_graph_to_batches),
+# saved in a compressed file that can be uploaded again without reading and converting the FHIR files, e.g. on
+# another machine (python main.py --replay FOLDER).
+#
+# Formats, chosen by the file extension:
+#   .jsonl.gz    gzip compressed JSON lines, one {"query": ..., "rows": [...]} per line.
+#   .msgpack.gz  gzip compressed stream of msgpack maps. Smaller and faster, needs the msgpack package.
+# The first record of a file is a header {"labels": [...]} with the node labels of the batches, so the schema can be
+# created before the upload. Date and DateTime values (--property-types temporal) are saved as {"$date": ...} and
+# {"$datetime": ...} maps (see property_serializer.encode_temporal).
+import gzip
+import json
+import os
+
+import property_serializer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSONL = "jsonl"
+MSGPACK = "msgpack"
+FORMATS = (JSONL, MSGPACK)
+EXTENSIONS = {JSONL: ".jsonl.gz", MSGPACK: ".msgpack.gz"}
+
+
+def get_artifact_format(file_path):
+    for artifact_format, extension in EXTENSIONS.items():
+        if file_path.endswith(extension):
+            return artifact_format
+    raise ValueError(f"Unknown batch artifact format: {file_path}")
+
+
+def check_artifact_format(artifact_format):
+    if artifact_format == MSGPACK and msgpack is None:
+        raise ImportError("The msgpack batch artifact format needs the msgpack package (pip install msgpack)")
+
+
+def get_artifact_file_path(source_name, folder_path, artifact_format=JSONL):
+    return f'{folder_path}/Batches_{source_name}{EXTENSIONS[artifact_format]}'
+
+
+# Return the sorted list of batch artifact files in a folder.
+def read_all_artifact_files(folder_path):
+    artifact_path_list = []
+    for file_name in os.listdir(folder_path):
+        if file_name.endswith(tuple(EXTENSIONS.values())):
+            artifact_path_list.append(folder_path + "/" + file_name)
+    artifact_path_list.sort()
+    return artifact_path_list
+
+
+def save_batches_to_file(batches, file_path, labels=()):
+    artifact_format = get_artifact_format(file_path)
+    check_artifact_format(artifact_format)
+    # Level 6 is much faster than the default 9 and the files are only a little larger.
+    with gzip.open(file_path, 'wb', compresslevel=6) as f:
+        if artifact_format == MSGPACK:
+            f.write(msgpack.packb({'labels': list(labels)}))
+            for query, rows in batches:
+                f.write(msgpack.packb({'query': query, 'rows': rows}, default=property_serializer.encode_temporal))
+        else:
+            f.write((json.dumps({'labels': list(labels)}) + "\n").encode('utf-8'))
+            for query, rows in batches:
+                f.write((json.dumps({'query': query, 'rows': rows}, ensure_ascii=False,
+                                    default=property_serializer.encode_temporal) + "\n").encode('utf-8'))
+
+
+# Yield the records of a file one by one, the header first.
+def iter_records(file_path):
+    artifact_format = get_artifact_format(file_path)
+    check_artifact_format(artifact_format)
+    with gzip.open(file_path, 'rb') as f:
+        if artifact_format == MSGPACK:
+            yield from msgpack.Unpacker(f, raw=False, object_hook=property_serializer.decode_temporal)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line, object_hook=property_serializer.decode_temporal)
+
+
+def read_artifact_labels(file_path):
+    for record in iter_records(file_path):
+        return record.get('labels', [])
+    return []
+
+
+# Yield the (query, rows) batches of a file.
+# batch_size: if given, consecutive batches with the same query are joined and split again into batches of
+#             batch_size rows, so the batch size of the upload does not depend on the batch size of the conversion.
+def read_batches_from_file(file_path, batch_size=None):
+    query = None
+    rows = []
+    for record in iter_records(file_path):
+        if 'query' not in record:
+            continue
+        if batch_size is None:
+            yield record['query'], record['rows']
+            continue
+        if record['query'] != query and rows:
+            yield query, rows
+            rows = []
+        query = record['query']
+        rows.extend(record['rows'])
+        while len(rows) >= batch_size:
+            yield query, rows[:batch_size]
+            rows = rows[batch_size:]
+    if rows:
+        yield query, rows
@@ -0,0 +1,285 @@
+# Benchmark suite: per-stage timings of the conversion and upload of bundles, saved as JSON, so the results of two
+# versions can be compared automatically (--compare).
+#
+# Stages of one bundle:
+#   read    json.load of the file
+#   graph   resources to a Graph with the reference edges (graph_helper.convert_resource_dict_to_graph)
+#   unnest  property nodes (graph_helper.build_property_nodes_for_each_node)
+#   cypher  Cypher statements, or the (query, rows) batches with --mode batch
+#   upload  sending them to the sink: a recording_driver.RecordingDriver (no server), or Neo4j with --sink neo4j
+# Every bundle is converted --warmup times without timing and then --repeat times with time.perf_counter. The stages
+# are summarized over all timed runs with mean, min, max and percentiles.
+#
+# Without --json-folder the bundles are generated with synthetic_bundle, so every run converts the same data:
+#   python benchmark.py --bundles 5 --patients 2 --resources 300 --depth 3 --output benchmark_results.json
+#   python benchmark.py --output new.json --compare benchmark_results.json --threshold 0.1
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import conversion_cache
+import cypher_generator
+import graph_helper
+import pipeline
+import property_serializer
+import purge
+import recording_driver
+import synthetic_bundle
+
+STAGES = ("read", "graph", "unnest", "cypher", "upload", "total")
+PERCENTILES = (50, 90, 99)
+DEFAULT_WARMUP = 2
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.1
+
+
+# Percentile of a sorted list with linear interpolation between the closest ranks.
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+# Summary of a list of durations in seconds, in milliseconds.
+def summarize(durations):
+    sorted_durations = sorted(durations)
+    summary = {"count": len(durations),
+               "mean_ms": sum(durations) / len(durations) * 1000 if durations else 0.0,
+               "min_ms": sorted_durations[0] * 1000 if durations else 0.0,
+               "max_ms": sorted_durations[-1] * 1000 if durations else 0.0}
+    for percent in PERCENTILES:
+        summary[f"p{percent}_ms"] = percentile(sorted_durations, percent) * 1000
+    return summary
+
+
+# Convert and upload one bundle. Returns the duration of every stage in seconds, and the size of the graph.
+def time_stages(json_path, sink, mode="statement", batch_size=cypher_generator.DEFAULT_BATCH_SIZE):
+    durations = {}
+    start = time.perf_counter()
+    data = graph_helper.read_one_json(json_path)
+    durations["read"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    entries = data.get("entry", [])
+    graph = graph_helper.convert_resource_dict_to_graph(graph_helper.group_resources_by_type(entries),
+                                                        entries[0].get("fullUrl") if entries else '')
+    durations["graph"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    graph_helper.build_property_nodes_for_each_node(graph)
+    if purge.get_tag_bundles():
+        purge.tag_bundle_nodes(graph)
+    durations["unnest"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if mode == "batch":
+        batches = cypher_generator.convert_graph_to_batches(graph, batch_size)
+    else:
+        cypher_statements = (cypher_generator.convert_all_nodes_to_cypher(graph) +
+                             cypher_generator.convert_all_edges_to_cypher(graph))
+    durations["cypher"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if mode == "batch":
+        sink.run_cypher_batches(batches)
+    else:
+        sink.run_cypher_queries(cypher_statements)
+    durations["upload"] = time.perf_counter() - start
+
+    durations["total"] = sum(durations.values())
+    size = {"resources": len(entries), "nodes": len(graph.get_nodes_properties_unnested()),
+            "edges": graph.get_number_of_edges()}
+    return durations, size
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Run the benchmark on a list of json files and return the results as a dict that can be saved as JSON.
+# parameters: the settings of the run, saved with the results.
+def run_benchmark(json_path_list, sink, warmup=DEFAULT_WARMUP, repeat=DEFAULT_REPEAT, mode="statement",
+                  batch_size=cypher_generator.DEFAULT_BATCH_SIZE, parameters=None):
+    stage_durations = {stage: [] for stage in STAGES}
+    workload = {"files": len(json_path_list), "bytes": 0, "resources": 0, "nodes": 0, "edges": 0}
+    files = []
+    mean_total = 0.0
+    for json_path in json_path_list:
+        for _ in range(warmup):
+            time_stages(json_path, sink, mode, batch_size)
+        file_totals = []
+        for _ in range(repeat):
+            # Garbage of the previous run is not collected during this one.
+            gc.collect()
+            durations, size = time_stages(json_path, sink, mode, batch_size)
+            for stage in STAGES:
+                stage_durations[stage].append(durations[stage])
+            file_totals.append(durations["total"])
+        file_size = os.path.getsize(json_path)
+        workload["bytes"] += file_size
+        for key in ("resources", "nodes", "edges"):
+            workload[key] += size[key]
+        mean_total += sum(file_totals) / len(file_totals)
+        files.append(dict(name=os.path.basename(json_path), bytes=file_size, **size,
+                          total_p50_ms=percentile(sorted(file_totals), 50) * 1000))
+
+    throughput = {}
+    if mean_total > 0:
+        throughput = {"bundles_per_second": workload["files"] / mean_total,
+                      "resources_per_second": workload["resources"] / mean_total,
+                      "nodes_per_second": workload["nodes"] / mean_total}
+    return {"metadata": {"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                         "git_commit": get_git_commit(),
+                         "converter_version": conversion_cache.CONVERTER_VERSION,
+                         "python": sys.version.split()[0],
+                         "platform": platform.platform()},
+            "parameters": dict(parameters or {}, warmup=warmup, repeat=repeat, mode=mode, batch_size=batch_size),
+            "workload": workload,
+            "stages": {stage: summarize(stage_durations[stage]) for stage in STAGES},
+            "throughput": throughput,
+            "files": files}
+
+
+def save_results(results, file_path):
+    with open(file_path, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+
+
+def load_results(file_path):
+    with open(file_path) as results_file:
+        return json.load(results_file)
+
+
+# Compare the stages of two results. Returns a list of (stage, baseline, current, change) of every stage, where
+# change is current / baseline - 1 of the statistic, e.g. 0.25 if the stage got 25% slower.
+def compare_results(baseline, current, statistic="p50_ms"):
+    comparison = []
+    for stage in STAGES:
+        baseline_value = baseline["stages"].get(stage, {}).get(statistic)
+        current_value = current["stages"].get(stage, {}).get(statistic)
+        if not baseline_value or current_value is None:
+            continue
+        comparison.append((stage, baseline_value, current_value, current_value / baseline_value - 1))
+    return comparison
+
+
+def print_results(results):
+    print(f"{results['workload']['files']} files, {results['workload']['resources']} resources, "
+          f"{results['workload']['nodes']} nodes, {results['workload']['edges']} edges")
+    print(f"{'stage':<8}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage in STAGES:
+        summary = results["stages"][stage]
+        print(f"{stage:<8}{summary['mean_ms']:>10.2f}{summary['p50_ms']:>10.2f}{summary['p90_ms']:>10.2f}"
+              f"{summary['p99_ms']:>10.2f}{summary['max_ms']:>10.2f}")
+    throughput = results["throughput"]
+    if throughput:
+        print(f"{throughput['bundles_per_second']:.1f} bundles/s, {throughput['resources_per_second']:.0f} "
+              f"resources/s, {throughput['nodes_per_second']:.0f} nodes/s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the conversion and upload stages of fhir2neo.")
+    parser.add_argument("--json-folder", default=None,
+                        help="Benchmark the json files of this folder. Default: generate synthetic bundles.")
+    parser.add_argument("--limit", type=int, default=20, help="Maximum number of json files of --json-folder.")
+    parser.add_argument("--bundles", type=int, default=5, help="Number of synthetic bundles.")
+    parser.add_argument("--patients", type=int, default=synthetic_bundle.DEFAULT_PATIENTS,
+                        help="Patients per synthetic bundle.")
+    parser.add_argument("--resources", type=int, default=synthetic_bundle.DEFAULT_RESOURCES_PER_PATIENT,
+                        help="Resources per patient of the synthetic bundles.")
+    parser.add_argument("--depth", type=int, default=synthetic_bundle.DEFAULT_NESTING_DEPTH,
+                        help="Nesting depth of the extension added to every synthetic resource.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic bundles.")
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help="Untimed runs per bundle.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Timed runs per bundle.")
+    parser.add_argument("--mode", choices=["statement", "batch"], default="statement",
+                        help="Generate and upload statements or batches, see main.py.")
+    parser.add_argument("--batch-size", type=int, default=cypher_generator.DEFAULT_BATCH_SIZE,
+                        help="Rows per batch with --mode batch.")
+    parser.add_argument("--rules", default=None, help="Mapping rules file. Default: rules.txt next to main.py.")
+    parser.add_argument("--property-modes", default=None, help="Property mode file, see property_mode.py.")
+    parser.add_argument("--projection", default=None, help="Projection file, see projection.py.")
+    parser.add_argument("--summary", default=None, help="Summary properties file, see patient_summary.py.")
+    parser.add_argument("--timeline", action="store_true", help="Build the NEXT_EVENT timeline, needs --summary.")
+    parser.add_argument("--tag-bundles", action="store_true", help="Give every node its bundle id, see purge.py.")
+    parser.add_argument("--property-types", choices=property_serializer.PROPERTY_TYPES,
+                        default=property_serializer.TYPED, help="Property value types, see property_serializer.py.")
+    parser.add_argument("--sink", choices=["recording", "neo4j"], default="recording",
+                        help="Upload to a recording driver without a server, or to the Neo4j database of --config. "
+                             "Every timed run uploads the bundle again, so use an empty test database.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds the recording driver waits per query, to simulate the round trip.")
+    parser.add_argument("--config", default='neo4j_config.txt', help="Neo4j config file for --sink neo4j.")
+    parser.add_argument("--output", default='benchmark_results.json', help="JSON file of the results.")
+    parser.add_argument("--compare", default=None, metavar="BASELINE",
+                        help="Compare the p50 of every stage with the results in this JSON file, and exit with 1 "
+                             "if a stage is slower by more than --threshold.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Allowed slowdown for --compare, 0.1 is 10%%.")
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if args.warmup < 0:
+        parser.error("--warmup must not be negative")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    pipeline.ConversionSettings(rule_file_path=args.rules, property_mode_file_path=args.property_modes,
+                                projection_file_path=args.projection, summary_file_path=args.summary,
+                                timeline=args.timeline, property_types=args.property_types,
+                                tag_bundles=args.tag_bundles).apply()
+    if args.sink == "neo4j":
+        import neo4j_driver
+        sink = neo4j_driver.Neo4jDriver(args.config)
+    else:
+        sink = recording_driver.RecordingDriver(latency=args.latency)
+    sink.connect()
+
+    with tempfile.TemporaryDirectory() as synthetic_folder_path:
+        if args.json_folder:
+            json_path_list = graph_helper.read_all_json_files(args.json_folder)[:args.limit]
+            parameters = {"json_folder": args.json_folder}
+        else:
+            json_path_list = synthetic_bundle.save_bundles(synthetic_folder_path, args.bundles, args.patients,
+                                                           args.resources, args.depth, args.seed)
+            parameters = {"synthetic": {"bundles": args.bundles, "patients": args.patients,
+                                        "resources": args.resources, "depth": args.depth, "seed": args.seed}}
+        parameters.update(sink=args.sink, latency=args.latency, rules=args.rules,
+                          property_modes=args.property_modes, property_types=args.property_types,
+                          projection=args.projection, summary=args.summary, timeline=args.timeline,
+                          tag_bundles=args.tag_bundles)
+        results = run_benchmark(json_path_list, sink, args.warmup, args.repeat, args.mode, args.batch_size,
+                                parameters)
+    sink.close()
+
+    print_results(results)
+    save_results(results, args.output)
+    print(f"Results have been saved at {args.output}")
+
+    if args.compare:
+        baseline = load_results(args.compare)
+        if baseline.get("parameters") != results["parameters"]:
+            print(f"Warning: {args.compare} was measured with other parameters")
+        regressions = []
+        for stage, baseline_value, current_value, change in compare_results(baseline, results):
+            print(f"{stage:<8}{baseline_value:>10.2f} ms -> {current_value:>10.2f} ms  {change:+.1%}")
+            if change > args.threshold:
+                regressions.append(stage)
+        if regressions:
+            print(f"Slower than {args.compare} by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            raise SystemExit(1)
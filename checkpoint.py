@@ -0,0 +1,95 @@
+# Checkpoint journal of an ingest run: which bundles are uploaded completely, which failed, and how many transactions
+# of a bundle that is uploaded in chunks are already committed.
+#
+# Every bundle is uploaded in one write transaction, or with --transaction-size in chunks of that many queries, each
+# in its own transaction (see neo4j_driver.Neo4jDriver.run_cypher_queries). The journal is updated after every
+# commit, so after a crash nothing is committed twice. With --adaptive the journal counts the committed rows of a bundle
+# instead of its transactions (see upload_controller):
+#   python main.py --resume
+# skips the bundles that are done, continues a chunked bundle after its last committed chunk, and tries the failed
+# bundles again. Without --resume the journal of the last run is cleared.
+# A bundle is converted again before it is resumed, and only a conversion that does not depend on the earlier bundles
+# of the run gives the same chunks, so --resume does not work with --registry or --shared-codes.
+#
+# The journal is a SQLite file. The upload threads of the pipeline share it under a lock.
+import os
+import sqlite3
+import threading
+import time
+
+import ndjson_reader
+
+DEFAULT_CHECKPOINT_FILE_PATH = "ingest_checkpoint.sqlite"
+
+DONE = "done"
+FAILED = "failed"
+IN_PROGRESS = "in_progress"
+
+
+# Key of a source in the journal: the absolute path of a Bundle json file, or the name of an NDJSON range.
+def get_checkpoint_key(source):
+    if isinstance(source, ndjson_reader.NdjsonRange):
+        return source.get_name()
+    return os.path.abspath(source)
+
+
+class CheckpointJournal:
+    def __init__(self, checkpoint_file_path=DEFAULT_CHECKPOINT_FILE_PATH):
+        self.checkpoint_file_path = checkpoint_file_path
+        self.connection = sqlite3.connect(checkpoint_file_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS bundles (source TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                                "committed_chunks INTEGER NOT NULL, total_chunks INTEGER, error TEXT, "
+                                "updated REAL NOT NULL)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    # Forget the last run.
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM bundles")
+
+    def get_status(self, source):
+        with self.lock:
+            row = self.connection.execute("SELECT status FROM bundles WHERE source = ?",
+                                          (get_checkpoint_key(source),)).fetchone()
+        return row[0] if row else None
+
+    def is_done(self, source):
+        return self.get_status(source) == DONE
+
+    # Number of chunks of the bundle that are committed. The upload continues with the next one.
+    def get_committed_chunks(self, source):
+        with self.lock:
+            row = self.connection.execute("SELECT committed_chunks FROM bundles WHERE source = ?",
+                                          (get_checkpoint_key(source),)).fetchone()
+        return row[0] if row else 0
+
+    def save(self, source, status, committed_chunks=None, total_chunks=None, error=None):
+        key = get_checkpoint_key(source)
+        with self.lock, self.connection:
+            if committed_chunks is None:
+                row = self.connection.execute("SELECT committed_chunks, total_chunks FROM bundles WHERE source = ?",
+                                              (key,)).fetchone()
+                committed_chunks, total_chunks = row if row else (0, None)
+            self.connection.execute("INSERT OR REPLACE INTO bundles (source, status, committed_chunks, "
+                                    "total_chunks, error, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                                    (key, status, committed_chunks, total_chunks, error, time.time()))
+
+    # Called after every commit, see neo4j_driver.Neo4jDriver.run_cypher_queries.
+    def save_chunk(self, source, committed_chunks, total_chunks):
+        self.save(source, IN_PROGRESS, committed_chunks, total_chunks)
+
+    def save_done(self, source):
+        self.save(source, DONE)
+
+    # The committed chunks are kept, so --resume continues after them.
+    def save_failed(self, source, error):
+        self.save(source, FAILED, error=str(error))
+
+    # Return a dict, key is the status, value is the number of bundles with that status.
+    def count_by_status(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM bundles GROUP BY status").fetchall())
@@ -0,0 +1,182 @@
+# On-disk cache of conversion results, so a bundle that has not changed is not converted again.
+#
+# An entry is found by its content: the key is a hash of the bundle bytes, the configuration of the conversion (see
+# compute_config_digest) and the kind of result (the Graph, or the statements and batches of pipeline.convert_bundle).
+# A changed bundle or rules file gives a new key, so entries never need to be invalidated, only evicted: when the
+# cache folder is larger than max_size, the least recently used entries are deleted (every hit touches the file).
+#
+# Conversion with a resource registry or shared codes depends on what earlier bundles wrote, so it is not cached
+# (see is_cacheable).
+import gzip
+import hashlib
+import os
+import pickle
+import threading
+
+import patient_summary
+import projection
+import property_mode
+import property_serializer
+import purge
+import resource_registry
+import rule
+import terminology
+
+# Change this when a change of the converter changes its output, so old entries are not used any more.
+CONVERTER_VERSION = "6"
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+EXTENSION = ".pickle.gz"
+
+# The cache used by pipeline.convert_source_to_graph and pipeline.convert_bundle, or None.
+conversion_cache = None
+
+# The config digest of this process (see get_config_digest), or None before it is computed.
+config_digest = None
+
+
+def compute_file_digest(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Digest of everything besides the bundle that changes the result of a conversion: the converter version, the rules,
+# property mode, projection and summary files, the property types, shared codes and bundle tagging. The incremental
+# ingest (see incremental) saves it with the hashes of a bundle as well.
+def compute_config_digest():
+    config_hash = hashlib.sha256()
+    config_hash.update(f"{CONVERTER_VERSION}\n{property_serializer.get_property_types()}\n".encode('utf-8'))
+    config_hash.update(compute_file_digest(rule.get_default_rule_file_path()).encode('utf-8'))
+    property_mode_file_path = property_mode.get_default_property_mode_file_path()
+    if property_mode_file_path:
+        config_hash.update(compute_file_digest(property_mode_file_path).encode('utf-8'))
+    projection_file_path = projection.get_default_projection_file_path()
+    if projection_file_path:
+        config_hash.update(f"projection {compute_file_digest(projection_file_path)}".encode('utf-8'))
+    summary_file_path = patient_summary.get_default_summary_file_path()
+    if summary_file_path:
+        summary = f"summary {compute_file_digest(summary_file_path)} {patient_summary.get_timeline()}"
+        config_hash.update(summary.encode('utf-8'))
+    if terminology.get_shared_codes():
+        config_hash.update(b"shared_codes")
+    if purge.get_tag_bundles():
+        config_hash.update(b"tag_bundles")
+    return config_hash.hexdigest()
+
+
+# Compute the config digest of this process again. pipeline.ConversionSettings.apply calls it after it has set the
+# configuration, so the files are read and hashed once per process, not once per bundle.
+def update_config_digest():
+    global config_digest
+    config_digest = compute_config_digest()
+    return config_digest
+
+
+def get_config_digest():
+    if config_digest is None:
+        return update_config_digest()
+    return config_digest
+
+
+class ConversionCache:
+    def __init__(self, cache_folder_path, max_size=DEFAULT_MAX_SIZE):
+        self.cache_folder_path = cache_folder_path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_folder_path, exist_ok=True)
+        self.size = sum(size for path, size, mtime in self.list_entries())
+
+    # Return a list of (path, size, mtime) of all entries.
+    def list_entries(self):
+        entries = []
+        for file_name in os.listdir(self.cache_folder_path):
+            if file_name.endswith(EXTENSION):
+                path = os.path.join(self.cache_folder_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process.
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    # kind: what is cached for the bundle, e.g. 'graph'. Different kinds of one bundle have different keys.
+    def make_key(self, json_path, kind):
+        key_hash = hashlib.sha256()
+        key_hash.update(f"{kind}\n{get_config_digest()}\n".encode('utf-8'))
+        key_hash.update(compute_file_digest(json_path).encode('utf-8'))
+        return key_hash.hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_folder_path, key + EXTENSION)
+
+    # Return the cached value of a key, or None.
+    def get(self, key):
+        path = self.get_entry_path(key)
+        try:
+            with gzip.open(path, 'rb') as f:
+                value = pickle.load(f)
+            # The mtime is the time of the last use, for the LRU eviction.
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self.get_entry_path(key)
+        # Written to a temporary file first, so other processes never read a half written entry.
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(temp_path, 'wb', compresslevel=1) as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_size:
+            self.evict()
+
+    # Delete the least recently used entries until the cache is not larger than max_size.
+    def evict(self):
+        entries = sorted(self.list_entries(), key=lambda entry: entry[2])
+        self.size = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def get_hits(self):
+        return self.hits
+
+    def get_misses(self):
+        return self.misses
+
+    def get_evictions(self):
+        return self.evictions
+
+    def get_statistics(self):
+        return (f"Conversion cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+                f"{self.size / (1024 * 1024):.1f} MB")
+
+
+def set_conversion_cache(cache):
+    global conversion_cache
+    conversion_cache = cache
+
+
+def get_conversion_cache():
+    return conversion_cache
+
+
+# Only Bundle json files are cached, and only if their conversion does not depend on earlier bundles.
+def is_cacheable(source):
+    return (conversion_cache is not None and isinstance(source, str) and resource_registry.get_registry() is None
+            and not terminology.get_shared_codes())
@@ -0,0 +1,178 @@
+# Export graphs as CSV files for the offline bulk importer (neo4j-admin database import).
+#
+# For an initial load of many bundles this is much faster than running Cypher statements: the graphs are written to
+# one header file and one data file per node label and per relationship type, and neo4j-admin builds the database
+# from them in one pass.
+#
+# Output files (in output_folder):
+#   nodes_<Label>_header.csv, nodes_<Label>.csv[.gz]
+#   relationships_<TYPE>_header.csv, relationships_<TYPE>.csv[.gz]
+#
+# Nodes of one label can have different properties. The node rows are first written to a temporary json lines file,
+# and the csv file with the header of all properties of that label is written by close().
+#
+# Shared resources (Organization, Practitioner, ...) appear in many bundles. Each one is written once, the first
+# time it is seen, and the edges of later bundles point to that first node.
+import csv
+import gzip
+import json
+import os
+
+# Resource types that are written once across all bundles, identified by resourceType + id (or fullUrl).
+from resource_registry import DEFAULT_SHARED_RESOURCE_TYPES
+
+RELATIONSHIP_PROPERTIES = ["source_node_name", "target_node_name", "source_node_type", "target_node_type",
+                           "reference_path"]
+
+
+class CsvExporter:
+    def __init__(self, output_folder, compress=False, shared_resource_types=DEFAULT_SHARED_RESOURCE_TYPES):
+        self.output_folder = output_folder
+        self.compress = compress
+        self.shared_resource_types = set(shared_resource_types)
+        # key: 'ResourceType/id', value: id of the node that was written for it.
+        self.shared_node_ids = {}
+        # Ids of the shared nodes of the graphs (e.g. terminology Code nodes) that were written.
+        self.written_shared_node_ids = set()
+        # key: label, value: dict of property names (used as an ordered set).
+        self.node_columns = {}
+        self.node_temp_files = {}
+        self.relationship_writers = {}
+        self.relationship_files = {}
+        self.relationship_types = []
+        self.number_of_nodes = 0
+        self.number_of_relationships = 0
+        os.makedirs(output_folder, exist_ok=True)
+
+    def open_data_file(self, file_name):
+        path = os.path.join(self.output_folder, file_name + (".csv.gz" if self.compress else ".csv"))
+        if self.compress:
+            return gzip.open(path, 'wt', newline='', encoding='utf-8')
+        return open(path, 'w', newline='', encoding='utf-8')
+
+    def write_header_file(self, file_name, header):
+        with open(os.path.join(self.output_folder, file_name + "_header.csv"), 'w', newline='',
+                  encoding='utf-8') as f:
+            csv.writer(f).writerow(header)
+
+    # Key of a shared resource node, or None if the node is not a shared resource.
+    def get_shared_resource_key(self, node):
+        if node.get_isPropertyNode() or node.get_node_type() not in self.shared_resource_types:
+            return None
+        resource_id = node.get_properties().get('id')
+        if resource_id:
+            return f"{node.get_node_type()}/{resource_id}"
+        return node.get_fullUrl() or None
+
+    # Add all nodes and edges of one graph (after build_property_nodes_for_each_node).
+    def add_graph(self, graph):
+        # Nodes that are not written, because the same shared resource was already written.
+        skipped = set()
+        # Node id -> id of the node that was written instead.
+        replaced_ids = {}
+        for node in graph.get_nodes_properties_unnested():
+            key = self.get_shared_resource_key(node)
+            if key is not None:
+                if key in self.shared_node_ids:
+                    skipped.add(node)
+                    replaced_ids[node.get_id()] = self.shared_node_ids[key]
+                    continue
+                self.shared_node_ids[key] = node.get_id()
+
+        # The property nodes of a skipped resource are skipped too. Property edges are added parent first,
+        # so one pass over the edges finds the whole subtree.
+        edges = list(graph.get_edges())
+        for edge in edges:
+            if edge.get_source_node() in skipped and edge.get_target_node().get_isPropertyNode():
+                skipped.add(edge.get_target_node())
+
+        for node in graph.get_shared_nodes():
+            if node.get_id() not in self.written_shared_node_ids:
+                self.written_shared_node_ids.add(node.get_id())
+                self.write_node(node)
+        for node in graph.get_nodes_properties_unnested():
+            if node not in skipped:
+                self.write_node(node)
+        for edge in edges:
+            if edge.get_source_node() in skipped:
+                continue
+            target_id = edge.get_target_node().get_id()
+            self.write_relationship(edge, replaced_ids.get(target_id, target_id))
+
+    def write_node(self, node):
+        label = node.get_node_type()
+        temp_file = self.node_temp_files.get(label)
+        if temp_file is None:
+            temp_file = open(os.path.join(self.output_folder, f"nodes_{label}.jsonl.tmp"), 'w', encoding='utf-8')
+            self.node_temp_files[label] = temp_file
+            self.node_columns[label] = {}
+        # Values are stored as strings, the same as in cypher_generator. The resource id is replaced by the node id.
+        row = {'node_name': node.get_name()}
+        for key, value in node.get_properties().items():
+            if key != 'id':
+                row[key] = str(value)
+        row['fullUrl'] = node.get_fullUrl()
+        columns = self.node_columns[label]
+        for key in row:
+            if key not in columns:
+                columns[key] = None
+        temp_file.write(json.dumps([node.get_id(), row]) + "\n")
+        self.number_of_nodes += 1
+
+    def write_relationship(self, edge, target_id):
+        edge_type = edge.get_edge_type() if edge.get_edge_type() else "UNDEFINED"
+        writer = self.relationship_writers.get(edge_type)
+        if writer is None:
+            self.write_header_file(f"relationships_{edge_type}",
+                                   [":START_ID", ":END_ID", ":TYPE"] + RELATIONSHIP_PROPERTIES)
+            data_file = self.open_data_file(f"relationships_{edge_type}")
+            writer = csv.writer(data_file)
+            self.relationship_files[edge_type] = data_file
+            self.relationship_writers[edge_type] = writer
+            self.relationship_types.append(edge_type)
+        source_node = edge.get_source_node()
+        target_node = edge.get_target_node()
+        writer.writerow([source_node.get_id(), target_id, edge_type,
+                         source_node.get_name(), target_node.get_name(),
+                         source_node.get_node_type(), target_node.get_node_type(), edge.get_reference_path()])
+        self.number_of_relationships += 1
+
+    # Write the node csv files and close all files. Returns the arguments for neo4j-admin database import.
+    def close(self):
+        for label, temp_file in self.node_temp_files.items():
+            temp_file.close()
+            columns = list(self.node_columns[label])
+            self.write_header_file(f"nodes_{label}", ["id:ID"] + columns + [":LABEL"])
+            temp_path = os.path.join(self.output_folder, f"nodes_{label}.jsonl.tmp")
+            with open(temp_path, 'r', encoding='utf-8') as f, self.open_data_file(f"nodes_{label}") as data_file:
+                writer = csv.writer(data_file)
+                for line in f:
+                    node_id, row = json.loads(line)
+                    writer.writerow([node_id] + [row.get(column, '') for column in columns] + [label])
+            os.remove(temp_path)
+        for data_file in self.relationship_files.values():
+            data_file.close()
+        self.node_temp_files = {}
+        self.relationship_files = {}
+        self.relationship_writers = {}
+        return self.get_import_arguments()
+
+    def get_import_arguments(self):
+        extension = ".csv.gz" if self.compress else ".csv"
+        arguments = []
+        for label in sorted(self.node_columns):
+            arguments.append("--nodes={},{}".format(os.path.join(self.output_folder, f"nodes_{label}_header.csv"),
+                                                    os.path.join(self.output_folder, f"nodes_{label}{extension}")))
+        for edge_type in sorted(self.relationship_types):
+            arguments.append("--relationships={},{}".format(
+                os.path.join(self.output_folder, f"relationships_{edge_type}_header.csv"),
+                os.path.join(self.output_folder, f"relationships_{edge_type}{extension}")))
+        # Property values can contain line breaks (e.g. the narrative in text.div).
+        arguments.append("--multiline-fields=true")
+        return arguments
+
+    def get_number_of_nodes(self):
+        return self.number_of_nodes
+
+    def get_number_of_relationships(self):
+        return self.number_of_relationships
@@ -1,4 +1,9 @@
 # Convert the graph to cypher statements.
+import functools
+import re
+
+import instrumentation
+import property_serializer
 
 # Example of cypher statements:
 # CREATE (alice:Person {id: '1', name: 'Alice', age: 30, city: 'New York'})
@@ -19,33 +24,43 @@
 # MATCH (n), (m) WHERE n.id = "6" AND m.id = "7" CREATE (n)-[:KNOWS]->(m)
 
 
+# Property names that are not plain identifiers (e.g. code.coding.0.code in the flat property mode) are quoted
+# with backticks. There are few different keys, so the result is cached.
+@functools.lru_cache(maxsize=4096)
+def quote_property_key(key):
+    if re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', key):
+        return key
+    return "`{}`".format(key.replace("`", "``"))
+
+
 # Cypher statement create node
-def convert_one_node_to_cypher(node):
+# merge: MERGE the node on its id and replace its properties, instead of CREATE. Used for resource nodes that other
+#        graphs can refer to (see Graph.merge_resource_nodes), and for resource nodes that are uploaded again.
+def convert_one_node_to_cypher(node, merge=False):
     node_type = node.get_node_type()
     node_name = node.get_name()
     node_properties = node.get_properties()
     node_fullUrl = node.get_fullUrl()
     node_id = node.get_id()  # Each node has a unique id. The id is used to create a relationship between two nodes.
 
-    # Escape single quotes in property values
-    escaped_properties = {}
-    for key, value in node_properties.items():
-        # Some values could be boolean, int, float, etc. We only need to escape string values.
-        if isinstance(value, str):
-            escaped_properties[key] = value.replace("'", "\\'")
-        else:
-            escaped_properties[key] = value
-
-    # Build Cypher statement
-    properties_str = ', '.join([f"{key}: '{value}'" for key, value in escaped_properties.items()])
+    # Build Cypher statement. The values are typed Cypher literals with escaped strings (see property_serializer).
+    format_cypher_literal = property_serializer.format_cypher_literal
+    properties_str = ', '.join([f"{quote_property_key(key)}: {format_cypher_literal(value)}"
+                                for key, value in node_properties.items()])
     properties_part = f", {properties_str}" if properties_str else ""
 
     node_label = f"n_{node_id}"
+    quote_string = property_serializer.quote_string
 
-    cypher_statement = "CREATE ({}:{} {{node_name: '{}'{} , id: '{}', fullUrl: '{}'}})".format(node_label,
-                                                                                               node_type, node_name,
-                                                                                               properties_part, node_id,
-                                                                                               node_fullUrl)
+    if merge:
+        cypher_statement = "MERGE ({}:{} {{id: {}}}) SET {} = {{node_name: {}{} , id: {}, fullUrl: {}}}".format(
+            node_label, node_type, quote_string(node_id), node_label, quote_string(str(node_name)), properties_part,
+            quote_string(node_id), quote_string(str(node_fullUrl)))
+        return cypher_statement
+
+    cypher_statement = "CREATE ({}:{} {{node_name: {}{} , id: {}, fullUrl: {}}})".format(
+        node_label, node_type, quote_string(str(node_name)), properties_part, quote_string(node_id),
+        quote_string(str(node_fullUrl)))
     return cypher_statement
 
 
@@ -62,44 +77,196 @@ def convert_one_edge_to_cypher(edge):
     source_node_label = f"n_{source_node_id}"
     target_node_label = f"n_{target_node_id}"
 
-    # Escape single quotes in property values
-    escaped_source_node_name = source_node_name.replace("'", "\\'")
-    escaped_target_node_name = target_node_name.replace("'", "\\'")
-    escaped_source_node_type = source_node_type.replace("'", "\\'")
-    escaped_target_node_type = target_node_type.replace("'", "\\'")
-
-    cypher_statement = ("MATCH (n), (m) "
-                        "WHERE n.id = '{}' AND m.id = '{}' "
-                        "CREATE (n)-[:{} {"
-                        "{source_node_name: '{}', "
-                        "target_node_name: '{}', "
-                        "source_node_type: '{}', "
-                        "target_node_type: '{}'}}]->(m);").format(
-        source_node_id, target_node_id, edge_type,
-        escaped_source_node_name, escaped_target_node_name,
-        escaped_source_node_type, escaped_target_node_type,)
+    # Escape the property values
+    quote_string = property_serializer.quote_string
+    # Edges between two resources also keep the JSON path of the reference.
+    reference_path = edge.get_reference_path()
+    reference_path_part = ", reference_path: {}".format(quote_string(reference_path)) if reference_path else ""
+
+    # The labels of both nodes are part of the MATCH, so the lookup by id is an index seek (see neo4j_schema).
+    # A target node from another graph may not be uploaded yet, so it is MERGEd instead of matched.
+    if edge.get_target_node().get_isExternalNode():
+        match_part = "MATCH (n:{} {{id: {}}}) MERGE (m:{} {{id: {}}}) "
+    else:
+        match_part = "MATCH (n:{} {{id: {}}}), (m:{} {{id: {}}}) "
+    cypher_statement = (match_part +
+                        "CREATE (n)-[:{} {{"
+                        "source_node_name: {}, "
+                        "target_node_name: {}, "
+                        "source_node_type: {}, "
+                        "target_node_type: {}{}}}]->(m);").format(
+        source_node_type, quote_string(source_node_id), target_node_type, quote_string(target_node_id), edge_type,
+        quote_string(source_node_name), quote_string(target_node_name),
+        quote_string(source_node_type), quote_string(target_node_type), reference_path_part)
 
     return cypher_statement
 
 
 # This will return a list of cypher statements line by line, creating all nodes.
+# Shared nodes (e.g. terminology Code nodes) are always MERGEd.
+@instrumentation.timed("convert_all_nodes_to_cypher")
 def convert_all_nodes_to_cypher(graph):
     cypher_statements = []
-    for node in graph.get_nodes_properties_unnested().values():
-        cypher_statements.append(convert_one_node_to_cypher(node))
+    for node in graph.get_shared_nodes():
+        cypher_statements.append(convert_one_node_to_cypher(node, merge=True))
+    merge_resource_nodes = graph.get_merge_resource_nodes()
+    for node in graph.get_nodes_properties_unnested():
+        merge = merge_resource_nodes and not node.get_isPropertyNode()
+        cypher_statements.append(convert_one_node_to_cypher(node, merge))
+    instrumentation.add_count("statements", len(cypher_statements))
     return cypher_statements
 
 
 # This will return a list of cypher statements line by line, creating all edges.
+@instrumentation.timed("convert_all_edges_to_cypher")
 def convert_all_edges_to_cypher(graph):
     cypher_statements = []
     for edge in graph.get_edges():
         cypher_statements.append(convert_one_edge_to_cypher(edge))
+    instrumentation.add_count("statements", len(cypher_statements))
     return cypher_statements
 
 
 def save_cypher_statements_to_file(cypher_statements, file_path):
-    # Save cypher statements to a txt file line by line
-    with open(file_path, 'w') as f:
-        for item in cypher_statements:
-            f.write("%s\n" % item)
+    # Save cypher statements to a txt file line by line, with one buffered writelines call.
+    with open(file_path, 'w', buffering=1 << 20) as f:
+        f.writelines(f"{item}\n" for item in cypher_statements)
+
+
+# Batched upload: instead of one literal statement per node/edge, nodes are grouped by label and edges by
+# relationship type into lists of parameter rows. Each group is sent as "UNWIND $rows AS r CREATE ...",
+# so the query text stays the same for every chunk and Neo4j can reuse its cached plan.
+#
+# Example of a batch:
+# ("UNWIND $rows AS r CREATE (n:`Patient`) SET n = r",
+#  [{'node_name': 'patient', 'gender': 'female', 'id': 'a509406a_5098_478c_b183_037d68a953d9_1', 'fullUrl': '...'}])
+DEFAULT_BATCH_SIZE = 1000
+
+
+# Parameter row of one node. The values are converted to their property types with all rows of their label, see
+# convert_all_nodes_to_rows.
+def convert_one_node_to_row(node):
+    row = {'node_name': node.get_name()}
+    row.update(node.get_properties())
+    row['id'] = node.get_id()
+    row['fullUrl'] = node.get_fullUrl()
+    return row
+
+
+# Parameter row of one edge. The relationship properties are kept in a nested map.
+def convert_one_edge_to_row(edge):
+    properties = {'source_node_name': edge.get_source_node().get_name(),
+                  'target_node_name': edge.get_target_node().get_name(),
+                  'source_node_type': edge.get_source_node().get_node_type(),
+                  'target_node_type': edge.get_target_node().get_node_type()}
+    if edge.get_reference_path():
+        properties['reference_path'] = edge.get_reference_path()
+    return {'source_id': edge.get_source_node().get_id(),
+            'target_id': edge.get_target_node().get_id(),
+            'properties': properties}
+
+
+# Return a dict, key is (node label, merge), value is a list of parameter rows with typed values
+# (see property_serializer).
+def convert_all_nodes_to_rows(graph):
+    rows_by_label = {}
+    for node in graph.get_shared_nodes():
+        rows_by_label.setdefault((node.get_node_type(), True), []).append(convert_one_node_to_row(node))
+    merge_resource_nodes = graph.get_merge_resource_nodes()
+    for node in graph.get_nodes_properties_unnested():
+        key = (node.get_node_type(), merge_resource_nodes and not node.get_isPropertyNode())
+        rows_by_label.setdefault(key, []).append(convert_one_node_to_row(node))
+    for rows in rows_by_label.values():
+        property_serializer.serialize_rows(rows)
+    return rows_by_label
+
+
+# Return a dict, key is (relationship type, source label, target label, target is external),
+# value is a list of parameter rows.
+# The labels are part of the key, so the MATCH of each batch can use the id index of both labels.
+def convert_all_edges_to_rows(graph):
+    rows_by_type = {}
+    for edge in graph.get_edges():
+        edge_type = edge.get_edge_type() if edge.get_edge_type() else "UNDEFINED"
+        key = (edge_type, edge.get_source_node().get_node_type(), edge.get_target_node().get_node_type(),
+               edge.get_target_node().get_isExternalNode())
+        rows_by_type.setdefault(key, []).append(convert_one_edge_to_row(edge))
+    return rows_by_type
+
+
+def build_node_batch_query(node_label, merge=False):
+    if merge:
+        return "UNWIND $rows AS r MERGE (n:`{}` {{id: r.id}}) SET n = r".format(node_label)
+    return "UNWIND $rows AS r CREATE (n:`{}`) SET n = r".format(node_label)
+
+
+def build_edge_batch_query(edge_type, source_label, target_label, merge_target=False):
+    if merge_target:
+        match_part = "MATCH (n:`{}` {{id: r.source_id}}) MERGE (m:`{}` {{id: r.target_id}}) "
+    else:
+        match_part = "MATCH (n:`{}` {{id: r.source_id}}), (m:`{}` {{id: r.target_id}}) "
+    return ("UNWIND $rows AS r " + match_part +
+            "CREATE (n)-[e:`{}`]->(m) SET e = r.properties").format(source_label, target_label, edge_type)
+
+
+# Split a list of rows into chunks of at most batch_size rows.
+def split_rows_into_chunks(rows, batch_size):
+    return [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+
+
+# Return a list of (query, rows) pairs. All node batches come before the edge batches,
+# because the edges need to MATCH nodes that already exist.
+@instrumentation.timed("convert_graph_to_batches")
+def convert_graph_to_batches(graph, batch_size=DEFAULT_BATCH_SIZE):
+    batches = []
+    for (node_label, merge), rows in convert_all_nodes_to_rows(graph).items():
+        query = build_node_batch_query(node_label, merge)
+        for chunk in split_rows_into_chunks(rows, batch_size):
+            batches.append((query, chunk))
+    for (edge_type, source_label, target_label, merge_target), rows in convert_all_edges_to_rows(graph).items():
+        query = build_edge_batch_query(edge_type, source_label, target_label, merge_target)
+        for chunk in split_rows_into_chunks(rows, batch_size):
+            batches.append((query, chunk))
+    instrumentation.add_count("batches", len(batches))
+    return batches
+
+
+# Before a changed resource is uploaded again, its old Property subtree and its outgoing edges are deleted
+# (see incremental). The property nodes of a resource are found by the property owner_property, which holds the
+# id of the resource node.
+def convert_one_resource_to_delete_cypher(node, owner_property):
+    node_id = property_serializer.quote_string(node.get_id())
+    return ["MATCH (n:`{}` {{id: {}}})-[e]->() DELETE e;".format(node.get_node_type(), node_id),
+            "MATCH (p:`Property` {{{}: {}}}) DETACH DELETE p;".format(quote_property_key(owner_property), node_id)]
+
+
+def build_delete_edges_batch_query(node_label):
+    return "UNWIND $rows AS r MATCH (n:`{}` {{id: r.id}})-[e]->() DELETE e".format(node_label)
+
+
+def build_delete_property_nodes_batch_query(owner_property):
+    return "UNWIND $rows AS r MATCH (p:`Property` {{`{}`: r.id}}) DETACH DELETE p".format(owner_property)
+
+
+# Return a list of (query, rows) pairs that delete the outgoing edges and the Property subtrees of the nodes.
+def convert_resources_to_delete_batches(nodes, owner_property, batch_size=DEFAULT_BATCH_SIZE):
+    rows_by_label = {}
+    for node in nodes:
+        rows_by_label.setdefault(node.get_node_type(), []).append({'id': node.get_id()})
+    batches = []
+    for node_label, rows in rows_by_label.items():
+        query = build_delete_edges_batch_query(node_label)
+        for chunk in split_rows_into_chunks(rows, batch_size):
+            batches.append((query, chunk))
+    rows = [{'id': node.get_id()} for node in nodes]
+    query = build_delete_property_nodes_batch_query(owner_property)
+    for chunk in split_rows_into_chunks(rows, batch_size):
+        batches.append((query, chunk))
+    return batches
+
+
+# Delete the nodes of a bundle with their relationships (see purge). The bundle id is checked as well, so a node of
+# another bundle with the same id is kept.
+def build_delete_bundle_nodes_batch_query(node_label, bundle_property):
+    return "UNWIND $rows AS r MATCH (n:`{}` {{id: r.id}}) WHERE n.`{}` = r.bundle_id DETACH DELETE n".format(
+        node_label, bundle_property)
@@ -0,0 +1,333 @@
+# Distributed ingest: a coordinator splits the corpus into shards, and any number of workers on any number of machines
+# lease the shards from a work queue on shared storage and ingest them.
+#
+#   python distributed.py create --work-queue /shared/queue.sqlite --json-folder "/shared/FHIR JSON" --shards 64
+#   python main.py --work-queue /shared/queue.sqlite --workers 4 --mode batch        (on every ingest machine)
+#   python distributed.py status --work-queue /shared/queue.sqlite --watch 10
+#
+# To try the queue on one machine, without a Neo4j server, start several worker processes on a local queue file:
+#   python distributed.py create --work-queue /tmp/queue.sqlite --shards 4
+#   mkdir -p /tmp/cypher
+#   python main.py --work-queue /tmp/queue.sqlite --worker-id local-1 --no-upload --cypher-folder /tmp/cypher &
+#   python main.py --work-queue /tmp/queue.sqlite --worker-id local-2 --no-upload --cypher-folder /tmp/cypher &
+#   python distributed.py status --work-queue /tmp/queue.sqlite --watch 2
+# Each worker prints the shards it has leased, and status prints the sources that each worker has done.
+#
+# A bundle goes to the shard hash(patient id) % shards, so all bundles of a patient are in the same shard and are
+# ingested in order by one worker. The patient id is the id of the first Patient resource of the bundle (the file
+# name if there is none). NDJSON ranges contain many patients, so they go to the shard hash(range name) % shards.
+# The shards only depend on the files, so creating the queue again gives the same shards.
+#
+# The work queue is a SQLite file. A worker leases one shard at a time for lease_time seconds, and the lease is
+# renewed with every committed transaction. The shard of a worker that crashed is leased again when its lease has
+# expired; the bundles that were already uploaded are skipped, because the queue is also the checkpoint journal of
+# the workers (it has the methods of checkpoint.CheckpointJournal). A shard with failed bundles is leased again, at
+# most max_attempts times.
+# Progress is only saved while the lease of the worker is valid. A worker that was too slow and lost its lease
+# stops uploading the shard (LeaseLostError), so it does not overwrite the progress of the worker that took over.
+# All machines must see the files under the same paths, and the shared file system must support SQLite locking.
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import checkpoint
+import graph_helper
+import json_stream
+import ndjson_reader
+
+DEFAULT_SHARDS = 16
+DEFAULT_LEASE_TIME = 1800
+DEFAULT_MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+# The lease of the shard has expired or another worker has leased it.
+class LeaseLostError(Exception):
+    pass
+
+
+# The id of the first Patient resource of a bundle, or the file name if the bundle has none. Patient is the first
+# entry in Synthea bundles, so the rest of the file is not read.
+def get_patient_id(json_path):
+    try:
+        for entry in json_stream.iter_bundle_entries(json_path):
+            resource = entry.get('resource', {})
+            if resource.get('resourceType') == 'Patient' and resource.get('id'):
+                return resource.get('id')
+    except (OSError, ValueError) as e:
+        print(f"Failed to read the patient id of {json_path}: {e}")
+    return os.path.splitext(os.path.basename(json_path))[0]
+
+
+# Shard of a key. sha1 and not hash(), which is different in every process.
+def get_shard(key, number_of_shards):
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:15], 16) % number_of_shards
+
+
+# Source description that is saved in the queue, and the source made from it.
+def source_to_spec(source):
+    if isinstance(source, ndjson_reader.NdjsonRange):
+        return json.dumps({'path': os.path.abspath(source.get_path()), 'start': source.get_start(),
+                           'end': source.get_end()})
+    return json.dumps({'path': os.path.abspath(source)})
+
+
+def spec_to_source(spec):
+    spec = json.loads(spec)
+    if 'start' in spec:
+        return ndjson_reader.NdjsonRange(spec['path'], spec['start'], spec['end'])
+    return spec['path']
+
+
+class WorkQueue:
+    # worker_id: name of this worker in the queue, None for the coordinator.
+    def __init__(self, queue_file_path, worker_id=None, lease_time=DEFAULT_LEASE_TIME,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.queue_file_path = queue_file_path
+        self.worker_id = worker_id
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        # The shard that this worker holds, and whether its lease was lost.
+        self.shard = None
+        self.lease_lost = False
+        # Leasing is done in an immediate transaction, so two workers never lease the same shard. Upload threads of
+        # the pipeline share the connection under a lock.
+        self.connection = sqlite3.connect(queue_file_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, status TEXT NOT NULL, "
+                                "worker TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+                                "updated REAL, error TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, spec TEXT NOT NULL, "
+                                "shard INTEGER NOT NULL, position INTEGER NOT NULL, status TEXT NOT NULL, "
+                                "committed_chunks INTEGER NOT NULL DEFAULT 0, total_chunks INTEGER, "
+                                "worker TEXT, updated REAL, error TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sources_shard ON sources (shard, position)")
+
+    def close(self):
+        self.connection.close()
+
+    def get_number_of_sources(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+
+    # Coordinator: put the sources into number_of_shards shards. Bundle files are sharded by patient id, NDJSON
+    # ranges by name. Replaces the content of the queue.
+    def create(self, source_list, number_of_shards=DEFAULT_SHARDS):
+        rows = []
+        for position, source in enumerate(source_list):
+            if isinstance(source, ndjson_reader.NdjsonRange):
+                shard_key = source.get_name()
+            else:
+                shard_key = get_patient_id(source)
+            rows.append((checkpoint.get_checkpoint_key(source), source_to_spec(source),
+                         get_shard(shard_key, number_of_shards), position, PENDING))
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("DELETE FROM shards")
+                self.connection.execute("DELETE FROM sources")
+                self.connection.executemany("INSERT INTO sources (source, spec, shard, position, status) "
+                                            "VALUES (?, ?, ?, ?, ?)", rows)
+                self.connection.executemany("INSERT INTO shards (shard, status, updated) VALUES (?, ?, ?)",
+                                            [(shard, PENDING, now) for shard in sorted({row[2] for row in rows})])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    # Worker: lease the next shard that is pending, whose lease has expired, or that failed fewer than max_attempts
+    # times. Returns the shard number, or None if there is no more work.
+    def lease_shard(self):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT shard FROM shards WHERE status = ? OR (status = ? AND lease_expires < ?) "
+                    "OR (status = ? AND attempts < ?) ORDER BY attempts, shard LIMIT 1",
+                    (PENDING, LEASED, now, FAILED, self.max_attempts)).fetchone()
+                if row is not None:
+                    self.connection.execute("UPDATE shards SET status = ?, worker = ?, lease_expires = ?, "
+                                            "attempts = attempts + 1, updated = ? WHERE shard = ?",
+                                            (LEASED, self.worker_id, now + self.lease_time, now, row[0]))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        self.shard = row[0] if row is not None else None
+        self.lease_lost = False
+        return self.shard
+
+    # The sources of a shard that are not uploaded yet, in the order of the coordinator's source list.
+    def get_shard_sources(self, shard):
+        with self.lock:
+            rows = self.connection.execute("SELECT spec FROM sources WHERE shard = ? AND status != ? "
+                                           "ORDER BY position", (shard, DONE)).fetchall()
+        return [spec_to_source(row[0]) for row in rows]
+
+    # Worker: the shard is done if all its sources are done, else failed. Returns the status.
+    def complete_shard(self, shard):
+        with self.lock:
+            remaining = self.connection.execute("SELECT COUNT(*) FROM sources WHERE shard = ? AND status != ?",
+                                                (shard, DONE)).fetchone()[0]
+            status = DONE if remaining == 0 else FAILED
+            error = None if remaining == 0 else f"{remaining} sources failed"
+            # A worker whose lease expired and was taken over does not change the shard any more.
+            self.connection.execute("UPDATE shards SET status = ?, lease_expires = NULL, updated = ?, error = ? "
+                                    "WHERE shard = ? AND worker = ?",
+                                    (status, time.time(), error, shard, self.worker_id))
+        self.shard = None
+        return status
+
+    # The checkpoint.CheckpointJournal methods, so the pipeline records its progress in the queue.
+    def is_done(self, source):
+        with self.lock:
+            row = self.connection.execute("SELECT status FROM sources WHERE source = ?",
+                                          (checkpoint.get_checkpoint_key(source),)).fetchone()
+        return row is not None and row[0] == DONE
+
+    # Raises LeaseLostError after the lease was lost, so the next bundles of the shard are not uploaded.
+    def get_committed_chunks(self, source):
+        with self.lock:
+            if self.lease_lost:
+                raise LeaseLostError(f"The lease of shard {self.shard} was lost")
+            row = self.connection.execute("SELECT committed_chunks FROM sources WHERE source = ?",
+                                          (checkpoint.get_checkpoint_key(source),)).fetchone()
+        return row[0] if row else 0
+
+    # Save the progress of a source and extend the lease of its shard, only if this worker holds a valid lease of the
+    # shard. Raises LeaseLostError otherwise.
+    def update_source(self, source, status, error=None, committed_chunks=None, total_chunks=None):
+        now = time.time()
+        lease_condition = "shard IN (SELECT shard FROM shards WHERE status = ? AND worker = ? AND lease_expires > ?)"
+        with self.lock:
+            if self.lease_lost:
+                raise LeaseLostError(f"The lease of shard {self.shard} was lost")
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if committed_chunks is None:
+                    cursor = self.connection.execute(
+                        "UPDATE sources SET status = ?, worker = ?, updated = ?, error = ? WHERE source = ? AND "
+                        + lease_condition, (status, self.worker_id, now, error, checkpoint.get_checkpoint_key(source),
+                                            LEASED, self.worker_id, now))
+                else:
+                    cursor = self.connection.execute(
+                        "UPDATE sources SET status = ?, committed_chunks = ?, total_chunks = ?, worker = ?, "
+                        "updated = ?, error = ? WHERE source = ? AND " + lease_condition,
+                        (status, committed_chunks, total_chunks, self.worker_id, now, error,
+                         checkpoint.get_checkpoint_key(source), LEASED, self.worker_id, now))
+                if cursor.rowcount > 0:
+                    self.connection.execute("UPDATE shards SET lease_expires = ?, updated = ? WHERE worker = ? AND "
+                                            "shard = (SELECT shard FROM sources WHERE source = ?)",
+                                            (now + self.lease_time, now, self.worker_id,
+                                             checkpoint.get_checkpoint_key(source)))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            if cursor.rowcount == 0:
+                self.lease_lost = True
+                raise LeaseLostError(f"The lease of shard {self.shard} was lost, {source} is not saved")
+
+    def save_chunk(self, source, committed_chunks, total_chunks):
+        self.update_source(source, checkpoint.IN_PROGRESS, committed_chunks=committed_chunks,
+                           total_chunks=total_chunks)
+
+    def save_done(self, source):
+        self.update_source(source, DONE)
+
+    # The shard of a lost lease belongs to another worker now, which decides about the source.
+    def save_failed(self, source, error):
+        try:
+            self.update_source(source, FAILED, error=str(error))
+        except LeaseLostError:
+            pass
+
+    # Coordinator: progress of the whole queue. Returns a dict with the number of shards and sources per status,
+    # and per worker the number of uploaded sources and the time of its last progress.
+    def get_progress(self):
+        with self.lock:
+            shards = dict(self.connection.execute("SELECT status, COUNT(*) FROM shards GROUP BY status").fetchall())
+            sources = dict(self.connection.execute("SELECT status, COUNT(*) FROM sources GROUP BY status").fetchall())
+            workers = {worker: {"done": done, "last_update": last_update} for worker, done, last_update in
+                       self.connection.execute("SELECT worker, COUNT(*), MAX(updated) FROM sources "
+                                               "WHERE status = ? AND worker IS NOT NULL GROUP BY worker",
+                                               (DONE,)).fetchall()}
+            exhausted = self.connection.execute("SELECT COUNT(*) FROM shards WHERE status = ? AND attempts >= ?",
+                                                (FAILED, self.max_attempts)).fetchone()[0]
+        return {"shards": shards, "sources": sources, "workers": workers, "exhausted_shards": exhausted}
+
+    # True if no shard can be leased or is being worked on any more.
+    def is_finished(self):
+        progress = self.get_progress()
+        open_shards = sum(progress["shards"].values()) - progress["shards"].get(DONE, 0)
+        return open_shards == progress["exhausted_shards"]
+
+
+def print_progress(progress):
+    shards = progress["shards"]
+    sources = progress["sources"]
+    total_sources = sum(sources.values())
+    print(f"Shards: {sum(shards.values())} total, {shards.get(DONE, 0)} done, {shards.get(LEASED, 0)} leased, "
+          f"{shards.get(PENDING, 0)} pending, {shards.get(FAILED, 0)} failed "
+          f"({progress['exhausted_shards']} without attempts left)")
+    print(f"Sources: {sources.get(DONE, 0)}/{total_sources} done, {sources.get(FAILED, 0)} failed")
+    for worker, worker_progress in sorted(progress["workers"].items()):
+        last_update = time.strftime("%H:%M:%S", time.localtime(worker_progress["last_update"]))
+        print(f"  {worker}: {worker_progress['done']} sources, last progress at {last_update}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Coordinator of a distributed ingest, see distributed.py. "
+                                                 "The workers run: python main.py --work-queue <file>")
+    parser.add_argument("command", choices=["create", "status"],
+                        help="create: split the input into shards in a new work queue. status: print the progress.")
+    parser.add_argument("--work-queue", required=True, help="SQLite file of the work queue on shared storage.")
+    parser.add_argument("--json-folder", default='FHIR Data/FHIR JSON', help="Folder of the input files.")
+    parser.add_argument("--input-format", choices=["bundle", "ndjson"], default="bundle",
+                        help="bundle: one Bundle json file per patient. ndjson: FHIR Bulk Data NDJSON files.")
+    parser.add_argument("--range-size", type=int, default=ndjson_reader.DEFAULT_RANGE_SIZE // (1024 * 1024),
+                        help="Size of the NDJSON byte ranges in MB.")
+    parser.add_argument("--limit", type=int, default=None, help="Only the first LIMIT bundle files.")
+    parser.add_argument("--shards", type=int, default=DEFAULT_SHARDS, help="Number of shards.")
+    parser.add_argument("--reset", action="store_true", help="Replace a work queue that is not empty.")
+    parser.add_argument("--watch", type=float, default=None, metavar="SECONDS",
+                        help="With status: print the progress every SECONDS until all shards are finished.")
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    work_queue = WorkQueue(args.work_queue)
+    if args.command == "create":
+        if work_queue.get_number_of_sources() > 0 and not args.reset:
+            print(f"{args.work_queue} is not empty, use --reset to replace it")
+            raise SystemExit(1)
+        if args.input_format == "ndjson":
+            source_list = ndjson_reader.split_all_ndjson_files(ndjson_reader.read_all_ndjson_files(args.json_folder),
+                                                               args.range_size * 1024 * 1024)
+        else:
+            source_list = graph_helper.read_all_json_files(args.json_folder)[:args.limit]
+        work_queue.create(source_list, args.shards)
+        print(f"{len(source_list)} sources have been put into {args.shards} shards in {args.work_queue}")
+        print_progress(work_queue.get_progress())
+    else:
+        while True:
+            print_progress(work_queue.get_progress())
+            if args.watch is None or work_queue.is_finished():
+                break
+            time.sleep(args.watch)
+            print("----------------------------------------------------")
+    work_queue.close()
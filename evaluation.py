@@ -6,7 +6,8 @@ import neo4j_driver
 import os
 import time
 import matplotlib.pyplot as plt
-from main import read_all_json_files, convert_one_json_to_cypher
+from graph_helper import read_all_json_files
+from main import convert_one_json_to_cypher
 
 
 def evaluate(time_info_dict):
@@ -1,28 +1,30 @@
 
 class Node:
+    # __slots__ instead of a __dict__ per node: a bundle has tens of thousands of Property nodes.
+    __slots__ = ('name', 'node_type', 'properties', 'fullUrl', 'isPropertyNode', 'isExternalNode', 'id', 'id_prefix')
+
     # name: condition1, condition2, patient, etc.
     # node_type: Condition, Patient, etc.
     # properties: information of one resource.
     # fullUrl: the id of one resource(node).
-    def __init__(self, name, node_type, properties={}, fullUrl='', isPropertyNode=False):
+    # isExternalNode: the node belongs to another graph (e.g. another NDJSON range). Edges can point to it,
+    #                 but it is not created by this graph.
+    def __init__(self, name, node_type, properties=None, fullUrl='', isPropertyNode=False, isExternalNode=False):
         self.name = name
         self.node_type = node_type
-        self.properties = properties
+        self.properties = properties if properties is not None else {}
         self.fullUrl = fullUrl
-        self.child_nodes = []
-        self.parent_nodes = []
         self.isPropertyNode = isPropertyNode
+        self.isExternalNode = isExternalNode
+        # id is a dense integer within the graph and id_prefix is the graph id. The string id
+        # (e.g. a509406a_5098_478c_b183_037d68a953d9_12) is only built by get_id, when the graph is exported.
+        # A node with a fixed string id (set_id) has no id_prefix.
         self.id = 0
+        self.id_prefix = None
 
     def __repr__(self):
         return f"{self.name}"
 
-    def add_child_node(self, child_node):
-        self.child_nodes.append(child_node)
-
-    def add_parent_node(self, parent_node):
-        self.parent_nodes.append(parent_node)
-
     def add_node_property(self, property_dict):
         self.properties.update(property_dict)
 
@@ -45,31 +47,50 @@ class Node:
     def get_isPropertyNode(self):
         return self.isPropertyNode
 
+    def get_isExternalNode(self):
+        return self.isExternalNode
+
     def get_fullUrl(self):
         return self.fullUrl
 
+    def set_isExternalNode(self, isExternalNode):
+        self.isExternalNode = isExternalNode
+
     def get_id(self):
-        return self.id
+        if self.id_prefix is None:
+            return self.id
+        return f"{self.id_prefix}_{self.id}"
 
     def set_id(self, id):
         self.id = id
+        self.id_prefix = None
+
+    # Give the node a dense integer id in a graph. get_id returns id_prefix + '_' + number.
+    def set_number(self, id_prefix, number):
+        self.id = number
+        self.id_prefix = id_prefix
 
 
+# An Edge is only a light view: the graph keeps its edges in parallel lists (see Graph.add_edge).
 class Edge:
-    def __init__(self, source_node, target_node, edge_type=''):
+    __slots__ = ('edge_type', 'reference_path', 'source_node', 'target_node')
+
+    # reference_path: for an edge between two resources, the JSON path of the reference in the source resource,
+    #                 e.g. 'subject' or 'evidence[0].detail[0]'.
+    def __init__(self, source_node, target_node, edge_type='', reference_path=''):
         self.edge_type = edge_type
+        self.reference_path = reference_path
         self.source_node = source_node
         self.target_node = target_node
-        self.source_node.add_child_node(target_node)
-        self.target_node.add_parent_node(source_node)
 
     def __repr__(self):
         return f"({self.source_node.get_id()}, {self.target_node.get_id()})"
 
-    def set_edge_type(self, rules):
-        key = tuple([self.source_node.node_type, self.target_node.node_type])
-        if key in rules:
-            self.edge_type = rules.get(key)
+    # rule: a rule.Rule. Rules with '*' apply when there is no rule for this pair of types.
+    def set_edge_type(self, rule):
+        edge_type = rule.get_edge_type(self.source_node.node_type, self.target_node.node_type)
+        if edge_type:
+            self.edge_type = edge_type
 
     def set_property_edge_type(self, type_name):
         self.edge_type = type_name
@@ -84,14 +105,29 @@ class Edge:
     def get_target_node(self):
         return self.target_node
 
+    def get_reference_path(self):
+        return self.reference_path
+
 
 class Graph:
     def __init__(self, graph_id=''):
         self.graph_id = graph_id
         self.nodes_properties_nested = {}
         self.nodes_url_as_key = {}
-        self.nodes_properties_unnested = {}
-        self.edges = set()
+        # The unnested nodes in the order of their number: node number i is nodes_properties_unnested[i - 1].
+        self.nodes_properties_unnested = []
+        # The edges are kept as parallel lists instead of one Edge object per edge, in the order they were added,
+        # so the output of one bundle is deterministic.
+        self.edge_sources = []
+        self.edge_targets = []
+        self.edge_types = []
+        self.edge_reference_paths = []
+        # If True, resource nodes are written with MERGE on their id instead of CREATE,
+        # so a node that was already created as the target of an edge from another graph is reused.
+        self.merge_resource_nodes = False
+        # Nodes that all graphs share, e.g. terminology Code nodes (see terminology). They are always MERGEd.
+        # key: node id, value: node
+        self.shared_nodes = {}
 
     def add_node_properties_nested(self, node):
         id = self.get_graph_id() + str(len(self.get_nodes_properties_nested()) + 1)
@@ -100,12 +136,40 @@ class Graph:
         self.nodes_url_as_key[node.get_fullUrl()] = node.get_id()
 
     def add_node_properties_unnested(self, node):
-        id = self.get_graph_id() + "_" + str(len(self.get_nodes_properties_unnested()) + 1)
-        node.set_id(id)
-        self.nodes_properties_unnested[id] = node
+        self.nodes_properties_unnested.append(node)
+        node.set_number(self.get_graph_id(), len(self.nodes_properties_unnested))
+
+    def add_shared_node(self, node):
+        self.shared_nodes[node.get_id()] = node
+
+    def find_shared_node(self, id):
+        return self.shared_nodes.get(id)
+
+    # Give an unnested node a new id, e.g. an id that other graphs already use to refer to it.
+    def set_node_properties_unnested_id(self, node, new_id):
+        node.set_id(new_id)
 
     def add_edge(self, edge):
-        self.edges.add(edge)
+        self.edge_sources.append(edge.get_source_node())
+        self.edge_targets.append(edge.get_target_node())
+        self.edge_types.append(edge.get_edge_type())
+        self.edge_reference_paths.append(edge.get_reference_path())
+
+    # Remove nodes from the unnested nodes, together with the edges that start at them.
+    # Edges to a removed node are kept and the node becomes external: this graph does not create it,
+    # because it already exists in the database (see incremental).
+    def remove_nodes(self, nodes):
+        removed = set(nodes)
+        if not removed:
+            return
+        self.nodes_properties_unnested = [node for node in self.nodes_properties_unnested if node not in removed]
+        kept = [i for i, source in enumerate(self.edge_sources) if source not in removed]
+        self.edge_sources = [self.edge_sources[i] for i in kept]
+        self.edge_targets = [self.edge_targets[i] for i in kept]
+        self.edge_types = [self.edge_types[i] for i in kept]
+        self.edge_reference_paths = [self.edge_reference_paths[i] for i in kept]
+        for node in removed:
+            node.set_isExternalNode(True)
 
     def set_graph_id(self, graph_id):
         # Get rid of "urn:uuid:"
@@ -114,6 +178,9 @@ class Graph:
         graph_id = graph_id.replace("-", "_")
         self.graph_id = graph_id
 
+    def set_merge_resource_nodes(self, merge_resource_nodes):
+        self.merge_resource_nodes = merge_resource_nodes
+
     # Find one node by its name and return
     def find_node_by_name(self, name):
         return self.nodes_properties_nested.get(name)
@@ -130,14 +197,28 @@ class Graph:
     def get_nodes_properties_nested(self):
         return self.nodes_properties_nested
 
+    # Return the list of unnested nodes.
     def get_nodes_properties_unnested(self):
         return self.nodes_properties_unnested
 
+    # Yield the edges one by one. The Edge objects are built on the fly from the parallel lists.
     def get_edges(self):
-        return self.edges
+        for i in range(len(self.edge_sources)):
+            yield Edge(self.edge_sources[i], self.edge_targets[i], self.edge_types[i], self.edge_reference_paths[i])
+
+    def get_number_of_edges(self):
+        return len(self.edge_sources)
 
     def get_edges_with_type(self):
-        return [(edge.get_source_node().get_name(), edge.get_target_node().get_name(), edge.get_edge_type()) for edge in self.edges]
+        return [(source.get_name(), target.get_name(), edge_type)
+                for source, target, edge_type in zip(self.edge_sources, self.edge_targets, self.edge_types)]
+
+    # Return the shared nodes this graph writes. External shared nodes are only the target of edges.
+    def get_shared_nodes(self, include_external=False):
+        return [node for node in self.shared_nodes.values() if include_external or not node.get_isExternalNode()]
 
     def get_nodes_url_as_key(self):
         return self.nodes_url_as_key
+
+    def get_merge_resource_nodes(self):
+        return self.merge_resource_nodes
@@ -1,51 +1,150 @@
+import hashlib
+import itertools
 import json
+import os
+import re
+import instrumentation
+import json_stream
 from graph import Graph, Node, Edge
-from rule import Rule
+import patient_summary
+import projection
+import property_mode
+import rule
+import terminology
 
 
 # Read one json file and save as object. Report error if the file is not found.
+@instrumentation.timed("read_json")
 def read_one_json(path):
     data = {}
     try:
         with open(path) as json_file:
             data = json.load(json_file)
+        instrumentation.add_count("bytes_read", os.path.getsize(path))
     except FileNotFoundError:
         print("File not found")
     return data
 
 
+# Return the sorted paths of the json files in a folder.
+def read_all_json_files(json_folder_path):
+    json_path_list = []
+    for json_file in os.listdir(json_folder_path):
+        if json_file.endswith(".json"):
+            json_path = json_folder_path + "/" + json_file
+            json_path_list.append(json_path)
+    json_path_list.sort()
+    return json_path_list
+
+
+# Node id of a resource, e.g. Patient_123. Other characters than letters, digits and '_' are replaced by '_', and then
+# the first 8 hex digits of the hash of the original id are appended, so 'a-b' and 'a_b' get different ids,
+# e.g. Patient_a_b_eeb47caa.
+def make_node_id(resource_type, resource_id):
+    node_id = f"{resource_type}_{resource_id}"
+    sanitized_id = re.sub(r'[^0-9A-Za-z_]', '_', node_id)
+    if sanitized_id == node_id:
+        return node_id
+    return f"{sanitized_id}_{hashlib.sha256(node_id.encode('utf-8')).hexdigest()[:8]}"
+
+
+# Identity of a resource node across bundles: 'ResourceType/id', or 'ResourceType/fullUrl' if the resource has no id.
+# None if the resource has neither.
+def get_resource_key(node):
+    identity = node.get_properties().get('id') or node.get_fullUrl()
+    if identity:
+        return f"{node.get_node_type()}/{identity}"
+    return None
+
+
+# Reduce a reference to 'ResourceType/id', or return None if it has no such form.
+# Absolute references like 'http://server/fhir/Patient/123' or 'Patient/123/_history/2' become 'Patient/123'.
+def reduce_reference(reference):
+    parts = reference.split('/')
+    if '_history' in parts:
+        parts = parts[:parts.index('_history')]
+    if len(parts) >= 2 and parts[-2] and parts[-1]:
+        return f"{parts[-2]}/{parts[-1]}"
+    return None
+
+
+# Find all the references in each resource(node), together with the JSON path of the object that holds them.
+# e.g. [('subject', 'urn:uuid:...'), ('evidence[0].detail[0]', 'urn:uuid:...')]
+# The resource is walked once with an explicit stack instead of recursion, so deeply nested resources cannot hit
+# Python's recursion limit. The references are returned in document order.
+def find_references_with_paths(data):
+    references = []
+    # Items on the stack are (value, path, is_reference).
+    stack = [(data, '', False)]
+    while stack:
+        value, path, is_reference = stack.pop()
+        if is_reference:
+            references.append((path, value))
+        elif isinstance(value, dict):
+            # Pushed in reverse order, so they are popped in document order.
+            for key, child in reversed(list(value.items())):
+                if key == "reference":
+                    stack.append((child, path, True))
+                else:
+                    stack.append((child, f"{path}.{key}" if path else key, False))
+        elif isinstance(value, list):
+            for i in range(len(value) - 1, -1, -1):
+                stack.append((value[i], f"{path}[{i}]", False))
+    return references
+
+
 # Find all the references in each resource(node).
 # It can find the relationship between two nodes, which would help to find the child nodes.
 def find_references(data):
-    references = []
-    if isinstance(data, dict):
-        for key, value in data.items():
-            if key == "reference":
-                references.append(value)
-            else:
-                references.extend(find_references(value))
-    elif isinstance(data, list):
-        for item in data:
-            references.extend(find_references(item))
-    return references
+    return [reference for path, reference in find_references_with_paths(data)]
 
 
-# Convert the json file to a graph.
-def convert_json_to_graph(json_path):
-    data = read_one_json(json_path)
-    resource_list = data.get("entry", [])
-    # Each item in resource_list is a dictionary.
-    # Retrival the resource_list to get the resourceType.
-    # And save the information in a dict, key is resourceType, value is a list of resource.
+# Add an edge for every reference of every resource node in the graph.
+# resolve(reference) returns the node the reference points to, or None.
+# The JSON path of the reference is kept on the edge (e.g. 'subject', 'evidence[0].detail[0]').
+def add_reference_edges(graph, rules, resolve):
+    for node in graph.get_nodes_properties_nested().values():
+        for path, reference in find_references_with_paths(node.get_properties()):
+            # Find the child node in the graph.
+            child_node = resolve(reference)
+            if child_node:
+                # Add an edge between this node and its child node.
+                edge = Edge(node, child_node, reference_path=path)
+                # Set the edge type based on the rules.
+                edge.set_edge_type(rules)
+                graph.add_edge(edge)
+
+
+# Each item in resource_list is a dictionary.
+# Retrival the resource_list to get the resourceType.
+# And save the information in a dict, key is resourceType, value is a list of resource.
+# resource_list can be a list or an iterator (see json_stream.iter_bundle_entries).
+# The resources are projected here (see projection): resources of dropped types are skipped and dropped paths are
+# removed, before anything else sees them.
+def group_resources_by_type(resource_list):
     resource_dict = {}
+    resource_projection = projection.get_projection()
+    project = not resource_projection.is_empty()
     for resource in resource_list:
         # The structure of 'resource' is like: {'resource': {'resourceType': 'Condition', 'clinicalStatus': {'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/condition-clinical', 'code': 'active'}]}, 'verificationStatus': {'coding': [{'system': 'http://terminology.hl7.org/CodeSystem/condition-ver-status', 'code': 'confirmed'}]}, 'code': {'coding': [{'system': 'http://snomed.info/sct', 'code': '195967001', 'display': 'Traumatic brain injury (disorder)'}]}, 'subject': {'reference': 'Patient/patient1'}, 'onsetDateTime': '2019-04-04T00:00:00+00:00', 'recordedDate': '2019-04-04T00:00:00+00:00', 'recorder': {'reference': 'Practitioner/Practitioner1'}, 'evidence': [{'detail': [{'reference': 'Observation/observation1'}]}]}}
         resource_type = resource.get('resource').get('resourceType', '')
+        if resource_type and project:
+            if not resource_projection.is_type_included(resource_type):
+                instrumentation.add_count("resources_dropped")
+                continue
+            resource['resource'] = resource_projection.project_resource(resource.get('resource'))
         if resource_type:
             if resource_type not in resource_dict:
                 resource_dict.update({resource_type: []})
             resource_dict[resource_type].append(resource)
+    return resource_dict
 
+
+# Convert the resources grouped by resourceType to a graph.
+# graph_fullUrl is the fullUrl of the first resource in the json file. It would be used as the id of the graph.
+# rule_file_path: the rules file, None uses the default rules file (see rule.get_rule).
+# resolve_external(reference): returns the node of a resource outside the bundle, or None.
+def convert_resource_dict_to_graph(resource_dict, graph_fullUrl, rule_file_path=None, resolve_external=None):
     # Convert each item from resource_dict to node, and save in node_dict.
     node_dict = {}
     for resource_type in resource_dict.keys():
@@ -73,39 +172,76 @@ def convert_json_to_graph(json_path):
 
     # Create a graph
     graph = Graph()
-    # Get the fullUrl of first resource in this json file. It would be used as the id of the graph.
     # Each node id would be fullUrl + number, e.g. urn:uuid:2e27c71e-30c8-4ceb-8c1c-5641e066c0a4_1
-    graph.set_graph_id(data.get("entry")[0].get("fullUrl"))
+    graph.set_graph_id(graph_fullUrl)
     for resource_type in node_dict.keys():
         for node in node_dict[resource_type]:
             graph.add_node_properties_nested(node)
 
-    # Read the rules from file.
-    rule = Rule("rules.txt")
-    rules = rule.get_rules()
+    # The rules are read from file once per process and cached.
+    rules = rule.get_rule(rule_file_path)
 
     # Add edges to the graph.
-    for node in graph.get_nodes_properties_nested().values():
-        # Find all child nodes of this node.
-        references = find_references(node.get_properties())
-        for reference in references:
-            # Find the child node in the graph.
-            child_node = graph.find_node_by_fullUrl(reference)
-            if child_node:
-                # Add an edge between this node and its child node.
-                edge = Edge(node, child_node)
-                # Set the edge type based on the rules.
-                edge.set_edge_type(rules)
-                graph.add_edge(edge)
+    # A reference that is not in the bundle is passed to resolve_external (e.g. resource_registry), if it is given.
+    if resolve_external is None:
+        resolve = graph.find_node_by_fullUrl
+    else:
+        def resolve(reference):
+            return graph.find_node_by_fullUrl(reference) or resolve_external(reference)
+    add_reference_edges(graph, rules, resolve)
+
+    # Chain the events of every patient (see patient_summary).
+    if patient_summary.get_timeline():
+        patient_summary.add_timeline_edges(graph, patient_summary.get_summary_properties())
 
     return graph
 
 
+# Convert the json file to a graph.
+@instrumentation.timed("convert_json_to_graph")
+def convert_json_to_graph(json_path, rule_file_path=None, resolve_external=None):
+    data = read_one_json(json_path)
+    resource_dict = group_resources_by_type(data.get("entry", []))
+    # Get the fullUrl of first resource in this json file. It would be used as the id of the graph.
+    return convert_resource_dict_to_graph(resource_dict, data.get("entry")[0].get("fullUrl"), rule_file_path,
+                                          resolve_external)
+
+
+# Convert the json file to a graph, reading the entries one by one with json_stream.
+# The whole json text and document are never held in memory, only the resources kept by the graph.
+# The graph is the same as the one from convert_json_to_graph.
+@instrumentation.timed("convert_json_stream_to_graph")
+def convert_json_stream_to_graph(json_path, rule_file_path=None, resolve_external=None):
+    entries = json_stream.iter_bundle_entries(json_path)
+    try:
+        first_entry = next(entries, None)
+    except FileNotFoundError:
+        print("File not found")
+        first_entry = None
+    if first_entry is None:
+        return convert_resource_dict_to_graph({}, '', rule_file_path, resolve_external)
+    instrumentation.add_count("bytes_read", os.path.getsize(json_path))
+    resource_dict = group_resources_by_type(itertools.chain([first_entry], entries))
+    return convert_resource_dict_to_graph(resource_dict, first_entry.get("fullUrl"), rule_file_path,
+                                          resolve_external)
+
+
+# With shared codes (see terminology), a Coding is not unnested, but linked from the resource node to its Code node.
 def unnest_one_node_properties_to_simple_nodes(nested_properties_dict, parent_node, graph):
+    resource_node = parent_node
+    shared_codes = terminology.get_shared_codes()
+
     def process_dict(nested_properties_dict, parent_node=None, parent_node_value_isList=False):
         current_node = parent_node
         for key, value in nested_properties_dict.items():
-            if isinstance(value, dict):
+            if shared_codes and terminology.is_coding(value):
+                terminology.add_code_edge(graph, resource_node, value)
+            elif shared_codes and isinstance(value, list) and value and all(
+                    terminology.is_coding(item) for item in value):
+                # A list of only Codings, e.g. 'coding', does not need a Property node of its own.
+                for item in value:
+                    terminology.add_code_edge(graph, resource_node, item)
+            elif isinstance(value, dict):
                 child_node_name = f"{parent_node.get_name()}_{key}" if parent_node else key
                 child_node = Node(name=child_node_name, node_type="Property", properties={}, isPropertyNode=True)
                 graph.add_node_properties_unnested(child_node)
@@ -125,7 +261,9 @@ def unnest_one_node_properties_to_simple_nodes(nested_properties_dict, parent_no
                 # Add number to the name of the child node, if there are more child nodes have the same name in the same list.
                 # e.g. children1, children2, etc.
                 for item in value:
-                    if (not isinstance(item, dict)) and (not isinstance(item, list)):
+                    if shared_codes and terminology.is_coding(item):
+                        terminology.add_code_edge(graph, resource_node, item)
+                    elif (not isinstance(item, dict)) and (not isinstance(item, list)):
                         # In case of 'family': ['Bode', 'Jackie', '69'],
                         # The properties names of node 'family' would be value1:Bode, value2:Jackie, value3:69.
                         cnt_property = len(child_node.get_properties())
@@ -150,9 +288,47 @@ def unnest_one_node_properties_to_simple_nodes(nested_properties_dict, parent_no
     process_dict(nested_properties_dict, parent_node)
 
 
-def build_property_nodes_for_each_node(graph):
+# Store the nested properties of a resource on the resource node itself, with their path as the property name.
+# e.g. {'code': {'coding': [{'system': 'http://loinc.org', 'code': '8302-2'}]}} becomes
+# {'code.coding.0.system': 'http://loinc.org', 'code.coding.0.code': '8302-2'}.
+# A value at a promoted path (the path without list indexes, e.g. 'code.coding') becomes Property nodes instead,
+# with the path joined by '_' as the relationship type, e.g. (observation)-[:code_coding]->(Property).
+# With shared codes (see terminology), a Coding is linked to its Code node instead.
+def flatten_one_node_properties(nested_properties_dict, parent_node, graph, promoted_paths=frozenset()):
+    shared_codes = terminology.get_shared_codes()
+    flat_properties_dict = {}
+    promoted_properties = []
+    # Items on the stack are (value, path, path without list indexes). Walked in document order, like
+    # find_references_with_paths.
+    stack = [(value, key, key) for key, value in reversed(list(nested_properties_dict.items()))]
+    while stack:
+        value, path, promoted_path = stack.pop()
+        if shared_codes and terminology.is_coding(value):
+            terminology.add_code_edge(graph, parent_node, value)
+        elif isinstance(value, dict) or isinstance(value, list):
+            if promoted_path in promoted_paths:
+                promoted_properties.append((promoted_path.replace('.', '_'), value))
+            elif isinstance(value, dict):
+                for key, child in reversed(list(value.items())):
+                    stack.append((child, f"{path}.{key}", f"{promoted_path}.{key}"))
+            else:
+                for i in range(len(value) - 1, -1, -1):
+                    stack.append((value[i], f"{path}.{i}", promoted_path))
+        else:
+            flat_properties_dict[path] = value
+    parent_node.add_node_property(flat_properties_dict)
+    for key, value in promoted_properties:
+        unnest_one_node_properties_to_simple_nodes({key: value}, parent_node, graph)
+
+
+# property_modes: a property_mode.PropertyModes, None uses the default property mode file.
+# The summary properties of each resource (see patient_summary) are added to its simple properties.
+@instrumentation.timed("build_property_nodes")
+def build_property_nodes_for_each_node(graph, property_modes=None):
+    if property_modes is None:
+        property_modes = property_mode.get_property_modes()
+    summary_properties = patient_summary.get_summary_properties()
     nodes_properties_nested = graph.get_nodes_properties_nested()
-    edges = graph.get_edges()
 
     for node_key, node in nodes_properties_nested.items():
         nested_properties_dict = {}
@@ -162,8 +338,52 @@ def build_property_nodes_for_each_node(graph):
                 nested_properties_dict.update({key: value})
             else:
                 simple_properties_dict.update({key: value})
+        simple_properties_dict.update(summary_properties.compute(node.get_node_type(), node.get_properties()))
         node.clear_node_all_properties()
         node.add_node_property(simple_properties_dict)
         graph.add_node_properties_unnested(node)
 
-        unnest_one_node_properties_to_simple_nodes(nested_properties_dict, node, graph)
+        mode, promoted_paths = property_modes.get_mode(node.get_node_type())
+        if mode == property_mode.FLAT:
+            flatten_one_node_properties(nested_properties_dict, node, graph, promoted_paths)
+        else:
+            unnest_one_node_properties_to_simple_nodes(nested_properties_dict, node, graph)
+    instrumentation.add_count("nodes", len(graph.get_nodes_properties_unnested()))
+    instrumentation.add_count("edges", graph.get_number_of_edges())
+
+
+# Give every resource node a stable id instead of the graph id and its position in the bundle, e.g. Patient_123,
+# and every property node the id of its resource plus a number, e.g. Patient_123_4.
+# resource_node_ids: key is a resource node, value is its new id (see make_node_id).
+# owner_property: if set, the id of the resource is also stored in this property of its property nodes,
+#                 so the property nodes of one resource can be found in the database.
+# Must be called after build_property_nodes_for_each_node, which adds each resource node right before its property nodes.
+def set_resource_identity_ids(graph, resource_node_ids, owner_property=None):
+    owner_id = None
+    numbers = {}
+    for node in graph.get_nodes_properties_unnested():
+        if not node.get_isPropertyNode():
+            owner_id = resource_node_ids[node]
+            graph.set_node_properties_unnested_id(node, owner_id)
+            continue
+        # Two resource nodes can have the same id, so the numbers are counted per resource id.
+        number = numbers.get(owner_id, 0) + 1
+        numbers[owner_id] = number
+        node.set_number(owner_id, number)
+        if owner_property:
+            node.add_node_property({owner_property: owner_id})
+
+
+# Remove resource nodes from the graph, together with their property nodes and the edges that start at them
+# (see Graph.remove_nodes). Must be called after build_property_nodes_for_each_node, which adds each resource node
+# right before its property nodes.
+def remove_resource_nodes(graph, resource_nodes):
+    resource_nodes = set(resource_nodes)
+    removed_nodes = []
+    removed = False
+    for node in graph.get_nodes_properties_unnested():
+        if not node.get_isPropertyNode():
+            removed = node in resource_nodes
+        if removed:
+            removed_nodes.append(node)
+    graph.remove_nodes(removed_nodes)
@@ -0,0 +1,181 @@
+# Incremental ingest: upload only what has changed since the last run.
+#
+# Resource nodes get a stable id from resourceType + id (e.g. Patient_123), or from the fullUrl if the resource has
+# no id, and they are MERGEd on that id, so uploading the same folder again does not create a second copy.
+# A resource with neither id nor fullUrl can only be recognized by its content: its id is made from its hash, and a
+# changed version of it becomes a new node.
+# Property nodes get the id of their resource plus a number (e.g. Patient_123_4), and the id of their resource in
+# the property OWNER_PROPERTY, so the Property subtree of one resource can be found and replaced.
+#
+# A local state file (sqlite) keeps the content hash of every uploaded bundle and resource:
+#   - a bundle with the same hash as in the last run is skipped before it is converted;
+#   - a resource with the same hash is not uploaded again. The hash covers the whole resource, so a new
+#     meta.lastUpdated is a change as well;
+#   - both hashes include the digest of the configuration (rules, property modes, property types, shared codes, see
+#     conversion_cache.compute_config_digest), so after a change of the configuration everything is uploaded again;
+#   - a changed resource is MERGEd with its new properties, and its old Property subtree and outgoing edges are
+#     deleted before the new ones are created.
+# The hashes of a bundle are saved only after its upload has succeeded.
+import hashlib
+import json
+import os
+import sqlite3
+
+import conversion_cache
+import cypher_generator
+import graph_helper
+
+DEFAULT_STATE_FILE_PATH = "ingest_state.sqlite"
+
+# Property of the Property nodes that holds the id of their resource node.
+OWNER_PROPERTY = "resource_node_id"
+
+# SQLite limits the number of parameters of one statement.
+MAX_SQL_PARAMETERS = 500
+
+
+def compute_file_hash(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Hash of one resource. The keys are sorted, so the hash does not depend on the order of the keys in the file.
+def compute_resource_hash(resource):
+    text = json.dumps(resource, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class IngestState:
+    def __init__(self, state_file_path=DEFAULT_STATE_FILE_PATH):
+        self.state_file_path = state_file_path
+        self.connection = sqlite3.connect(state_file_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS bundles (path TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS resources (resource_key TEXT PRIMARY KEY, "
+                                "hash TEXT NOT NULL, last_updated TEXT)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    # Return the hash of the bundle from the last run, or None.
+    def get_bundle_hash(self, path):
+        row = self.connection.execute("SELECT hash FROM bundles WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return row[0] if row else None
+
+    # Return a dict, key is the resource key, value is the hash from the last run. Unknown keys are left out.
+    def get_resource_hashes(self, resource_keys):
+        resource_keys = list(resource_keys)
+        resource_hashes = {}
+        for i in range(0, len(resource_keys), MAX_SQL_PARAMETERS):
+            chunk = resource_keys[i:i + MAX_SQL_PARAMETERS]
+            query = "SELECT resource_key, hash FROM resources WHERE resource_key IN ({})".format(
+                ", ".join("?" * len(chunk)))
+            resource_hashes.update(self.connection.execute(query, chunk).fetchall())
+        return resource_hashes
+
+    # Save the hashes of an uploaded bundle and of its changed resources in one transaction.
+    def save_update(self, update):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO resources (resource_key, hash, last_updated) VALUES (?, ?, ?)",
+                [(key, resource_hash, last_updated)
+                 for key, (resource_hash, last_updated) in update.get_resource_hashes().items()])
+            self.connection.execute("INSERT OR REPLACE INTO bundles (path, hash) VALUES (?, ?)",
+                                    (os.path.abspath(update.get_source()), update.get_bundle_hash()))
+
+
+# The changed part of one bundle.
+# graph: the graph without the unchanged resources and their property nodes.
+# replaced_nodes: resource nodes that were uploaded before and have changed since.
+# resource_hashes: key is the resource key, value is (hash, meta.lastUpdated) of every changed resource.
+class IncrementalUpdate:
+    def __init__(self, source, bundle_hash, graph, replaced_nodes, resource_hashes):
+        self.source = source
+        self.bundle_hash = bundle_hash
+        self.graph = graph
+        self.replaced_nodes = replaced_nodes
+        self.resource_hashes = resource_hashes
+
+    def get_source(self):
+        return self.source
+
+    def get_bundle_hash(self):
+        return self.bundle_hash
+
+    def get_graph(self):
+        return self.graph
+
+    def get_replaced_nodes(self):
+        return self.replaced_nodes
+
+    def get_resource_hashes(self):
+        return self.resource_hashes
+
+    # Cypher statements that delete the old Property subtrees and edges. They run before the statements of the graph.
+    def get_delete_cypher_statements(self):
+        cypher_statements = []
+        for node in self.replaced_nodes:
+            cypher_statements.extend(cypher_generator.convert_one_resource_to_delete_cypher(node, OWNER_PROPERTY))
+        return cypher_statements
+
+    def get_delete_batches(self, batch_size=cypher_generator.DEFAULT_BATCH_SIZE):
+        return cypher_generator.convert_resources_to_delete_batches(self.replaced_nodes, OWNER_PROPERTY, batch_size)
+
+
+# Convert one Bundle json file for an incremental upload.
+# Returns None if the file has not changed since the last run, otherwise an IncrementalUpdate.
+def convert_json_to_incremental_update(json_path, state, streaming=False):
+    # Another configuration changes the resources, so the bundle is converted again.
+    config_digest = conversion_cache.get_config_digest()
+    bundle_hash = compute_file_hash(json_path) + ":" + config_digest
+    if state.get_bundle_hash(json_path) == bundle_hash:
+        return None
+
+    if streaming:
+        graph = graph_helper.convert_json_stream_to_graph(json_path)
+    else:
+        graph = graph_helper.convert_json_to_graph(json_path)
+    graph.set_merge_resource_nodes(True)
+
+    # The resources are hashed before build_property_nodes_for_each_node, which replaces their properties.
+    resource_keys = {}
+    resource_node_ids = {}
+    resource_hashes = {}
+    for node in graph.get_nodes_properties_nested().values():
+        resource_hash = compute_resource_hash(node.get_properties())
+        key = graph_helper.get_resource_key(node)
+        if key is None:
+            key = f"{node.get_node_type()}/{resource_hash}"
+        meta = node.get_properties().get('meta')
+        last_updated = meta.get('lastUpdated') if isinstance(meta, dict) else None
+        resource_keys[node] = key
+        resource_node_ids[node] = graph_helper.make_node_id(node.get_node_type(), key.split('/', 1)[1])
+        # The id above only depends on the content, the saved hash on the configuration as well.
+        saved_hash = hashlib.sha256(f"{config_digest}:{resource_hash}".encode('utf-8')).hexdigest()
+        resource_hashes.setdefault(key, (saved_hash, last_updated))
+    old_hashes = state.get_resource_hashes(resource_hashes.keys())
+
+    graph_helper.build_property_nodes_for_each_node(graph)
+    graph_helper.set_resource_identity_ids(graph, resource_node_ids, OWNER_PROPERTY)
+
+    # Resources that have not changed, and the second copy of a resource that is in the bundle twice, are not
+    # uploaded. Edges to them are kept.
+    removed_resources = set()
+    seen_keys = set()
+    replaced_nodes = []
+    for node, key in resource_keys.items():
+        if key in seen_keys:
+            removed_resources.add(node)
+            continue
+        seen_keys.add(key)
+        old_hash = old_hashes.get(key)
+        if old_hash == resource_hashes[key][0]:
+            removed_resources.add(node)
+            resource_hashes.pop(key)
+        elif old_hash is not None:
+            replaced_nodes.append(node)
+    graph_helper.remove_resource_nodes(graph, removed_resources)
+    return IncrementalUpdate(json_path, bundle_hash, graph, replaced_nodes, resource_hashes)
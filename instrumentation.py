@@ -0,0 +1,249 @@
+# Instrumentation of ingest runs: where the time goes (parsing, graph, unnesting, Cypher generation, upload), and how
+# many bytes, nodes, edges and statements per second are processed.
+#
+# - Timers: functions decorated with @timed(name) add their duration to the timer name.
+# - Counters (add_count) and gauges (set_gauge, e.g. queue depths).
+# - Structured log events: one JSON object per line in the file of open_event_log (--metrics-log).
+# - A Prometheus text endpoint on http://<host>:<port>/metrics (start_metrics_server, --metrics-port).
+# - An end-of-run summary (Metrics.format_summary).
+# - profile_call runs one function under cProfile and optionally tracemalloc (--profile-bundle).
+#
+# Every process has its own metrics. A worker process of the pipeline resets them for every bundle and sends them
+# back with the ConvertedBundle, and the main process merges them (see pipeline.convert_bundle).
+import cProfile
+import functools
+import inspect
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRIC_PREFIX = "fhir2neo"
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            # name -> [calls, total seconds, max seconds]
+            self.timers = {}
+            self.counters = {}
+            # name -> [last value, max value]
+            self.gauges = {}
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    def add_count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            gauge = self.gauges.get(name)
+            if gauge is None:
+                self.gauges[name] = [value, value]
+            else:
+                gauge[0] = value
+                gauge[1] = max(gauge[1], value)
+
+    def get_counter(self, name):
+        return self.counters.get(name, 0)
+
+    def get_elapsed(self):
+        return time.time() - self.start_time
+
+    # Picklable copy of the timers and counters, e.g. to send them from a worker process.
+    def snapshot(self):
+        with self.lock:
+            return {"timers": {name: list(timer) for name, timer in self.timers.items()},
+                    "counters": dict(self.counters)}
+
+    # Add a snapshot of another process.
+    def merge(self, snapshot):
+        with self.lock:
+            for name, (calls, total, maximum) in snapshot["timers"].items():
+                timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+                timer[0] += calls
+                timer[1] += total
+                timer[2] = max(timer[2], maximum)
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    # The metrics in the Prometheus text exposition format.
+    def format_prometheus(self):
+        with self.lock:
+            lines = [f"# TYPE {METRIC_PREFIX}_uptime_seconds gauge",
+                     f"{METRIC_PREFIX}_uptime_seconds {time.time() - self.start_time:.3f}",
+                     f"# TYPE {METRIC_PREFIX}_stage_seconds_total counter",
+                     f"# TYPE {METRIC_PREFIX}_stage_calls_total counter"]
+            for name, (calls, total, maximum) in sorted(self.timers.items()):
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_total{{stage="{name}"}} {total:.6f}')
+                lines.append(f'{METRIC_PREFIX}_stage_calls_total{{stage="{name}"}} {calls}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+                lines.append(f"{METRIC_PREFIX}_{name}_total {value}")
+            for name, (value, maximum) in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+                lines.append(f"{METRIC_PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    # Table of the timers, the counters with their rate per second of the run, and the maximum of the gauges.
+    def format_summary(self):
+        elapsed = max(self.get_elapsed(), 1e-9)
+        with self.lock:
+            lines = [f"Ingest summary after {elapsed:.1f} s",
+                     f"{'stage':<28}{'calls':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}"]
+            for name, (calls, total, maximum) in sorted(self.timers.items(), key=lambda item: -item[1][1]):
+                lines.append(f"{name:<28}{calls:>8}{total:>10.2f}{total / calls * 1000:>10.2f}{maximum * 1000:>10.2f}")
+            for name, value in sorted(self.counters.items()):
+                if name == "bytes_read":
+                    megabytes = value / (1024 * 1024)
+                    lines.append(f"{name:<28}{megabytes:>10.1f} MB{megabytes / elapsed:>10.2f} MB/s")
+                else:
+                    lines.append(f"{name:<28}{value:>13}{value / elapsed:>10.0f} /s")
+            for name, (value, maximum) in sorted(self.gauges.items()):
+                lines.append(f"{name:<28}{maximum:>13} max")
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+# True in the worker processes of the pipeline, see pipeline.init_worker.
+worker_process = False
+event_log = None
+event_log_lock = threading.Lock()
+
+
+def get_metrics():
+    return metrics
+
+
+def set_worker_process(is_worker_process):
+    global worker_process
+    worker_process = is_worker_process
+
+
+def is_worker_process():
+    return worker_process
+
+
+def add_count(name, value=1):
+    metrics.add_count(name, value)
+
+
+def set_gauge(name, value):
+    metrics.set_gauge(name, value)
+
+
+# Decorator: add the duration of every call of the function (or coroutine) to the timer name.
+def timed(name):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    metrics.add_time(name, time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# Write the log events to a file, one JSON object per line.
+def open_event_log(file_path):
+    global event_log
+    event_log = open(file_path, "a", encoding="utf-8")
+
+
+def close_event_log():
+    global event_log
+    if event_log is not None:
+        event_log.close()
+        event_log = None
+
+
+# Write a structured log event, e.g. log_event("bundle_uploaded", source=..., seconds=...). Does nothing without
+# an event log.
+def log_event(event, **fields):
+    if event_log is None:
+        return
+    record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "event": event}
+    record.update(fields)
+    with event_log_lock:
+        event_log.write(json.dumps(record, default=str) + "\n")
+        event_log.flush()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.format_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # No access log lines between the progress lines of main.py.
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the metrics in the Prometheus text format on http://host:port/metrics in a background thread.
+def start_metrics_server(port, host=""):
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Call function(*args) under cProfile, print the 25 functions with the largest cumulative time, and return its result.
+# trace_memory: also print the peak memory and the 10 lines that allocated the most memory (tracemalloc).
+# output_path: also save the profile for pstats or snakeviz.
+def profile_call(function, *args, output_path=None, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(function, *args)
+    finally:
+        if trace_memory:
+            memory_snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(25)
+    print(stream.getvalue())
+    if output_path:
+        profiler.dump_stats(output_path)
+        print(f"Profile has been saved at {output_path}")
+    if trace_memory:
+        print(f"Memory: {current / (1024 * 1024):.1f} MB at the end, {peak / (1024 * 1024):.1f} MB peak")
+        for statistic in memory_snapshot.statistics("lineno")[:10]:
+            print(statistic)
+    return result
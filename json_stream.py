@@ -0,0 +1,96 @@
+# Streaming reader for FHIR Bundle json files.
+# json.load reads the whole file into one string and builds the whole document at once. This reader reads the file
+# in chunks and decodes the items of the top-level "entry" array one by one, so only the current entry and a small
+# text buffer are held in memory at any time.
+import json
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+WHITESPACE = ' \t\n\r'
+
+
+class JsonChunkReader:
+    def __init__(self, file, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    # Read more text from the file. Reads at least as much as is already buffered, so a large value
+    # is decoded after a logarithmic number of attempts.
+    def read_more(self):
+        if self.eof:
+            return False
+        # Drop the text that has already been decoded.
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        chunk = self.file.read(max(self.chunk_size, len(self.buffer)))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer += chunk
+        return True
+
+    # Return the next character that is not whitespace, without consuming it. Returns '' at the end of the file.
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' at offset {self.pos}, found '{found}'")
+        self.pos += 1
+
+    # Decode the next json value (object, array, string, number, ...).
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer could continue in the next chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+
+# Yield the items of the top-level "entry" array of a Bundle json file one by one.
+# Other top-level values (resourceType, type, ...) are decoded and skipped.
+def iter_bundle_entries(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    with open(path, 'r', encoding='utf-8') as json_file:
+        reader = JsonChunkReader(json_file, chunk_size)
+        reader.expect('{')
+        while True:
+            char = reader.peek()
+            if char == '}' or char == '':
+                return
+            if char == ',':
+                reader.pos += 1
+                continue
+            key = reader.decode_value()
+            reader.expect(':')
+            if key != "entry":
+                reader.decode_value()
+                continue
+            reader.expect('[')
+            while True:
+                char = reader.peek()
+                if char == ']':
+                    reader.pos += 1
+                    break
+                if char == ',':
+                    reader.pos += 1
+                    continue
+                if char == '':
+                    raise ValueError("Unexpected end of file in 'entry'")
+                yield reader.decode_value()
@@ -1,63 +1,552 @@
 # Description: Main file for the project
-import graph_helper
+import argparse
+import asyncio
+import batch_artifact
+import checkpoint
+import conversion_cache
+import csv_exporter
 import cypher_generator
+import distributed
+import graph_helper
+import incremental
+import instrumentation
+import ndjson_reader
 import neo4j_driver
+import neo4j_schema
 import os
+import pipeline
+import property_serializer
+import purge
+import recording_driver
+import resource_registry
+import socket
+import terminology
+import time
+import upload_controller
+
+
+# Convert one json file to a graph with property nodes.
+# streaming: read the bundle entry by entry instead of loading the whole json document.
+def convert_one_json_to_graph(json_file_path, streaming=False):
+    return pipeline.convert_source_to_graph(json_file_path, streaming)
 
 
 # Return a list with cypher statements strings
-def convert_one_json_to_cypher(json_file_path):
-    graph = graph_helper.convert_json_to_graph(json_file_path)
-    graph_helper.build_property_nodes_for_each_node(graph)
+def convert_graph_to_cypher(graph):
     cypher_nodes_statements = cypher_generator.convert_all_nodes_to_cypher(graph)
     cypher_edges_statements = cypher_generator.convert_all_edges_to_cypher(graph)
     all_cypher_statements = cypher_nodes_statements + cypher_edges_statements
     return all_cypher_statements
 
 
-def read_all_json_files(json_folder_path):
-    json_path_list = []
-    for json_file in os.listdir(json_folder_path):
-        if json_file.endswith(".json"):
-            json_path = json_folder_path + "/" + json_file
-            json_path_list.append(json_path)
-    json_path_list.sort()
-    return json_path_list
+# Return a list with cypher statements strings
+def convert_one_json_to_cypher(json_file_path):
+    graph = convert_one_json_to_graph(json_file_path)
+    return convert_graph_to_cypher(graph)
 
 
-if __name__ == '__main__':
-    neo4j_config_file = 'neo4j_config.txt'
-    json_folder_path = 'FHIR Data/FHIR JSON'
-    cypher_folder_path = 'FHIR Data/FHIR Cypher'
-    json_path_list = read_all_json_files(json_folder_path)
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert FHIR JSON files to Cypher and upload them to Neo4j.")
+    parser.add_argument("--config", default='neo4j_config.txt', help="Neo4j config file.")
+    parser.add_argument("--json-folder", default='FHIR Data/FHIR JSON',
+                        help="Folder with FHIR JSON files (or NDJSON files with --input-format ndjson).")
+    parser.add_argument("--input-format", choices=["bundle", "ndjson"], default="bundle",
+                        help="'bundle': one Bundle per *.json file, "
+                             "'ndjson': FHIR Bulk Data *.ndjson files with one resource per line.")
+    parser.add_argument("--range-size", type=int, default=ndjson_reader.DEFAULT_RANGE_SIZE // (1024 * 1024),
+                        help="Size in MB of the byte ranges a NDJSON file is split into.")
+    parser.add_argument("--cypher-folder", default='FHIR Data/FHIR Cypher',
+                        help="Folder for generated Cypher files and batch artifacts.")
+    parser.add_argument("--no-cypher-dump", action="store_true", help="Do not write the Cypher text files.")
+    parser.add_argument("--artifact-format", choices=batch_artifact.FORMATS, default=None,
+                        help="Also write the upload batches of every file as a compressed batch artifact "
+                             "(Batches_<name>.jsonl.gz or .msgpack.gz), which --replay can upload later.")
+    parser.add_argument("--replay", default=None, metavar="FOLDER",
+                        help="Do not convert. Upload the batch artifacts in FOLDER instead.")
+    parser.add_argument("--limit", type=int, default=100,
+                        help="Maximum number of JSON files to process. NDJSON input is not limited.")
+    parser.add_argument("--mode", choices=["statement", "batch"], default="statement",
+                        help="'statement' uploads one Cypher statement per node/edge, "
+                             "'batch' uploads grouped UNWIND batches.")
+    parser.add_argument("--batch-size", type=int, default=cypher_generator.DEFAULT_BATCH_SIZE,
+                        help="Number of rows per UNWIND batch in batch mode.")
+    parser.add_argument("--rules", default=None, help="Mapping rules file. Default: rules.txt next to main.py.")
+    parser.add_argument("--property-modes", default=None,
+                        help="File with the property storage mode (nested or flat) per resource type, "
+                             "e.g. property_modes.txt. Default: all resources nested.")
+    parser.add_argument("--projection", default=None,
+                        help="File with the resource types and JSON paths that are converted, e.g. projection.txt. "
+                             "Everything else is dropped while the files are read. Default: everything.")
+    parser.add_argument("--summary", default=None,
+                        help="File with the summary properties that are copied onto the resource nodes, e.g. "
+                             "summary.txt (names and birthDate of Patients, codes and dates of events).")
+    parser.add_argument("--timeline", action="store_true",
+                        help="Link the Encounters, Observations and Procedures of every patient in the order of "
+                             "their event_time with NEXT_EVENT relationships. Needs --summary.")
+    parser.add_argument("--tag-bundles", action="store_true",
+                        help="Store the id of its bundle in every node, with an index, so the nodes of a bundle or a "
+                             "patient can be deleted or replaced later (see purge.py).")
+    parser.add_argument("--replace", action="store_true",
+                        help="Delete the nodes of the bundles of the input files that an earlier run with "
+                             "--tag-bundles uploaded, then upload the files again. Implies --tag-bundles.")
+    parser.add_argument("--purge-concurrency", type=int, default=purge.DEFAULT_CONCURRENCY,
+                        help="Number of delete transactions that run at the same time with --replace.")
+    parser.add_argument("--property-types", choices=property_serializer.PROPERTY_TYPES,
+                        default=property_serializer.TYPED,
+                        help="'typed' keeps numbers, booleans and lists as such, 'temporal' also stores FHIR dates and "
+                             "dateTimes as Neo4j Date and DateTime values, 'string' stores every value as a string "
+                             "(the format of earlier versions).")
+    parser.add_argument("--shared-codes", action="store_true",
+                        help="Link every Coding to one shared Code {system, code} node with a HAS_CODE relationship, "
+                             "instead of Property nodes.")
+    parser.add_argument("--code-cache-size", type=int, default=terminology.DEFAULT_CACHE_SIZE,
+                        help="Number of codes each process remembers as already written with --shared-codes.")
+    parser.add_argument("--registry", action="store_true",
+                        help="Write shared resources (Organization, Practitioner, ...) once across all bundles and "
+                             "resolve references to resources of earlier bundles whose upload has committed. With "
+                             "--workers or --async, a bundle is converted while earlier bundles are still uploading, "
+                             "so which references are resolved, and the output of a bundle, depends on the timing "
+                             "of the workers.")
+    parser.add_argument("--registry-file", default=None,
+                        help="Keep the resource registry in this SQLite file, so it survives a restart and is shared "
+                             "by --workers. Implies --registry.")
+    parser.add_argument("--cache-folder", default=None,
+                        help="Cache the conversion of every bundle in this folder, so unchanged bundles are not "
+                             "converted again in the next run. Not used with --registry, --shared-codes or "
+                             "--incremental.")
+    parser.add_argument("--cache-size", type=int, default=conversion_cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help="Maximum size of the conversion cache in MB. The least recently used bundles are "
+                             "deleted first.")
+    parser.add_argument("--schema", choices=["index", "constraint", "none"], default="index",
+                        help="Create an index or a uniqueness constraint on the id of every node label before upload.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Number of conversion processes. 0 converts and uploads one file after another.")
+    parser.add_argument("--upload-concurrency", type=int, default=1,
+                        help="Number of upload threads when --workers is greater than 0, "
+                             "or number of concurrent sessions with --async.")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Upload with the asyncio driver: several bundles at the same time, each in one write "
+                             "transaction that is retried after transient errors.")
+    parser.add_argument("--max-retries", type=int, default=neo4j_driver.DEFAULT_MAX_RETRIES,
+                        help="Number of retries of a transaction after a transient error.")
+    parser.add_argument("--transaction-size", type=int, default=0,
+                        help="Commit the queries of a bundle in transactions of this many statements (or batches "
+                             "with --mode batch). 0 uploads every bundle in one transaction.")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Adjust the rows per transaction while uploading, from the commit latency and the "
+                             "transient errors (see upload_controller). Failed transactions are split and tried again.")
+    parser.add_argument("--target-latency", type=float, default=upload_controller.DEFAULT_TARGET_LATENCY,
+                        help="Seconds a transaction may take with --adaptive before the next ones get smaller.")
+    parser.add_argument("--max-in-flight", type=int, default=upload_controller.DEFAULT_MAX_IN_FLIGHT,
+                        help="Maximum number of transactions that run at the same time with --adaptive.")
+    parser.add_argument("--checkpoint-file", default=checkpoint.DEFAULT_CHECKPOINT_FILE_PATH,
+                        help="Journal of the uploaded bundles and committed transactions for --resume.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip the bundles that the last run uploaded completely, continue a bundle after its "
+                             "last committed transaction, and try the failed bundles again. Use the same "
+                             "--transaction-size as in the last run.")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Read each bundle entry by entry instead of loading the whole json document.")
+    parser.add_argument("--export-csv", default=None, metavar="FOLDER",
+                        help="Do not upload. Write CSV files for neo4j-admin database import to FOLDER instead.")
+    parser.add_argument("--compress", action="store_true", help="Write the CSV data files with gzip.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="MERGE resources on resourceType + id and upload only bundles and resources that have "
+                             "changed since the last run.")
+    parser.add_argument("--state-file", default=incremental.DEFAULT_STATE_FILE_PATH,
+                        help="File with the hashes of the uploaded bundles and resources for --incremental.")
+    parser.add_argument("--work-queue", default=None,
+                        help="Run as a worker of a distributed ingest: lease shards from this work queue (see "
+                             "distributed.py) instead of reading --json-folder. NDJSON workers still build the "
+                             "reference index from --json-folder.")
+    parser.add_argument("--worker-id", default=None, help="Name of this worker in the work queue. Default: host-pid.")
+    parser.add_argument("--lease-time", type=int, default=distributed.DEFAULT_LEASE_TIME,
+                        help="Seconds after which the shard of a worker without progress is leased to another worker.")
+    parser.add_argument("--no-upload", action="store_true",
+                        help="Only convert and save the Cypher files and batch artifacts, without connecting to Neo4j.")
+    parser.add_argument("--metrics-log", default=None,
+                        help="Append structured log events (one JSON object per line) to this file.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve the metrics in the Prometheus text format on http://localhost:<port>/metrics.")
+    parser.add_argument("--profile-bundle", default=None, metavar="NAME",
+                        help="Profile the conversion of the bundle with this name (e.g. Abbott_Pok_14) with cProfile. "
+                             "Only with --workers 0 and without --async.")
+    parser.add_argument("--profile-output", default=None,
+                        help="Save the profile of --profile-bundle to this file, e.g. for snakeviz.")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="Also trace the memory allocations of --profile-bundle with tracemalloc.")
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.workers < 0:
+        parser.error("--workers must not be negative")
+    if args.upload_concurrency < 1:
+        parser.error("--upload-concurrency must be at least 1")
+    if args.range_size < 1:
+        parser.error("--range-size must be at least 1")
+    if args.artifact_format == batch_artifact.MSGPACK and batch_artifact.msgpack is None:
+        parser.error("--artifact-format msgpack needs the msgpack package (pip install msgpack)")
+    if args.code_cache_size < 1:
+        parser.error("--code-cache-size must be at least 1")
+    if args.cache_size < 1:
+        parser.error("--cache-size must be at least 1")
+    if args.max_retries < 0:
+        parser.error("--max-retries must not be negative")
+    if args.transaction_size < 0:
+        parser.error("--transaction-size must not be negative")
+    if args.adaptive and args.transaction_size:
+        parser.error("--adaptive chooses the transaction size, do not use it with --transaction-size")
+    if args.target_latency <= 0:
+        parser.error("--target-latency must be positive")
+    if args.max_in_flight < 1:
+        parser.error("--max-in-flight must be at least 1")
+    if args.registry_file:
+        args.registry = True
+    if args.replace:
+        args.tag_bundles = True
+    if args.purge_concurrency < 1:
+        parser.error("--purge-concurrency must be at least 1")
+    if args.incremental and (args.input_format != "bundle" or args.workers > 0 or args.export_csv or args.use_async
+                             or args.registry):
+        parser.error("--incremental only works with bundle input, --workers 0 and without --export-csv, --async "
+                     "or --registry")
+    if args.timeline and (not args.summary or args.input_format != "bundle" or args.incremental):
+        parser.error("--timeline needs --summary and only works with bundle input and without --incremental")
+    if args.tag_bundles and (args.input_format != "bundle" or args.incremental):
+        parser.error("--tag-bundles and --replace only work with bundle input and without --incremental")
+    if args.replace and (args.registry or args.work_queue or args.resume or args.no_upload or args.export_csv):
+        parser.error("--replace does not work with --registry, --work-queue, --resume, --no-upload or --export-csv")
+    if args.registry and args.input_format != "bundle":
+        parser.error("--registry only works with bundle input")
+    # --resume skips the committed transactions of a bundle that is converted again, so its conversion must not
+    # depend on what earlier bundles of the run wrote.
+    if args.resume and (args.registry or args.shared_codes):
+        parser.error("--resume does not work with --registry or --shared-codes: they change the conversion of a "
+                     "bundle, so its committed transactions can not be skipped")
+    if args.registry and args.workers > 0 and not args.registry_file:
+        parser.error("--registry with --workers needs a --registry-file that the worker processes share")
+    if args.work_queue and (args.incremental or args.resume or args.export_csv):
+        parser.error("--work-queue does not work with --incremental, --resume or --export-csv")
+    if args.no_upload and (args.use_async or args.incremental):
+        parser.error("--no-upload does not work with --async or --incremental")
+    if args.profile_bundle and (args.workers > 0 or args.use_async):
+        parser.error("--profile-bundle only works with --workers 0 and without --async")
+    return args
 
-    driver = neo4j_driver.Neo4jDriver(neo4j_config_file)
-    driver.connect()
 
-    cnt = 1
-    total_json_files = len(json_path_list)
+# Convert and upload the sources (json files or NDJSON ranges) one after another. Returns the list of sources that
+# failed to upload.
+# ingest_state: an incremental.IngestState for incremental ingest, or None.
+# journal: a checkpoint.CheckpointJournal, or None.
+def process_json_files_one_by_one(source_list, driver, cypher_folder_path, args, ingest_state=None, journal=None):
+    failures = []
+    total_json_files = len(source_list)
     processed_json_files = 0
-    for json_path in json_path_list:
+    for source in source_list:
         processed_json_files += 1
         print(f"Processing {processed_json_files}/{total_json_files} json file")
-        json_file_name = os.path.basename(json_path)
-        json_file_name = os.path.splitext(json_file_name)[0]
+        json_file_name = pipeline.get_source_name(source)
         cypher_file_name = f'Cypher_{json_file_name}.txt'
-        cypher_file_path = f'{cypher_folder_path}/Cypher_{json_file_name}.txt'
-        print("Converting " + json_path + " to Cypher statements")
-        cypher_statements = convert_one_json_to_cypher(json_path)
+        print(f"Converting {source} to Cypher statements")
+        update = None
+        if ingest_state is not None:
+            update = incremental.convert_json_to_incremental_update(source, ingest_state, args.streaming)
+            if update is None:
+                print(f"{source} has not changed since the last run")
+                print("----------------------------------------------------")
+                continue
+            graph = update.get_graph()
+            # The statements are only built if they are uploaded or saved, the batches only if they are uploaded
+            # or saved as a batch artifact.
+            cypher_statements = None
+            if args.mode != "batch" or not args.no_cypher_dump:
+                cypher_statements = update.get_delete_cypher_statements() + convert_graph_to_cypher(graph)
+            batches = None
+            if args.mode == "batch" or args.artifact_format:
+                batches = (update.get_delete_batches(args.batch_size) +
+                           cypher_generator.convert_graph_to_batches(graph, args.batch_size))
+            bundle = pipeline.ConvertedBundle(source, cypher_statements, batches,
+                                              neo4j_schema.collect_graph_labels(graph))
+            pipeline.add_commit_info(bundle, graph)
+        elif json_file_name == args.profile_bundle:
+            print(f"Profiling the conversion of {source}")
+            bundle = instrumentation.profile_call(pipeline.convert_bundle, source, args.batch_size, args.mode,
+                                                  args.streaming, not args.no_cypher_dump, args.artifact_format,
+                                                  output_path=args.profile_output, trace_memory=args.profile_memory)
+        else:
+            bundle = pipeline.convert_bundle(source, args.batch_size, args.mode, args.streaming,
+                                             not args.no_cypher_dump, args.artifact_format)
+            if bundle.get_cache_hit():
+                print(f"{source} has been read from the conversion cache")
         print("Cypher statements have been generated")
-        cypher_generator.save_cypher_statements_to_file(cypher_statements, cypher_file_path)
-        print(cypher_file_name + " has been saved at " + cypher_folder_path)
+        pipeline.record_converted_bundle(bundle)
+        pipeline.save_converted_bundle(bundle, cypher_folder_path, not args.no_cypher_dump, args.artifact_format)
+        if not args.no_cypher_dump:
+            print(cypher_file_name + " has been saved at " + cypher_folder_path)
 
-        print("Uploading Cypher statements in " + cypher_file_name + " to Neo4j database")
-        driver.run_cypher_queries(cypher_statements)
-        print("Cypher statements in " + cypher_file_name + " has been uploaded to Neo4j database")
+        print(f"Uploading {source} to Neo4j database")
+        if args.schema != "none":
+            driver.ensure_schema(bundle.get_labels(), unique=args.schema == "constraint")
+        start = time.perf_counter()
+        try:
+            pipeline.upload_bundle(driver, bundle, args.mode, journal)
+        except Exception as e:
+            # The transactions of the bundle that are not committed are rolled back, --resume tries it again.
+            print(f"Failed to upload {source}: {e}")
+            pipeline.record_uploaded_bundle(bundle, time.perf_counter() - start, error=e)
+            failures.append(source)
+            print("----------------------------------------------------")
+            continue
+        pipeline.record_uploaded_bundle(bundle, time.perf_counter() - start)
+        print(f"{source} has been uploaded to Neo4j database")
+        if update is not None:
+            ingest_state.save_update(update)
+            print(f"{len(update.get_resource_hashes())} new or changed resources, "
+                  f"{len(update.get_replaced_nodes())} of them replaced")
 
         print(f"{processed_json_files}/{total_json_files} files have been processed")
         print("----------------------------------------------------")
+    return failures
+
+
+# Upload the batch artifacts (see batch_artifact) in a folder one after another, without converting anything.
+def replay_batch_artifacts(artifact_folder_path, driver, args):
+    artifact_path_list = batch_artifact.read_all_artifact_files(artifact_folder_path)
+    total_artifacts = len(artifact_path_list)
+    for processed_artifacts, artifact_path in enumerate(artifact_path_list, start=1):
+        print(f"Uploading {processed_artifacts}/{total_artifacts}: {artifact_path}")
+        if args.schema != "none":
+            driver.ensure_schema(batch_artifact.read_artifact_labels(artifact_path),
+                                 unique=args.schema == "constraint")
+        driver.run_batch_artifact(artifact_path, args.batch_size)
+    print(f"{total_artifacts} batch artifacts have been uploaded to Neo4j database")
+
+
+# The settings of the conversion of args, the same in this process and in the worker processes of the pipelines.
+def build_conversion_settings(args):
+    return pipeline.ConversionSettings(rule_file_path=args.rules, property_mode_file_path=args.property_modes,
+                                       projection_file_path=args.projection, summary_file_path=args.summary,
+                                       timeline=args.timeline, shared_codes=args.shared_codes,
+                                       code_cache_size=args.code_cache_size, use_registry=args.registry,
+                                       registry_file_path=args.registry_file, cache_folder_path=args.cache_folder,
+                                       cache_size=args.cache_size * 1024 * 1024, property_types=args.property_types,
+                                       tag_bundles=args.tag_bundles, mode=args.mode, batch_size=args.batch_size,
+                                       streaming=args.streaming, cypher_dump=not args.no_cypher_dump,
+                                       artifact_format=args.artifact_format)
+
+
+# Convert the sources one after another and write them as CSV files for neo4j-admin database import.
+def export_sources_to_csv(source_list, args):
+    exporter = csv_exporter.CsvExporter(args.export_csv, compress=args.compress)
+    total_sources = len(source_list)
+    for processed_sources, source in enumerate(source_list, start=1):
+        print(f"Exporting {processed_sources}/{total_sources}: {source}")
+        exporter.add_graph(pipeline.convert_source_to_graph(source, args.streaming))
+        if args.registry:
+            resource_registry.get_registry().commit_claims(source)
+    import_arguments = exporter.close()
+    print(f"{exporter.get_number_of_nodes()} nodes and {exporter.get_number_of_relationships()} relationships "
+          f"have been written to {args.export_csv}")
+    print("Import them into an empty database with:")
+    print("neo4j-admin database import full neo4j " + " ".join(f'"{argument}"' for argument in import_arguments))
+
+
+# Delete the nodes of the bundles of the sources (see purge), so that they can be uploaded again. The bundle id
+# indexes are created first.
+def purge_sources(source_list, args):
+    driver = neo4j_driver.Neo4jDriver(args.config, max_retries=args.max_retries,
+                                      controller=upload_controller.get_upload_controller())
+    driver.connect()
+    try:
+        if args.schema != "none":
+            driver.ensure_schema(neo4j_schema.collect_schema_labels(args.rules), unique=args.schema == "constraint")
+        bundle_ids = [purge.get_bundle_id(source) for source in source_list]
+        number_of_nodes = purge.purge_bundles(driver, [bundle_id for bundle_id in bundle_ids if bundle_id],
+                                              args.batch_size, args.purge_concurrency)
+        print(f"{number_of_nodes} nodes of {len(source_list)} files have been deleted before they are uploaded again")
+    finally:
+        driver.close()
+    print("----------------------------------------------------")
 
-        cnt += 1
-        if cnt >= 101:
+
+# Print the end-of-run summary of the instrumentation, log it as the run_summary event, and close the event log.
+def finish_instrumentation():
+    print("----------------------------------------------------")
+    if upload_controller.get_upload_controller() is not None:
+        print(upload_controller.get_upload_controller().format_report())
+    print(instrumentation.get_metrics().format_summary())
+    instrumentation.log_event("run_summary", elapsed=round(instrumentation.get_metrics().get_elapsed(), 3),
+                              **instrumentation.get_metrics().snapshot())
+    instrumentation.close_event_log()
+
+
+# Print the failed sources and the instrumentation summary, and close the checkpoint journal (or work queue).
+def finish_run(failures, journal):
+    if failures:
+        if isinstance(journal, distributed.WorkQueue):
+            print(f"{len(failures)} files failed, their shards are leased again:")
+        else:
+            print(f"{len(failures)} files failed, run again with --resume to retry them:")
+        for source in failures:
+            print(f"  {source}")
+    journal.close()
+    finish_instrumentation()
+
+
+# Convert and upload the sources with the asynchronous, pipelined or sequential ingest of args. Returns the list of
+# sources that failed.
+# driver: the Neo4jDriver, None with --async.
+# settings: the pipeline.ConversionSettings of args.
+def ingest_sources(source_list, driver, cypher_folder_path, args, settings, reference_index=None, ingest_state=None,
+                   journal=None):
+    if args.use_async:
+        failures = asyncio.run(process_sources_async(source_list, cypher_folder_path, args, settings,
+                                                     reference_index, journal))
+        print(f"{len(source_list) - len(failures)}/{len(source_list)} files have been processed")
+        return failures
+    if args.workers > 0:
+        # Pipelined ingest: conversion in worker processes, upload in upload threads.
+        failures = pipeline.run_pipeline(source_list, driver, cypher_folder_path, settings, workers=args.workers,
+                                         upload_concurrency=args.upload_concurrency, schema=args.schema,
+                                         reference_index=reference_index, journal=journal)
+        print(f"{len(source_list) - len(failures)}/{len(source_list)} files have been processed")
+        return failures
+    failures = process_json_files_one_by_one(source_list, driver, cypher_folder_path, args, ingest_state, journal)
+    if args.registry:
+        print(f"{resource_registry.get_registry().get_number_of_reused_nodes()} shared resources have been "
+              f"reused instead of written again")
+    if conversion_cache.get_conversion_cache() is not None:
+        print(conversion_cache.get_conversion_cache().get_statistics())
+    return failures
+
+
+# Worker of a distributed ingest: lease shards from the work queue (see distributed) and ingest them until there
+# are no shards left. Returns the list of sources that failed.
+def ingest_work_queue(work_queue, driver, cypher_folder_path, args, settings, reference_index=None):
+    failures = []
+    while True:
+        shard = work_queue.lease_shard()
+        if shard is None:
             break
-    driver.close()
+        source_list = work_queue.get_shard_sources(shard)
+        print(f"{work_queue.worker_id} has leased shard {shard} with {len(source_list)} files")
+        failures.extend(ingest_sources(source_list, driver, cypher_folder_path, args, settings, reference_index,
+                                       journal=work_queue))
+        print(f"Shard {shard} is {work_queue.complete_shard(shard)}")
+        print("----------------------------------------------------")
+    print(f"{work_queue.worker_id}: no more shards to lease")
+    return failures
+
+
+# Connect the asyncio driver, convert and upload all sources, and close the driver, all on one event loop.
+async def process_sources_async(source_list, cypher_folder_path, args, settings, reference_index=None, journal=None):
+    driver = neo4j_driver.AsyncNeo4jDriver(args.config, max_retries=args.max_retries,
+                                           transaction_size=args.transaction_size or None,
+                                           controller=upload_controller.get_upload_controller())
+    driver.connect()
+    try:
+        if args.schema != "none":
+            await driver.ensure_schema(neo4j_schema.collect_schema_labels(args.rules),
+                                       unique=args.schema == "constraint")
+        return await pipeline.run_async_pipeline(source_list, driver, cypher_folder_path, settings,
+                                                 workers=args.workers, upload_concurrency=args.upload_concurrency,
+                                                 schema=args.schema, reference_index=reference_index,
+                                                 journal=journal)
+    finally:
+        await driver.close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    neo4j_config_file = args.config
+    json_folder_path = args.json_folder
+    cypher_folder_path = args.cypher_folder
+    if args.metrics_log:
+        instrumentation.open_event_log(args.metrics_log)
+    if args.metrics_port:
+        instrumentation.start_metrics_server(args.metrics_port)
+        print(f"Metrics are served on http://localhost:{args.metrics_port}/metrics")
+    if args.adaptive:
+        upload_controller.set_upload_controller(
+            upload_controller.UploadController(target_latency=args.target_latency, max_in_flight=args.max_in_flight))
+    if args.replay:
+        driver = neo4j_driver.Neo4jDriver(neo4j_config_file, max_retries=args.max_retries,
+                                          transaction_size=args.transaction_size or None,
+                                          controller=upload_controller.get_upload_controller())
+        driver.connect()
+        replay_batch_artifacts(args.replay, driver, args)
+        driver.close()
+        finish_instrumentation()
+        raise SystemExit(0)
+    settings = build_conversion_settings(args)
+    settings.apply()
+    if args.registry:
+        # The workers of a work queue can share the registry file, their claims stay pending until they commit.
+        if not args.work_queue:
+            released = resource_registry.get_registry().release_pending_claims()
+            if released:
+                print(f"{released} shared resources that the last run claimed but did not upload will be written "
+                      f"again")
+    reference_index = None
+    if args.input_format == "ndjson":
+        ndjson_path_list = ndjson_reader.read_all_ndjson_files(json_folder_path)
+        print("Building the reference index of " + json_folder_path)
+        reference_index = ndjson_reader.build_reference_index(ndjson_path_list)
+        ndjson_reader.set_reference_index(reference_index)
+        print(f"{len(reference_index)} resources have been indexed")
+        source_list = ndjson_reader.split_all_ndjson_files(ndjson_path_list, args.range_size * 1024 * 1024)
+    elif args.work_queue:
+        # The sources come from the work queue.
+        source_list = []
+    else:
+        source_list = graph_helper.read_all_json_files(json_folder_path)[:args.limit]
+
+    if args.export_csv:
+        export_sources_to_csv(source_list, args)
+        finish_instrumentation()
+        raise SystemExit(0)
+
+    if args.work_queue:
+        # The work queue is also the checkpoint journal of the worker.
+        journal = distributed.WorkQueue(args.work_queue, args.worker_id or f"{socket.gethostname()}-{os.getpid()}",
+                                        args.lease_time)
+    else:
+        journal = checkpoint.CheckpointJournal(args.checkpoint_file)
+        if args.resume:
+            total_sources = len(source_list)
+            source_list = [source for source in source_list if not journal.is_done(source)]
+            print(f"Resuming: {total_sources - len(source_list)} of {total_sources} files were uploaded by the "
+                  f"last run")
+        else:
+            journal.clear()
+    if args.replace:
+        purge_sources(source_list, args)
+
+    # The asynchronous ingest connects its own driver.
+    driver = None
+    ingest_state = None
+    if not args.use_async:
+        if args.no_upload:
+            driver = recording_driver.RecordingDriver(transaction_size=args.transaction_size or None,
+                                                      controller=upload_controller.get_upload_controller())
+        else:
+            driver = neo4j_driver.Neo4jDriver(neo4j_config_file, max_retries=args.max_retries,
+                                              transaction_size=args.transaction_size or None,
+                                              controller=upload_controller.get_upload_controller())
+        driver.connect()
+        if args.schema != "none":
+            driver.ensure_schema(neo4j_schema.collect_schema_labels(args.rules), unique=args.schema == "constraint")
+        if args.incremental:
+            ingest_state = incremental.IngestState(args.state_file)
+            driver.ensure_owner_index(incremental.OWNER_PROPERTY)
+
+    if args.work_queue:
+        failures = ingest_work_queue(journal, driver, cypher_folder_path, args, settings, reference_index)
+    else:
+        failures = ingest_sources(source_list, driver, cypher_folder_path, args, settings, reference_index,
+                                  ingest_state, journal)
+    if ingest_state is not None:
+        ingest_state.close()
+    if driver is not None:
+        driver.close()
+    finish_run(failures, journal)
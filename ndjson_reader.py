@@ -0,0 +1,203 @@
+# Input adapter for FHIR Bulk Data ($export) NDJSON files.
+# Each file has one resource per line, usually one file per resource type (Patient.ndjson, Observation.ndjson, ...).
+# References between resources look like 'Patient/123' and usually point to a resource in another file.
+#
+# The files are read line by line and split into byte ranges (NdjsonRange), so a large file can be converted by
+# several workers. Each range becomes one Graph, the same kind of graph that graph_helper builds from a Bundle.
+# A global ReferenceIndex, built in a first pass over all files, gives every resource a fixed node id, so a range
+# can create edges to resources in other ranges and files.
+import json
+import os
+
+import graph_helper
+from graph import Graph, Node
+import incremental
+import instrumentation
+import projection
+import rule
+
+# Default size of one byte range. A file smaller than this is one range.
+DEFAULT_RANGE_SIZE = 64 * 1024 * 1024
+
+# The reference index used by convert_ndjson_range_to_graph when no index is given.
+# In worker processes it is set once by the pool initializer (see set_reference_index).
+reference_index = None
+
+
+# A part of one NDJSON file: all lines that start in [start, end).
+class NdjsonRange:
+    def __init__(self, path, start, end):
+        self.path = path
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f"{self.path}[{self.start}:{self.end}]"
+
+    # Name used for the Cypher file and the graph id, e.g. Observation_0, Observation_67108864.
+    def get_name(self):
+        return f"{os.path.splitext(os.path.basename(self.path))[0]}_{self.start}"
+
+    def get_path(self):
+        return self.path
+
+    def get_start(self):
+        return self.start
+
+    def get_end(self):
+        return self.end
+
+
+# The key of a resource in the index, e.g. 'Patient/123'. A resource without an id cannot be referenced, and gets the
+# hash of its content instead (see incremental.compute_resource_hash), so two of them do not become one node.
+def make_reference_key(resource):
+    resource_id = resource.get('id')
+    if not resource_id:
+        resource_id = incremental.compute_resource_hash(resource)
+    return f"{resource.get('resourceType', '')}/{resource_id}"
+
+
+class ReferenceIndex:
+    def __init__(self):
+        # key: 'ResourceType/id', value: (node id, node type, node name)
+        self.nodes = {}
+        self.type_counts = {}
+
+    def add_resource(self, resource):
+        key = make_reference_key(resource)
+        if key in self.nodes:
+            return
+        if not resource.get('id'):
+            instrumentation.add_count("resources_without_id")
+        resource_type = resource.get('resourceType', '')
+        cnt = self.type_counts.get(resource_type, 0) + 1
+        self.type_counts[resource_type] = cnt
+        # Name is resourceType + number, e.g. observation1, observation2, etc.
+        self.nodes[key] = (graph_helper.make_node_id(resource_type, key.split('/', 1)[1]), resource_type,
+                           resource_type.lower() + str(cnt))
+
+    # Return the key of a reference, or None if it is not in the index.
+    # Absolute references like 'http://server/fhir/Patient/123' or 'Patient/123/_history/2' are reduced to 'Patient/123'.
+    def resolve(self, reference):
+        if reference in self.nodes:
+            return reference
+        key = graph_helper.reduce_reference(reference)
+        if key in self.nodes:
+            return key
+        return None
+
+    def get_node_info(self, key):
+        return self.nodes.get(key)
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def set_reference_index(index):
+    global reference_index
+    reference_index = index
+
+
+# Files of resource types that the projection drops are not read (see projection.Projection.is_ndjson_file_included).
+def read_all_ndjson_files(ndjson_folder_path):
+    ndjson_path_list = []
+    resource_projection = projection.get_projection()
+    for ndjson_file in os.listdir(ndjson_folder_path):
+        if ndjson_file.endswith(".ndjson") and resource_projection.is_ndjson_file_included(ndjson_file):
+            ndjson_path_list.append(ndjson_folder_path + "/" + ndjson_file)
+    ndjson_path_list.sort()
+    return ndjson_path_list
+
+
+# Split one file into ranges of about range_size bytes. Every range starts at the beginning of a line.
+def split_ndjson_file(path, range_size=DEFAULT_RANGE_SIZE):
+    file_size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        while boundaries[-1] + range_size < file_size:
+            # Move the boundary to the start of the next line.
+            f.seek(boundaries[-1] + range_size)
+            f.readline()
+            if f.tell() >= file_size:
+                break
+            boundaries.append(f.tell())
+    boundaries.append(file_size)
+    return [NdjsonRange(path, boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+
+
+def split_all_ndjson_files(ndjson_path_list, range_size=DEFAULT_RANGE_SIZE):
+    ranges = []
+    for path in ndjson_path_list:
+        ranges.extend(split_ndjson_file(path, range_size))
+    return ranges
+
+
+# Yield the resources of the lines that start in [start, end) one by one, projected (see projection). Empty lines
+# and resources of dropped types are skipped.
+def iter_ndjson_resources(path, start=0, end=None):
+    resource_projection = projection.get_projection()
+    project = not resource_projection.is_empty()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            resource = json.loads(line)
+            if project:
+                if not resource_projection.is_type_included(resource.get('resourceType', '')):
+                    instrumentation.add_count("resources_dropped")
+                    continue
+                resource = resource_projection.project_resource(resource)
+            yield resource
+
+
+# First pass: read every resource once and give it a node id.
+def build_reference_index(ndjson_path_list):
+    index = ReferenceIndex()
+    for path in ndjson_path_list:
+        for resource in iter_ndjson_resources(path):
+            index.add_resource(resource)
+    return index
+
+
+# Convert one range to a graph with property nodes.
+# Resource nodes keep the id from the index. A reference to a resource outside the range becomes an edge to an
+# external node, which is MERGEd on upload, so it does not matter which range is uploaded first.
+def convert_ndjson_range_to_graph(ndjson_range, index=None, rule_file_path=None):
+    index = index if index is not None else reference_index
+    graph = Graph(graph_helper.make_node_id("ndjson", ndjson_range.get_name()))
+    graph.set_merge_resource_nodes(True)
+
+    for resource in iter_ndjson_resources(ndjson_range.get_path(), ndjson_range.get_start(), ndjson_range.get_end()):
+        key = make_reference_key(resource)
+        # The same resource twice in one range is converted once.
+        if graph.find_node_by_fullUrl(key):
+            continue
+        node_id, node_type, node_name = index.get_node_info(key)
+        node = Node(name=node_name, node_type=node_type, properties=resource, fullUrl=key)
+        graph.add_node_properties_nested(node)
+
+    def resolve(reference):
+        key = index.resolve(reference)
+        if key is None:
+            return None
+        child_node = graph.find_node_by_fullUrl(key)
+        if child_node is None:
+            node_id, node_type, node_name = index.get_node_info(key)
+            child_node = Node(name=node_name, node_type=node_type, properties={}, fullUrl=key, isExternalNode=True)
+            child_node.set_id(node_id)
+        return child_node
+
+    graph_helper.add_reference_edges(graph, rule.get_rule(rule_file_path), resolve)
+
+    graph_helper.build_property_nodes_for_each_node(graph)
+    # build_property_nodes_for_each_node numbers all nodes of the graph. Resource nodes get their id from the
+    # index back, because other ranges refer to them by that id.
+    for node in list(graph.get_nodes_properties_nested().values()):
+        graph.set_node_properties_unnested_id(node, index.get_node_info(node.get_fullUrl())[0])
+    return graph
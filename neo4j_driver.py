@@ -1,13 +1,50 @@
-from neo4j import GraphDatabase
+import asyncio
+import time
+import batch_artifact
+import instrumentation
+from neo4j import AsyncGraphDatabase, GraphDatabase
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
+import neo4j_schema
+import upload_controller
 
+# Errors after which a transaction is tried again: deadlocks, lock timeouts, a leader switch in a cluster,
+# a lost connection.
+TRANSIENT_ERRORS = (TransientError, ServiceUnavailable, SessionExpired)
+DEFAULT_MAX_RETRIES = upload_controller.DEFAULT_MAX_RETRIES
+DEFAULT_RETRY_DELAY = upload_controller.DEFAULT_RETRY_DELAY
 
+
+def read_database_info(file_path):
+    database_info = {}
+    try:
+        with open(file_path, "r") as file:
+            for line in file:
+                key, value = line.strip().split("=")
+                database_info[key.strip()] = value.strip()
+        return database_info
+    except Exception as e:
+        print(f"Failed to read database info from file: {e}")
+        return None
+
+
+# Every call of run_cypher_queries and run_cypher_batches runs in one explicit write transaction, or in chunks of
+# transaction_size queries with one transaction each. A transaction that fails with a transient error is rolled back
+# and tried again after a delay that doubles every time, at most max_retries times (see upload_controller.RetryPolicy).
+# With an upload_controller.UploadController the size of the transactions is adjusted while the upload runs instead.
 class Neo4jDriver:
-    def __init__(self, config_file_path='neo4j_config.txt'):
+    def __init__(self, config_file_path='neo4j_config.txt', max_retries=DEFAULT_MAX_RETRIES,
+                 retry_delay=DEFAULT_RETRY_DELAY, transaction_size=None, controller=None):
         config = self.read_database_info(config_file_path)
         self.uri = config.get("uri")
         self.user = config.get("user")
         self.password = config.get("password")
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.transaction_size = transaction_size
+        self.controller = controller
         self.driver = None
+        # Labels that already have an index (or constraint) on id.
+        self.schema_labels = set()
 
     def connect(self):
         try:
@@ -25,22 +62,188 @@ class Neo4jDriver:
             result = session.run(query)
             return result
 
-    def run_cypher_queries(self, queries):
-        results = []
+    # Run a read query in a read transaction and return its records as a list of dicts.
+    def run_read_query(self, query, **parameters):
         with self.driver.session() as session:
-            for query in queries:
-                result = session.run(query)
-                results.append(result)
-        return results
+            return session.execute_read(lambda tx: tx.run(query, parameters).data())
+
+    # Run work(tx) in a write transaction and commit it, see AsyncNeo4jDriver.run_in_write_transaction.
+    def run_in_write_transaction(self, work, max_retries=None):
+        retry_policy = upload_controller.RetryPolicy(self.max_retries if max_retries is None else max_retries,
+                                                     self.retry_delay)
+        while True:
+            try:
+                with self.driver.session() as session:
+                    with session.begin_transaction() as tx:
+                        result = work(tx)
+                        tx.commit()
+                        return result
+            except TRANSIENT_ERRORS as e:
+                delay = retry_policy.next_delay(e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    # Run the queries in the transactions of an upload_controller.create_upload upload: transactions of
+    # transaction_size queries, or sized by the controller.
+    # run_query(tx, query) runs one query and returns its summary.
+    # start_chunk: skip the transactions that were committed before (see checkpoint).
+    # on_commit(committed_chunks, total_chunks): called after every commit.
+    # With a controller, start_chunk and on_commit count rows instead of transactions (see upload_controller).
+    def run_in_transactions(self, queries, run_query, start_chunk=0, on_commit=None):
+        upload = upload_controller.create_upload(queries, self.transaction_size, self.controller, start_chunk,
+                                                 on_commit)
+        for chunk in upload:
+            def work(tx, chunk=chunk):
+                return [run_query(tx, query) for query in chunk]
+            start = time.perf_counter()
+            try:
+                with upload.get_in_flight():
+                    result = self.run_in_write_transaction(work, upload.get_max_retries(chunk))
+            except TRANSIENT_ERRORS as e:
+                if upload.split(chunk, e):
+                    continue
+                raise
+            upload.commit(chunk, result, time.perf_counter() - start)
+        return upload.get_results()
+
+    # Each result is consumed before the next query is sent, so a failing query raises here and not later.
+    @instrumentation.timed("run_cypher_queries")
+    def run_cypher_queries(self, queries, start_chunk=0, on_commit=None):
+        summaries = self.run_in_transactions(queries, lambda tx, query: tx.run(query).consume(),
+                                             start_chunk, on_commit)
+        instrumentation.add_count("uploaded_statements", len(summaries))
+        return summaries
+
+    # Run a list of (query, rows) pairs from cypher_generator.convert_graph_to_batches.
+    # Each batch is sent with its rows as the $rows parameter, so the same query text is reused.
+    @instrumentation.timed("run_cypher_batches")
+    def run_cypher_batches(self, batches, start_chunk=0, on_commit=None):
+        def run_batch(tx, batch):
+            query, rows = batch
+            summary = tx.run(query, rows=rows).consume()
+            instrumentation.add_count("uploaded_rows", len(rows))
+            return summary
+        return self.run_in_transactions(batches, run_batch, start_chunk, on_commit)
+
+    # Upload a batch artifact file (see batch_artifact), e.g. one that was converted on another machine.
+    # batch_size: split the rows again into batches of this size, None keeps the batches of the file.
+    def run_batch_artifact(self, file_path, batch_size=None):
+        return self.run_cypher_batches(batch_artifact.read_batches_from_file(file_path, batch_size))
+
+    # Create an index (or uniqueness constraint) on the id of every label that does not have one yet,
+    # and wait until the new indexes are online, so the following edge statements can use them.
+    def ensure_schema(self, labels, unique=False):
+        new_labels = [label for label in labels if label not in self.schema_labels]
+        if not new_labels:
+            return
+        with self.driver.session() as session:
+            for statement in neo4j_schema.build_schema_statements(new_labels, unique):
+                session.run(statement).consume()
+            session.run("CALL db.awaitIndexes()").consume()
+        self.schema_labels.update(new_labels)
+
+    # Create the index on the owner property of the Property nodes, see neo4j_schema.build_owner_index_statement.
+    def ensure_owner_index(self, owner_property):
+        with self.driver.session() as session:
+            session.run(neo4j_schema.build_owner_index_statement(owner_property)).consume()
+            session.run("CALL db.awaitIndexes()").consume()
 
     def read_database_info(self, file_path):
-        database_info = {}
+        return read_database_info(file_path)
+
+
+# The same upload methods as Neo4jDriver on the asyncio driver. The methods are coroutines, so several bundles can
+# be uploaded at the same time over the connection pool (see pipeline.run_async_pipeline).
+# Every call runs in its own session and one explicit write transaction (or one per chunk of transaction_size
+# queries), which is committed at the end and tried again after a transient error, so a bundle is either uploaded
+# completely or not at all. With a controller the transactions are sized as in Neo4jDriver.
+class AsyncNeo4jDriver:
+    def __init__(self, config_file_path='neo4j_config.txt', max_retries=DEFAULT_MAX_RETRIES,
+                 retry_delay=DEFAULT_RETRY_DELAY, transaction_size=None, controller=None):
+        config = read_database_info(config_file_path)
+        self.uri = config.get("uri")
+        self.user = config.get("user")
+        self.password = config.get("password")
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.transaction_size = transaction_size
+        self.controller = controller
+        self.driver = None
+        # Labels that already have an index (or constraint) on id.
+        self.schema_labels = set()
+
+    def connect(self):
         try:
-            with open(file_path, "r") as file:
-                for line in file:
-                    key, value = line.strip().split("=")
-                    database_info[key.strip()] = value.strip()
-            return database_info
+            self.driver = AsyncGraphDatabase.driver(self.uri, auth=(self.user, self.password))
         except Exception as e:
-            print(f"Failed to read database info from file: {e}")
-            return None
+            print(f"Failed to connect to Neo4j: {e}")
+
+    async def close(self):
+        if self.driver:
+            await self.driver.close()
+            print("Connection closed.")
+
+    # Run work(tx) in a write transaction and commit it. After a transient error the transaction is rolled back
+    # and work is run again in a new transaction, at most max_retries times (default: the max_retries of the driver).
+    async def run_in_write_transaction(self, work, max_retries=None):
+        retry_policy = upload_controller.RetryPolicy(self.max_retries if max_retries is None else max_retries,
+                                                     self.retry_delay)
+        while True:
+            try:
+                async with self.driver.session() as session:
+                    async with await session.begin_transaction() as tx:
+                        result = await work(tx)
+                        await tx.commit()
+                        return result
+            except TRANSIENT_ERRORS as e:
+                delay = retry_policy.next_delay(e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    # See Neo4jDriver.run_in_transactions. run_query is a coroutine function.
+    async def run_in_transactions(self, queries, run_query, start_chunk=0, on_commit=None):
+        upload = upload_controller.create_upload(queries, self.transaction_size, self.controller, start_chunk,
+                                                 on_commit)
+        for chunk in upload:
+            async def work(tx, chunk=chunk):
+                return [await run_query(tx, query) for query in chunk]
+            start = time.perf_counter()
+            try:
+                async with upload.get_async_in_flight():
+                    result = await self.run_in_write_transaction(work, upload.get_max_retries(chunk))
+            except TRANSIENT_ERRORS as e:
+                if upload.split(chunk, e):
+                    continue
+                raise
+            upload.commit(chunk, result, time.perf_counter() - start)
+        return upload.get_results()
+
+    @instrumentation.timed("run_cypher_queries")
+    async def run_cypher_queries(self, queries, start_chunk=0, on_commit=None):
+        async def run_query(tx, query):
+            return await (await tx.run(query)).consume()
+        summaries = await self.run_in_transactions(queries, run_query, start_chunk, on_commit)
+        instrumentation.add_count("uploaded_statements", len(summaries))
+        return summaries
+
+    @instrumentation.timed("run_cypher_batches")
+    async def run_cypher_batches(self, batches, start_chunk=0, on_commit=None):
+        async def run_batch(tx, batch):
+            query, rows = batch
+            summary = await (await tx.run(query, rows=rows)).consume()
+            instrumentation.add_count("uploaded_rows", len(rows))
+            return summary
+        return await self.run_in_transactions(batches, run_batch, start_chunk, on_commit)
+
+    # See Neo4jDriver.ensure_schema. Schema statements run outside of the data transactions.
+    async def ensure_schema(self, labels, unique=False):
+        new_labels = [label for label in labels if label not in self.schema_labels]
+        if not new_labels:
+            return
+        async with self.driver.session() as session:
+            for statement in neo4j_schema.build_schema_statements(new_labels, unique):
+                await (await session.run(statement)).consume()
+            await (await session.run("CALL db.awaitIndexes()")).consume()
+        self.schema_labels.update(new_labels)
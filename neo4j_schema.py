@@ -0,0 +1,85 @@
+# Schema bootstrap for the Neo4j database.
+# Every edge statement looks up its two nodes by the id property. Without an index on (label, id) each lookup
+# is a scan over all nodes, so edge upload gets slower with every bundle. Creating an index (or a uniqueness
+# constraint, which is backed by an index) per label keeps each lookup an index seek.
+import re
+
+import patient_summary
+import property_serializer
+import purge
+import rule
+import terminology
+
+PROPERTY_LABEL = "Property"
+
+# Properties with clinical values that are compared in range queries: the value of a valueQuantity (on its Property
+# node, or on the Observation in the flat property mode) and the dates of Patients and Observations. Their range
+# indexes are created with typed property values (see property_serializer), so e.g.
+# MATCH (p:Property) WHERE p.value > 140 is an index seek.
+RANGE_INDEX_PROPERTIES = {PROPERTY_LABEL: ["value"],
+                          "Observation": ["effectiveDateTime", "issued", "valueQuantity.value"],
+                          "Patient": ["birthDate"]}
+
+
+# Return a sorted list of node labels: every resource type in the rules file, and Property.
+def collect_schema_labels(rule_file_path=None):
+    labels = {PROPERTY_LABEL}
+    labels.update(rule.get_rule(rule_file_path).get_resource_types())
+    return sorted(labels)
+
+
+# Return a sorted list of the labels of all nodes in the graph.
+# Resource types that do not appear in the rules file still need an index.
+def collect_graph_labels(graph):
+    labels = set()
+    for node in graph.get_nodes_properties_unnested():
+        labels.add(node.get_node_type())
+    for node in graph.get_shared_nodes(include_external=True):
+        labels.add(node.get_node_type())
+    return sorted(labels)
+
+
+# Cypher statement create an index or a uniqueness constraint on the id of one label.
+# IF NOT EXISTS makes the statement safe to run before every upload.
+def build_schema_statement(label, unique=False):
+    if unique:
+        return ("CREATE CONSTRAINT constraint_{}_id IF NOT EXISTS "
+                "FOR (n:`{}`) REQUIRE n.id IS UNIQUE").format(label.lower(), label)
+    return "CREATE INDEX index_{}_id IF NOT EXISTS FOR (n:`{}`) ON (n.id)".format(label.lower(), label)
+
+
+# Cypher statement create a range index on one property of a label.
+def build_range_index_statement(label, property_name):
+    return "CREATE RANGE INDEX index_{}_{} IF NOT EXISTS FOR (n:`{}`) ON (n.`{}`)".format(
+        label.lower(), re.sub(r'\W', '_', property_name).lower(), label, property_name)
+
+
+# Code nodes are also looked up by system and code in queries (see terminology).
+def build_schema_statements(labels, unique=False):
+    statements = [build_schema_statement(label, unique) for label in labels]
+    if terminology.CODE_LABEL in labels:
+        statements.append("CREATE INDEX index_{}_system_code IF NOT EXISTS FOR (n:`{}`) ON (n.system, n.code)".format(
+            terminology.CODE_LABEL.lower(), terminology.CODE_LABEL))
+    if property_serializer.get_property_types() != property_serializer.STRING:
+        for label in labels:
+            for property_name in RANGE_INDEX_PROPERTIES.get(label, []):
+                statements.append(build_range_index_statement(label, property_name))
+    # The summary properties are what patient lookups and time window queries read (see patient_summary).
+    for label, property_name in patient_summary.get_summary_properties().get_property_names():
+        statement = build_range_index_statement(label, property_name)
+        if label in labels and statement not in statements:
+            statements.append(statement)
+    # Purge finds the nodes of a bundle by their bundle id, and the Patient of a patient by its fullUrl.
+    if purge.get_tag_bundles():
+        for label in labels:
+            statements.append(build_range_index_statement(label, purge.BUNDLE_ID_PROPERTY))
+        if "Patient" in labels:
+            statements.append(build_range_index_statement("Patient", "fullUrl"))
+    return statements
+
+
+# Cypher statement create an index on the property of the Property nodes that holds the id of their resource node.
+# Incremental ingest deletes the Property subtree of a changed resource by this property (see incremental).
+def build_owner_index_statement(owner_property):
+    return "CREATE INDEX index_{}_{} IF NOT EXISTS FOR (n:`{}`) ON (n.`{}`)".format(
+        PROPERTY_LABEL.lower(), owner_property, PROPERTY_LABEL, owner_property)
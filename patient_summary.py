@@ -0,0 +1,168 @@
+import datetime
+import os
+
+from graph import Edge
+import property_serializer
+
+# Summary properties: values deep in a resource (e.g. name[0].given[0]) are copied onto the resource node while the
+# graph is built, so queries and Bloom read them from the node instead of walking Property nodes, e.g.
+#   MATCH (p:Patient {familyname: 'Bode'}) RETURN p.firstname, p.birthDate
+# Dates become Date and DateTime values, unless the property types are strings (see property_serializer).
+#
+# A summary file has one line per summary property: resource type, property name and one or more paths. The value of
+# the first path that has one is stored. A path is written without list indexes and takes the first item of a list,
+# e.g.
+#   Patient firstname name.given
+#   Observation event_time effectiveDateTime effectivePeriod.start issued
+#
+# Timeline: the resources of the timeline types with an event_time are linked per patient in the order of their
+# event_time, (encounter)-[:NEXT_EVENT]->(observation)-[:NEXT_EVENT]->(procedure)..., so the events before or after
+# one are one hop away. The patient of a resource is the Patient its references (subject, patient) point to.
+EVENT_TIME_PROPERTY = 'event_time'
+NEXT_EVENT_TYPE = 'NEXT_EVENT'
+DEFAULT_TIMELINE_TYPES = ('Encounter', 'Observation', 'Procedure')
+PATIENT_TYPE = 'Patient'
+
+
+# The value at a path, taking the first item of every list on the way. None if there is no value or it is an object.
+def get_path_value(resource, keys):
+    value = resource
+    for key in keys:
+        while isinstance(value, list):
+            value = value[0] if value else None
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+        if value is None:
+            return None
+    while isinstance(value, list):
+        value = value[0] if value else None
+    return None if isinstance(value, dict) else value
+
+
+# Point in time of a date or dateTime (a string or already typed) for sorting, a date at midnight UTC. None if it is
+# not a date.
+def get_sort_time(value):
+    if isinstance(value, str):
+        temporal = property_serializer.parse_temporal(value)
+        value = temporal[1] if temporal is not None else None
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc)
+    return None
+
+
+class SummaryProperties:
+    def __init__(self, file_path=None):
+        # key: resource type, value: list of (property name, list of paths split into keys).
+        self.properties = self.read_properties_from_file(file_path) if file_path else {}
+
+    def read_properties_from_file(self, file_path):
+        properties = {}
+        with open(file_path, 'r') as file:
+            for line in file:
+                tokens = line.strip().split()
+                # Lines starting with '#' are comments
+                if not tokens or tokens[0].startswith('#'):
+                    continue
+                if len(tokens) < 3:
+                    raise ValueError(f"Invalid line in summary file {file_path}: {line.strip()}")
+                properties.setdefault(tokens[0], []).append((tokens[1], [path.split('.') for path in tokens[2:]]))
+        return properties
+
+    def get_properties(self):
+        return self.properties
+
+    # Return a list of (resource type, property name) of all summary properties.
+    def get_property_names(self):
+        return [(resource_type, name) for resource_type, summaries in self.properties.items()
+                for name, paths in summaries]
+
+    # Return a dict with the summary properties of one resource. Dates are typed unless the property types are
+    # strings.
+    def compute(self, resource_type, resource):
+        summaries = self.properties.get(resource_type)
+        if not summaries:
+            return {}
+        typed = property_serializer.get_property_types() != property_serializer.STRING
+        summary = {}
+        for name, paths in summaries:
+            for keys in paths:
+                value = get_path_value(resource, keys)
+                if value is not None:
+                    if typed and isinstance(value, str):
+                        temporal = property_serializer.parse_temporal(value)
+                        if temporal is not None:
+                            value = temporal[1]
+                    summary[name] = value
+                    break
+        return summary
+
+
+# Link the events of every patient in a graph with NEXT_EVENT edges, in the order of their event_time. Must be
+# called before build_property_nodes_for_each_node, while the resource nodes still have their json.
+# timeline_types: the resource types of the events.
+def add_timeline_edges(graph, summary_properties, timeline_types=DEFAULT_TIMELINE_TYPES):
+    timeline_types = set(timeline_types)
+    # The first Patient that each event refers to.
+    patients = {}
+    for edge in graph.get_edges():
+        source_node = edge.get_source_node()
+        if (source_node.get_node_type() in timeline_types and source_node not in patients
+                and edge.get_target_node().get_node_type() == PATIENT_TYPE):
+            patients[source_node] = edge.get_target_node()
+    events_by_patient = {}
+    for position, node in enumerate(graph.get_nodes_properties_nested().values()):
+        patient = patients.get(node)
+        if patient is None:
+            continue
+        event_time = summary_properties.compute(node.get_node_type(), node.get_properties()).get(EVENT_TIME_PROPERTY)
+        sort_time = get_sort_time(event_time)
+        if sort_time is not None:
+            # The position keeps events at the same time in the order of the bundle.
+            events_by_patient.setdefault(patient, []).append((sort_time, position, node))
+    number_of_edges = 0
+    for events in events_by_patient.values():
+        events.sort(key=lambda event: (event[0], event[1]))
+        for (_, _, node), (_, _, next_node) in zip(events, events[1:]):
+            graph.add_edge(Edge(node, next_node, NEXT_EVENT_TYPE))
+            number_of_edges += 1
+    return number_of_edges
+
+
+# Like the property modes (see property_mode.get_property_modes), every summary file is read once per process.
+# None means no file: no summary properties and no timeline.
+summary_properties_cache = {}
+default_summary_file_path = None
+timeline = False
+
+
+def set_default_summary_file_path(file_path):
+    global default_summary_file_path
+    default_summary_file_path = file_path
+
+
+def get_default_summary_file_path():
+    return default_summary_file_path
+
+
+def set_timeline(enabled):
+    global timeline
+    timeline = enabled
+
+
+def get_timeline():
+    return timeline
+
+
+# Return the SummaryProperties of a file. file_path=None uses the default file.
+def get_summary_properties(file_path=None):
+    path = file_path if file_path else default_summary_file_path
+    path = os.path.abspath(path) if path else None
+    mtime = os.path.getmtime(path) if path else None
+    cached = summary_properties_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, SummaryProperties(path))
+        summary_properties_cache[path] = cached
+    return cached[1]
@@ -0,0 +1,561 @@
+# Pipelined ingest: convert bundles in a pool of worker processes while other bundles are being uploaded.
+#
+# Conversion (graph_helper + cypher_generator) is pure CPU work, so it runs in a bounded process pool.
+# The workers only return picklable data (cypher statements and (query, rows) batches), never the Graph.
+# The main process takes the converted bundles in the order of the input list, saves the Cypher file and puts
+# them on a bounded queue. One or more upload threads take the bundles from the queue and send them to Neo4j,
+# so bundle N+1 is converted while bundle N is uploading.
+#
+# run_async_pipeline does the same on one asyncio event loop with neo4j_driver.AsyncNeo4jDriver: the upload
+# coroutines share the loop with the conversion, which runs in an executor, and each upload waits on the network
+# without blocking the others.
+#
+# A source is either the path of a Bundle json file or an ndjson_reader.NdjsonRange.
+import asyncio
+import functools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import batch_artifact
+import conversion_cache
+import cypher_generator
+import graph_helper
+import instrumentation
+import ndjson_reader
+import patient_summary
+import neo4j_schema
+import projection
+import property_mode
+import property_serializer
+import purge
+import resource_registry
+import rule
+import terminology
+
+
+# The result of converting one source. It is sent from a worker process to the main process.
+class ConvertedBundle:
+    def __init__(self, source, cypher_statements, batches, labels):
+        self.source = source
+        self.cypher_statements = cypher_statements
+        self.batches = batches
+        self.labels = labels
+        # True if it was read from the conversion cache, False if it was converted and cached, None without cache.
+        self.cache_hit = None
+        # The instrumentation metrics of the conversion in a worker process, None in the main process.
+        self.metrics = None
+        # The ids of the Code nodes that the bundle writes in full with shared codes (see terminology), else None.
+        self.code_ids = None
+
+    def get_source(self):
+        return self.source
+
+    def get_cypher_statements(self):
+        return self.cypher_statements
+
+    def get_batches(self):
+        return self.batches
+
+    def get_labels(self):
+        return self.labels
+
+    def get_cache_hit(self):
+        return self.cache_hit
+
+    def get_metrics(self):
+        return self.metrics
+
+    def get_code_ids(self):
+        return self.code_ids
+
+
+# Add what the main process records after the upload of the bundle has committed (see record_committed_bundle).
+def add_commit_info(bundle, graph):
+    if terminology.get_shared_codes():
+        bundle.code_ids = terminology.get_written_code_ids(graph)
+
+
+# Runs after the upload of a bundle has committed: its Code nodes can be skipped by the bundles that are converted
+# later in this process, and its claims in the resource registry are final.
+def record_committed_bundle(bundle):
+    if bundle.get_code_ids():
+        terminology.get_code_cache().add(bundle.get_code_ids())
+    if resource_registry.get_registry() is not None:
+        resource_registry.get_registry().commit_claims(bundle.get_source())
+
+
+# Runs after the conversion or the upload of a source has failed: the shared resources it claimed in the resource
+# registry are written by the next bundle that has them.
+def record_failed_bundle(source):
+    if resource_registry.get_registry() is not None:
+        resource_registry.get_registry().release_claims(source)
+
+
+# The settings of the conversion, built once by main.py and the same in the main process and in every worker process
+# (see init_worker). It is sent to each worker process once.
+# rule_file_path: the rules file, None uses the default rules file (see rule.get_rule).
+# property_mode_file_path: the property mode file, None stores all resources nested (see property_mode).
+# projection_file_path: the projection file, None converts everything (see projection).
+# summary_file_path, timeline: the summary properties file and the NEXT_EVENT timeline (see patient_summary).
+# shared_codes, code_cache_size: link Codings to shared Code nodes (see terminology).
+# use_registry, registry_file_path: write shared resources once and resolve references across bundles. Only a
+#                                   registry file is shared by the workers (see resource_registry).
+# cache_folder_path, cache_size: the conversion cache in bytes, shared by the workers through its folder
+#                                (see conversion_cache).
+# property_types: string, typed or temporal property values (see property_serializer).
+# tag_bundles: every node gets the id of its bundle (see purge).
+# mode, batch_size, streaming: what convert_bundle produces, and how it reads a Bundle json file.
+# cypher_dump: save the Cypher file of every source. artifact_format: also save a batch artifact (see batch_artifact).
+class ConversionSettings:
+    def __init__(self, rule_file_path=None, property_mode_file_path=None, projection_file_path=None,
+                 summary_file_path=None, timeline=False, shared_codes=False,
+                 code_cache_size=terminology.DEFAULT_CACHE_SIZE, use_registry=False, registry_file_path=None,
+                 cache_folder_path=None, cache_size=conversion_cache.DEFAULT_MAX_SIZE,
+                 property_types=property_serializer.TYPED, tag_bundles=False, mode="statement",
+                 batch_size=cypher_generator.DEFAULT_BATCH_SIZE, streaming=False, cypher_dump=True,
+                 artifact_format=None):
+        self.rule_file_path = rule_file_path
+        self.property_mode_file_path = property_mode_file_path
+        self.projection_file_path = projection_file_path
+        self.summary_file_path = summary_file_path
+        self.timeline = timeline
+        self.shared_codes = shared_codes
+        self.code_cache_size = code_cache_size
+        self.use_registry = use_registry
+        self.registry_file_path = registry_file_path
+        self.cache_folder_path = cache_folder_path
+        self.cache_size = cache_size
+        self.property_types = property_types
+        self.tag_bundles = tag_bundles
+        self.mode = mode
+        self.batch_size = batch_size
+        self.streaming = streaming
+        self.cypher_dump = cypher_dump
+        self.artifact_format = artifact_format
+
+    def get_mode(self):
+        return self.mode
+
+    def get_batch_size(self):
+        return self.batch_size
+
+    def get_streaming(self):
+        return self.streaming
+
+    def get_cypher_dump(self):
+        return self.cypher_dump
+
+    def get_artifact_format(self):
+        return self.artifact_format
+
+    # Set the settings of the conversion modules in this process, and load the rules, property modes, projection
+    # and summary properties once, not once per bundle. Every process has its own code cache (see terminology).
+    def apply(self):
+        if self.rule_file_path:
+            rule.set_default_rule_file_path(self.rule_file_path)
+        rule.get_rule()
+        property_mode.set_default_property_mode_file_path(self.property_mode_file_path)
+        property_mode.get_property_modes()
+        projection.set_default_projection_file_path(self.projection_file_path)
+        projection.get_projection()
+        patient_summary.set_default_summary_file_path(self.summary_file_path)
+        patient_summary.set_timeline(self.timeline)
+        patient_summary.get_summary_properties()
+        terminology.set_shared_codes(self.shared_codes, self.code_cache_size)
+        property_serializer.set_property_types(self.property_types)
+        purge.set_tag_bundles(self.tag_bundles)
+        if self.use_registry:
+            resource_registry.set_registry(resource_registry.ResourceRegistry(self.registry_file_path))
+        if self.cache_folder_path:
+            conversion_cache.set_conversion_cache(conversion_cache.ConversionCache(self.cache_folder_path,
+                                                                                   self.cache_size))
+        conversion_cache.update_config_digest()
+
+
+# Initializer of every worker process: the reference index and the settings are sent once per process.
+def init_worker(reference_index, settings):
+    ndjson_reader.set_reference_index(reference_index)
+    instrumentation.set_worker_process(True)
+    settings.apply()
+
+
+# Convert one source to a graph with property nodes.
+# streaming: read a Bundle json file entry by entry (see json_stream).
+# use_cache: read the graph from the conversion cache if there is one, and add it if it is not there yet.
+def convert_source_to_graph(source, streaming=False, use_cache=True):
+    if isinstance(source, ndjson_reader.NdjsonRange):
+        return ndjson_reader.convert_ndjson_range_to_graph(source)
+    cache = conversion_cache.get_conversion_cache()
+    cache_key = None
+    if use_cache and conversion_cache.is_cacheable(source):
+        cache_key = cache.make_key(source, "graph")
+        graph = cache.get(cache_key)
+        if graph is not None:
+            return graph
+    # References to resources of earlier bundles are resolved with the resource registry, if there is one.
+    registry = resource_registry.get_registry()
+    resolve_external = registry.resolve if registry is not None else None
+    if streaming:
+        graph = graph_helper.convert_json_stream_to_graph(source, resolve_external=resolve_external)
+    else:
+        graph = graph_helper.convert_json_to_graph(source, resolve_external=resolve_external)
+    graph_helper.build_property_nodes_for_each_node(graph)
+    if purge.get_tag_bundles():
+        purge.tag_bundle_nodes(graph)
+    if registry is not None:
+        registry.add_graph(graph, source)
+    if cache_key is not None:
+        cache.put(cache_key, graph)
+    return graph
+
+
+# Name of a source, used for the Cypher file, e.g. Abbott_Buena_66 or Observation_0.
+def get_source_name(source):
+    if isinstance(source, ndjson_reader.NdjsonRange):
+        return source.get_name()
+    return os.path.splitext(os.path.basename(source))[0]
+
+
+# Runs in a worker process. The graph never leaves the worker, only statements and batches do.
+# A worker process sends the instrumentation metrics of the bundle with it, the main process merges them.
+def convert_bundle(source, batch_size, mode, streaming=False, cypher_dump=True, artifact_format=None):
+    if instrumentation.is_worker_process():
+        instrumentation.get_metrics().reset()
+    bundle = convert_bundle_with_cache(source, batch_size, mode, streaming, cypher_dump, artifact_format)
+    if instrumentation.is_worker_process():
+        bundle.metrics = instrumentation.get_metrics().snapshot()
+    return bundle
+
+
+# The statements are only built if they are uploaded or saved (cypher_dump), the batches only if they are uploaded
+# or saved as a batch artifact.
+# With a conversion cache, the whole ConvertedBundle is cached: reading it is much faster than building the
+# statements and batches again from a cached graph.
+def convert_bundle_with_cache(source, batch_size, mode, streaming=False, cypher_dump=True, artifact_format=None):
+    build_statements = mode != "batch" or cypher_dump
+    build_batches = mode == "batch" or bool(artifact_format)
+    cache = conversion_cache.get_conversion_cache()
+    cache_key = None
+    if conversion_cache.is_cacheable(source):
+        cache_key = cache.make_key(source, f"bundle statements={build_statements} "
+                                           f"batches={batch_size if build_batches else None}")
+        bundle = cache.get(cache_key)
+        if bundle is not None:
+            # The same bundle can have been cached under another path.
+            bundle.source = source
+            bundle.cache_hit = True
+            return bundle
+    graph = convert_source_to_graph(source, streaming, use_cache=False)
+    cypher_statements = None
+    if build_statements:
+        cypher_statements = (cypher_generator.convert_all_nodes_to_cypher(graph) +
+                             cypher_generator.convert_all_edges_to_cypher(graph))
+    batches = None
+    if build_batches:
+        batches = cypher_generator.convert_graph_to_batches(graph, batch_size)
+    bundle = ConvertedBundle(source, cypher_statements, batches, neo4j_schema.collect_graph_labels(graph))
+    add_commit_info(bundle, graph)
+    if cache_key is not None:
+        cache.put(cache_key, bundle)
+        bundle.cache_hit = False
+    return bundle
+
+
+def get_cypher_file_path(source, cypher_folder_path):
+    return f'{cypher_folder_path}/Cypher_{get_source_name(source)}.txt'
+
+
+# Save the Cypher file (cypher_dump) and the batch artifact (artifact_format, see batch_artifact) of a converted
+# bundle in cypher_folder_path.
+def save_converted_bundle(bundle, cypher_folder_path, cypher_dump=True, artifact_format=None):
+    source = bundle.get_source()
+    if cypher_dump:
+        cypher_generator.save_cypher_statements_to_file(bundle.get_cypher_statements(),
+                                                        get_cypher_file_path(source, cypher_folder_path))
+    if artifact_format:
+        batch_artifact.save_batches_to_file(
+            bundle.get_batches(),
+            batch_artifact.get_artifact_file_path(get_source_name(source), cypher_folder_path, artifact_format),
+            bundle.get_labels())
+
+
+# Return start_chunk and on_commit for the upload of a bundle with a checkpoint journal (see checkpoint): the upload
+# continues after the transactions that were committed before, and every commit is saved in the journal.
+def get_checkpoint_arguments(bundle, journal=None):
+    if journal is None:
+        return 0, None
+    source = bundle.get_source()
+    return journal.get_committed_chunks(source), lambda committed, total: journal.save_chunk(source, committed, total)
+
+
+# Start the upload of a converted bundle with the checkpoint arguments of the journal, and return what the driver
+# returns: nothing for a neo4j_driver.Neo4jDriver, a coroutine for an AsyncNeo4jDriver.
+# mode: "batch" uploads the batches of a bundle, "statement" its Cypher statements.
+def start_upload(driver, bundle, mode, journal):
+    start_chunk, on_commit = get_checkpoint_arguments(bundle, journal)
+    if mode == "batch":
+        return driver.run_cypher_batches(bundle.get_batches(), start_chunk=start_chunk, on_commit=on_commit)
+    return driver.run_cypher_queries(bundle.get_cypher_statements(), start_chunk=start_chunk, on_commit=on_commit)
+
+
+# Record the end of the upload of a bundle, and save in the journal whether it is done or failed.
+# error: the exception of a failed upload.
+def finish_upload(bundle, journal, error=None):
+    if error is not None:
+        record_failed_bundle(bundle.get_source())
+        if journal is not None:
+            journal.save_failed(bundle.get_source(), error)
+        return
+    record_committed_bundle(bundle)
+    if journal is not None:
+        journal.save_done(bundle.get_source())
+
+
+# Upload a converted bundle, and save in the journal whether it is done or failed.
+def upload_bundle(driver, bundle, mode="statement", journal=None):
+    try:
+        start_upload(driver, bundle, mode, journal)
+    except Exception as e:
+        finish_upload(bundle, journal, e)
+        raise
+    finish_upload(bundle, journal)
+
+
+# upload_bundle with a neo4j_driver.AsyncNeo4jDriver.
+async def async_upload_bundle(driver, bundle, mode="statement", journal=None):
+    try:
+        await start_upload(driver, bundle, mode, journal)
+    except Exception as e:
+        finish_upload(bundle, journal, e)
+        raise
+    finish_upload(bundle, journal)
+
+
+# Print and log the end of the upload of a bundle by an upload worker, and add the source to failures if the upload
+# failed with error.
+def report_upload(bundle, start, failures, error=None):
+    if error is None:
+        print(f"Cypher statements of {bundle.get_source()} have been uploaded to Neo4j database")
+    else:
+        print(f"Failed to upload {bundle.get_source()}: {error}")
+        failures.append(bundle.get_source())
+    record_uploaded_bundle(bundle, time.perf_counter() - start, error)
+
+
+# Upload thread: take converted bundles from the queue until it gets None.
+def upload_worker(driver, upload_queue, failures, mode="statement", journal=None):
+    while True:
+        bundle = upload_queue.get()
+        if bundle is None:
+            upload_queue.task_done()
+            break
+        start = time.perf_counter()
+        try:
+            upload_bundle(driver, bundle, mode, journal)
+            report_upload(bundle, start, failures)
+        except Exception as e:
+            report_upload(bundle, start, failures, e)
+        finally:
+            upload_queue.task_done()
+
+
+# Merge the metrics of the worker process that converted the bundle, and log the bundle_converted event.
+def record_converted_bundle(bundle):
+    if bundle.get_metrics() is not None:
+        instrumentation.get_metrics().merge(bundle.get_metrics())
+    instrumentation.add_count("bundles_converted")
+    instrumentation.log_event("bundle_converted", source=bundle.get_source(), cache_hit=bundle.get_cache_hit(),
+                              statements=len(bundle.get_cypher_statements() or []),
+                              batches=len(bundle.get_batches() or []))
+
+
+# Log the bundle_uploaded event, or bundle_upload_failed if error is given.
+def record_uploaded_bundle(bundle, seconds, error=None):
+    if error is None:
+        instrumentation.add_count("bundles_uploaded")
+        instrumentation.log_event("bundle_uploaded", source=bundle.get_source(), seconds=round(seconds, 6))
+    else:
+        instrumentation.add_count("bundles_failed")
+        instrumentation.log_event("bundle_upload_failed", source=bundle.get_source(), seconds=round(seconds, 6),
+                                  error=str(error))
+
+
+# The conversion side that run_pipeline and run_async_pipeline share: it submits the conversion of the sources,
+# at most max_pending at a time, and handles the converted bundles in the order of source_list. The pipelines only
+# differ in the executor and in the driver calls.
+class PipelineRun:
+    def __init__(self, source_list, cypher_folder_path, settings, max_pending):
+        self.source_list = source_list
+        self.cypher_folder_path = cypher_folder_path
+        self.settings = settings
+        self.max_pending = max_pending
+        self.pending = []
+        self.next_index = 0
+        self.processed_sources = 0
+        # The upload workers add the sources that failed to upload to the same list.
+        self.failures = []
+        self.cache_hits = []
+
+    def get_failures(self):
+        return self.failures
+
+    def get_cache_hits(self):
+        return self.cache_hits
+
+    def has_sources(self):
+        return self.next_index < len(self.source_list) or len(self.pending) > 0
+
+    # Submit the conversion of the next sources while fewer than max_pending are pending.
+    # submit(function, *args) runs the function in an executor and returns a future.
+    def submit_conversions(self, submit):
+        settings = self.settings
+        while self.next_index < len(self.source_list) and len(self.pending) < self.max_pending:
+            source = self.source_list[self.next_index]
+            self.pending.append((source, submit(convert_bundle, source, settings.get_batch_size(), settings.get_mode(),
+                                                settings.get_streaming(), settings.get_cypher_dump(),
+                                                settings.get_artifact_format())))
+            self.next_index += 1
+
+    # Take the oldest pending conversion, so the files and uploads follow the order of source_list.
+    # Returns the source and its future.
+    def next_conversion(self):
+        self.processed_sources += 1
+        return self.pending.pop(0)
+
+    # Save a converted bundle and return it, or record the error of a failed conversion and return None.
+    def add_converted(self, source, bundle, error=None):
+        if error is not None:
+            print(f"Failed to convert {source}: {error}")
+            self.failures.append(source)
+            record_failed_bundle(source)
+            return None
+        save_converted_bundle(bundle, self.cypher_folder_path, self.settings.get_cypher_dump(),
+                              self.settings.get_artifact_format())
+        print(f"Converted {self.processed_sources}/{len(self.source_list)}: {source}")
+        self.cache_hits.append(bundle.get_cache_hit())
+        record_converted_bundle(bundle)
+        return bundle
+
+    # Set the gauges after a bundle was put on the upload queue.
+    def record_queued(self, upload_queue_depth):
+        instrumentation.set_gauge("upload_queue_depth", upload_queue_depth)
+        instrumentation.set_gauge("pending_conversions", len(self.pending))
+
+
+# Convert and upload all sources. Returns the list of sources that failed.
+# settings: the ConversionSettings of the conversion, which the main process has applied.
+# workers: number of conversion processes.
+# upload_concurrency: number of upload threads, each with its own Neo4j session.
+# schema: "index", "constraint" or "none", see neo4j_schema.
+# reference_index: the ndjson_reader.ReferenceIndex for NdjsonRange sources. It is sent to each worker process once.
+# journal: a checkpoint.CheckpointJournal that records the committed transactions of every bundle, or None.
+def run_pipeline(source_list, driver, cypher_folder_path, settings, workers=2, upload_concurrency=1, schema="index",
+                 reference_index=None, journal=None):
+    # Both bounds keep memory flat: at most 2 * workers converted bundles wait in the pool,
+    # and at most 2 * upload_concurrency wait for an upload thread.
+    run = PipelineRun(source_list, cypher_folder_path, settings, 2 * workers)
+    upload_queue = queue.Queue(maxsize=2 * upload_concurrency)
+    uploaders = [threading.Thread(target=upload_worker,
+                                  args=(driver, upload_queue, run.get_failures(), settings.get_mode(), journal))
+                 for _ in range(upload_concurrency)]
+    for uploader in uploaders:
+        uploader.start()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(reference_index, settings)) as executor:
+            while run.has_sources():
+                run.submit_conversions(executor.submit)
+                source, future = run.next_conversion()
+                try:
+                    bundle, error = future.result(), None
+                except Exception as e:
+                    bundle, error = None, e
+                bundle = run.add_converted(source, bundle, error)
+                if bundle is None:
+                    continue
+                if schema != "none":
+                    driver.ensure_schema(bundle.get_labels(), unique=schema == "constraint")
+                upload_queue.put(bundle)
+                run.record_queued(upload_queue.qsize())
+    finally:
+        for _ in uploaders:
+            upload_queue.put(None)
+        for uploader in uploaders:
+            uploader.join()
+    print_cache_statistics(run.get_cache_hits())
+    return run.get_failures()
+
+
+# Print the conversion cache hits and misses of the converted bundles (see ConvertedBundle.get_cache_hit). The
+# workers count them in their own process, so the main process counts them from the bundles.
+def print_cache_statistics(cache_hits):
+    if any(cache_hit is not None for cache_hit in cache_hits):
+        print(f"Conversion cache: {cache_hits.count(True)} hits, {cache_hits.count(False)} misses")
+
+
+# Upload coroutine: take converted bundles from the queue until it gets None.
+async def async_upload_worker(driver, upload_queue, failures, mode="statement", journal=None):
+    while True:
+        bundle = await upload_queue.get()
+        if bundle is None:
+            break
+        start = time.perf_counter()
+        try:
+            await async_upload_bundle(driver, bundle, mode, journal)
+            report_upload(bundle, start, failures)
+        except Exception as e:
+            report_upload(bundle, start, failures, e)
+
+
+# Convert and upload all sources on the running event loop. Returns the list of sources that failed.
+# driver: a connected neo4j_driver.AsyncNeo4jDriver.
+# workers: number of conversion processes. 0 converts in one thread of the main process, see below.
+# upload_concurrency: number of upload coroutines, i.e. bundles that are uploaded at the same time, each in its
+#                     own session and transaction.
+# The other arguments are the same as for run_pipeline.
+async def run_async_pipeline(source_list, driver, cypher_folder_path, settings, workers=0, upload_concurrency=2,
+                             schema="index", reference_index=None, journal=None):
+    loop = asyncio.get_running_loop()
+    # The bounded queue is the backpressure: conversion waits while 2 * upload_concurrency bundles wait for upload.
+    run = PipelineRun(source_list, cypher_folder_path, settings, 2 * max(workers, 1))
+    upload_queue = asyncio.Queue(maxsize=2 * upload_concurrency)
+    uploaders = [asyncio.create_task(async_upload_worker(driver, upload_queue, run.get_failures(),
+                                                         settings.get_mode(), journal))
+                 for _ in range(upload_concurrency)]
+    if workers > 0:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                       initargs=(reference_index, settings))
+    else:
+        # With workers 0 the conversion shares the process, and so the resource registry of --registry without a
+        # file, with the event loop. It runs in a single thread, so two conversions never run at the same time.
+        # The event loop only reads the settings, which ConversionSettings.apply set before, and shares the
+        # resource registry, the code cache of --shared-codes and the metrics with the conversion thread, which
+        # all take a lock.
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        while run.has_sources():
+            run.submit_conversions(functools.partial(loop.run_in_executor, executor))
+            source, future = run.next_conversion()
+            try:
+                bundle, error = await future, None
+            except Exception as e:
+                bundle, error = None, e
+            bundle = run.add_converted(source, bundle, error)
+            if bundle is None:
+                continue
+            if schema != "none":
+                await driver.ensure_schema(bundle.get_labels(), unique=schema == "constraint")
+            await upload_queue.put(bundle)
+            run.record_queued(upload_queue.qsize())
+    finally:
+        for _ in uploaders:
+            await upload_queue.put(None)
+        await asyncio.gather(*uploaders)
+        executor.shutdown()
+    print_cache_statistics(run.get_cache_hits())
+    return run.get_failures()
@@ -0,0 +1,159 @@
+import os
+import rule
+
+# Projection: the resource types and JSON paths that are converted. Everything else is dropped while the entries are
+# read (see graph_helper.group_resources_by_type and ndjson_reader), so it never becomes a node, a Property node or a
+# Cypher statement. e.g. the narrative html in text.div, Provenance resources or the items of Claims.
+#
+# A projection file has one rule per line:
+#   exclude Provenance                          resource types that are dropped
+#   include Patient Observation Condition       only these resource types are kept (all if there is no include line)
+#   deny * text extension                       JSON paths that are dropped, for every resource type ('*') or one
+#   deny Claim item
+#   allow Patient name gender birthDate         only these JSON paths are kept
+# A path starts at the resource and is written without list indexes, e.g. component.valueQuantity.value. Denied paths
+# of '*' and of the resource type are both dropped. Allowed paths of the resource type replace those of '*'.
+# resourceType and id are always kept.
+# A reference in a dropped path is dropped with it, so the graph has no edge for it.
+INCLUDE = 'include'
+EXCLUDE = 'exclude'
+ALLOW = 'allow'
+DENY = 'deny'
+ALWAYS_KEPT_PATHS = ('resourceType', 'id')
+
+# Marks the end of a path in a path tree.
+END = None
+
+
+# Tree of dicts of the keys of the paths, e.g. ['text.div', 'text.status'] -> {'text': {'div': {END: True}, ...}}.
+def add_path_to_tree(tree, path):
+    node = tree
+    for key in path.split('.'):
+        node = node.setdefault(key, {})
+    node[END] = True
+
+
+# Project a value with the subtrees of the denied and the allowed paths at its position. deny or allow is None if no
+# path goes through the position. Returns the projected value, which shares the parts without paths with the original,
+# or None if nothing of an object or a list is left.
+def project_value(value, deny, allow):
+    if isinstance(value, dict):
+        projected = {}
+        for key, child in value.items():
+            deny_child = deny.get(key) if deny is not None else None
+            if deny_child is not None and END in deny_child:
+                continue
+            allow_child = None
+            if allow is not None:
+                allow_child = allow.get(key)
+                if allow_child is None:
+                    continue
+                if END in allow_child:
+                    # The whole subtree is allowed.
+                    allow_child = None
+            if deny_child is None and allow_child is None:
+                projected[key] = child
+                continue
+            child = project_value(child, deny_child, allow_child)
+            if child is not None:
+                projected[key] = child
+        return projected if projected else None
+    if isinstance(value, list):
+        projected = [item for item in (project_value(item, deny, allow) for item in value) if item is not None]
+        return projected if projected else None
+    return value
+
+
+class Projection:
+    def __init__(self, file_path=None):
+        self.included_types = None
+        self.excluded_types = set()
+        # key: resource type or '*', value: list of paths.
+        self.denied_paths = {}
+        self.allowed_paths = {}
+        if file_path:
+            self.read_projection_from_file(file_path)
+        # key: resource type, value: (deny tree, allow tree), built on first use.
+        self.path_trees = {}
+
+    def read_projection_from_file(self, file_path):
+        with open(file_path, 'r') as file:
+            for line in file:
+                tokens = line.strip().split()
+                # Lines starting with '#' are comments
+                if not tokens or tokens[0].startswith('#'):
+                    continue
+                if tokens[0] == INCLUDE and len(tokens) >= 2:
+                    self.included_types = (self.included_types or set()) | set(tokens[1:])
+                elif tokens[0] == EXCLUDE and len(tokens) >= 2:
+                    self.excluded_types.update(tokens[1:])
+                elif tokens[0] == DENY and len(tokens) >= 3:
+                    self.denied_paths.setdefault(tokens[1], []).extend(tokens[2:])
+                elif tokens[0] == ALLOW and len(tokens) >= 3:
+                    self.allowed_paths.setdefault(tokens[1], []).extend(tokens[2:])
+                else:
+                    raise ValueError(f"Invalid line in projection file {file_path}: {line.strip()}")
+
+    def is_empty(self):
+        return (self.included_types is None and not self.excluded_types and not self.denied_paths
+                and not self.allowed_paths)
+
+    def is_type_included(self, resource_type):
+        if resource_type in self.excluded_types:
+            return False
+        return self.included_types is None or resource_type in self.included_types
+
+    # An NDJSON file of a bulk export holds one resource type, named by the file, e.g. Provenance.ndjson or
+    # Provenance.001.ndjson. A file of a dropped type is not read at all.
+    def is_ndjson_file_included(self, ndjson_path):
+        return self.is_type_included(os.path.basename(ndjson_path).split('.')[0])
+
+    def get_path_trees(self, resource_type):
+        trees = self.path_trees.get(resource_type)
+        if trees is None:
+            deny_tree = {}
+            for path in self.denied_paths.get(rule.WILDCARD, []) + self.denied_paths.get(resource_type, []):
+                add_path_to_tree(deny_tree, path)
+            allowed_paths = self.allowed_paths.get(resource_type, self.allowed_paths.get(rule.WILDCARD))
+            allow_tree = None
+            if allowed_paths:
+                allow_tree = {}
+                for path in list(allowed_paths) + list(ALWAYS_KEPT_PATHS):
+                    add_path_to_tree(allow_tree, path)
+            trees = (deny_tree or None, allow_tree)
+            self.path_trees[resource_type] = trees
+        return trees
+
+    # Return the resource without the dropped paths. A resource without paths to drop is returned as it is.
+    def project_resource(self, resource):
+        deny_tree, allow_tree = self.get_path_trees(resource.get('resourceType', ''))
+        if deny_tree is None and allow_tree is None:
+            return resource
+        return project_value(resource, deny_tree, allow_tree) or {}
+
+
+# Like the property modes (see property_mode.get_property_modes), every projection file is read once per process.
+# None means no file: everything is kept.
+projection_cache = {}
+default_projection_file_path = None
+
+
+def set_default_projection_file_path(file_path):
+    global default_projection_file_path
+    default_projection_file_path = file_path
+
+
+def get_default_projection_file_path():
+    return default_projection_file_path
+
+
+# Return the Projection of a file. file_path=None uses the default file.
+def get_projection(file_path=None):
+    path = file_path if file_path else default_projection_file_path
+    path = os.path.abspath(path) if path else None
+    mtime = os.path.getmtime(path) if path else None
+    cached = projection_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, Projection(path))
+        projection_cache[path] = cached
+    return cached[1]
@@ -0,0 +1,72 @@
+
+import os
+import rule
+
+# How the nested properties (objects and lists) of a resource are stored:
+#   nested: every object, list and list item becomes a Property node with an edge from its parent
+#           (see graph_helper.unnest_one_node_properties_to_simple_nodes). This is the default.
+#   flat:   the values are stored on the resource node itself, with their path as the property name,
+#           e.g. code.coding.0.code, valueQuantity.value (see graph_helper.flatten_one_node_properties).
+#           Promoted paths are still stored as Property nodes.
+NESTED = 'nested'
+FLAT = 'flat'
+MODES = (NESTED, FLAT)
+
+
+# A property mode file has one line per resource type: resource type, mode and the promoted paths, e.g.
+#   Observation flat code.coding category.coding
+#   * nested
+# A promoted path is written without list indexes. '*' is used for resource types without a line of their own.
+class PropertyModes:
+    def __init__(self, file_path=None):
+        self.modes = self.read_modes_from_file(file_path) if file_path else {}
+
+    def read_modes_from_file(self, file_path):
+        modes = {}
+        with open(file_path, 'r') as file:
+            for line in file:
+                tokens = line.strip().split()
+                # Lines starting with '#' are comments
+                if not tokens or tokens[0].startswith('#'):
+                    continue
+                if len(tokens) < 2 or tokens[1] not in MODES:
+                    raise ValueError(f"Invalid line in property mode file {file_path}: {line.strip()}")
+                modes[tokens[0]] = (tokens[1], frozenset(tokens[2:]))
+        return modes
+
+    def get_modes(self):
+        return self.modes
+
+    # Return (mode, promoted paths) of a resource type.
+    def get_mode(self, resource_type):
+        mode = self.modes.get(resource_type)
+        if mode is None:
+            mode = self.modes.get(rule.WILDCARD, (NESTED, frozenset()))
+        return mode
+
+
+# Like the rules (see rule.get_rule), every property mode file is read once per process.
+# None means no file: every resource type is nested.
+property_modes_cache = {}
+default_property_mode_file_path = None
+
+
+def set_default_property_mode_file_path(file_path):
+    global default_property_mode_file_path
+    default_property_mode_file_path = file_path
+
+
+def get_default_property_mode_file_path():
+    return default_property_mode_file_path
+
+
+# Return the PropertyModes of a file. file_path=None uses the default file.
+def get_property_modes(file_path=None):
+    path = file_path if file_path else default_property_mode_file_path
+    path = os.path.abspath(path) if path else None
+    mtime = os.path.getmtime(path) if path else None
+    cached = property_modes_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, PropertyModes(path))
+        property_modes_cache[path] = cached
+    return cached[1]
@@ -0,0 +1,188 @@
+# Typed property values for the Cypher statements and the parameter rows of the batches.
+#
+# How the values of the FHIR json are stored in Neo4j (--property-types):
+#   string    every value as a string, e.g. {value: '5.4', active: 'True'}. The format of earlier versions, except
+#             that backslashes and control characters are escaped (see CYPHER_STRING_ESCAPES).
+#   typed     numbers and booleans keep their type and lists stay lists, e.g. {value: 5.4, active: true}. Default.
+#   temporal  typed, and FHIR dates and dateTimes with a time zone (birthDate, effectiveDateTime, ...) become Neo4j
+#             Date and DateTime values, e.g. {birthDate: date('1990-05-12')}. Partial dates (e.g. '2020-05') and
+#             other strings stay strings.
+# A typed NaN or Infinity has no Cypher literal and is not stored (null). A list with one becomes a list of strings.
+# With typed values a range query such as WHERE p.value > 100 or WHERE o.effectiveDateTime >= datetime('2020-01-01')
+# compares numbers and dates instead of strings, and can use a range index (see neo4j_schema).
+#
+# Statements get Cypher literals (format_cypher_literal). Batches get Python values (serialize_rows), which the Neo4j
+# driver sends as typed parameters: int, float, bool, str, list, datetime.date and datetime.datetime.
+import datetime
+import math
+import re
+
+STRING = "string"
+TYPED = "typed"
+TEMPORAL = "temporal"
+PROPERTY_TYPES = (STRING, TYPED, TEMPORAL)
+
+# The FHIR date and dateTime formats that have a Neo4j type: a full date, and a dateTime with seconds and time zone.
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+DATETIME_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})')
+
+# Escapes of a string in a Cypher string literal. Only quotes were escaped before, so a backslash or a line break in
+# a value broke the statement.
+CYPHER_STRING_ESCAPES = str.maketrans({'\\': '\\\\', "'": "\\'", '\n': '\\n', '\r': '\\r', '\t': '\\t',
+                                       '\b': '\\b', '\f': '\\f'})
+# Most strings need no escape. Searching for one is much faster than translate.
+CYPHER_STRING_ESCAPE_PATTERN = re.compile(r"[\\'\n\r\t\b\f]")
+
+# These keys of a node row are set by the converter and are always strings.
+RESERVED_KEYS = frozenset(['node_name', 'id', 'fullUrl'])
+
+property_types = TYPED
+
+
+# Set the property types of this process. Worker processes do this in their initializer (see pipeline.init_worker).
+def set_property_types(types):
+    global property_types
+    if types not in PROPERTY_TYPES:
+        raise ValueError(f"Unknown property types: {types}")
+    property_types = types
+
+
+def get_property_types():
+    return property_types
+
+
+def quote_string(value):
+    if CYPHER_STRING_ESCAPE_PATTERN.search(value) is None:
+        return "'" + value + "'"
+    return "'" + value.translate(CYPHER_STRING_ESCAPES) + "'"
+
+
+# Return the Neo4j temporal function name and the Python value of a FHIR date or dateTime, or None if the string is
+# not one.
+def parse_temporal(value):
+    # Most strings are not dates, the quick check avoids the regular expressions for them.
+    if len(value) < 10 or value[4] != '-':
+        return None
+    try:
+        if DATE_PATTERN.fullmatch(value):
+            return 'date', datetime.date.fromisoformat(value)
+        if DATETIME_PATTERN.fullmatch(value):
+            return 'datetime', datetime.datetime.fromisoformat(value)
+    except ValueError:
+        # e.g. 2020-02-30
+        pass
+    return None
+
+
+# Neo4j only stores lists whose items have the same simple type. Lists of numbers stay numbers (as floats if ints
+# and floats are mixed), other mixed lists become lists of strings.
+def normalize_list(values):
+    item_types = {type(item) for item in values}
+    if float in item_types and not all(math.isfinite(item) for item in values if type(item) is float):
+        # A stored list cannot hold null, so a list with NaN or Infinity becomes a list of strings.
+        return [str(item) for item in values]
+    if len(item_types) <= 1 and item_types <= {str, bool, int, float}:
+        return list(values)
+    if item_types <= {int, float}:
+        return [float(item) for item in values]
+    return [str(item) for item in values]
+
+
+# Python value of one property for a parameter row.
+def serialize_value(value, types=None):
+    types = types or property_types
+    if isinstance(value, datetime.date):
+        # Typed summary properties (see patient_summary).
+        return value.isoformat() if types == STRING else value
+    if types == STRING:
+        return str(value)
+    if isinstance(value, str):
+        if types == TEMPORAL:
+            temporal = parse_temporal(value)
+            if temporal is not None:
+                return temporal[1]
+        return value
+    if isinstance(value, float) and not math.isfinite(value):
+        # NaN and Infinity (json.load reads NaN, Infinity and numbers like 1e400 as them) are not stored.
+        return None
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return normalize_list(value)
+    return str(value)
+
+
+# Convert the property values of the node rows of one label in place, in one pass over the rows. Returns the rows.
+def serialize_rows(rows, types=None):
+    types = types or property_types
+    if types == STRING:
+        for row in rows:
+            for key, value in row.items():
+                if type(value) is not str and key not in RESERVED_KEYS:
+                    row[key] = serialize_value(value, types)
+        return rows
+    for row in rows:
+        for key, value in row.items():
+            # Numbers, booleans and (without temporal) strings are already typed, only the rest is converted.
+            value_type = type(value)
+            if value_type is str:
+                if types == TEMPORAL and key not in RESERVED_KEYS:
+                    temporal = parse_temporal(value)
+                    if temporal is not None:
+                        row[key] = temporal[1]
+            elif value_type is float:
+                if not math.isfinite(value):
+                    row[key] = None
+            elif value_type not in (int, bool) and value is not None:
+                row[key] = serialize_value(value, types)
+    return rows
+
+
+# Cypher literal of one property value, e.g. 5.4, true, 'it\'s', ['a', 'b'] or date('1990-05-12').
+def format_cypher_literal(value, types=None):
+    types = types or property_types
+    if type(value) is str:
+        if types == TEMPORAL:
+            temporal = parse_temporal(value)
+            if temporal is not None:
+                return f"{temporal[0]}({quote_string(value)})"
+        return quote_string(value)
+    if types == STRING:
+        return quote_string(value.isoformat() if isinstance(value, datetime.date) else str(value))
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return "null"
+        # Cypher has no '+' in the exponent: 1e+20 is written 1e20.
+        return repr(value).replace('e+', 'e')
+    if isinstance(value, int):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        return f"datetime({quote_string(value.isoformat())})"
+    if isinstance(value, datetime.date):
+        return f"date({quote_string(value.isoformat())})"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(format_cypher_literal(item, types) for item in normalize_list(value)) + "]"
+    return quote_string(str(value))
+
+
+# Batch artifacts in JSON cannot hold dates. They are saved as {"$date": "1990-05-12"} or {"$datetime": "..."}
+# (encode_temporal is the default function of json.dumps, decode_temporal the object_hook of json.loads).
+def encode_temporal(value):
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'$date': value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def decode_temporal(value):
+    if len(value) == 1:
+        if '$datetime' in value:
+            return datetime.datetime.fromisoformat(value['$datetime'])
+        if '$date' in value:
+            return datetime.date.fromisoformat(value['$date'])
+    return value
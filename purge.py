@@ -0,0 +1,198 @@
+# Purge and replace the nodes of a bundle or a patient.
+#
+# With --tag-bundles every node that a bundle writes gets the id of its graph (see Graph.set_graph_id, the fullUrl of
+# the first entry, e.g. the Patient of a Synthea bundle) in the property BUNDLE_ID_PROPERTY, with a range index per
+# label (see neo4j_schema), so the nodes of one bundle are found by index seeks instead of a scan of the database:
+#   python purge.py --bundle-id 2e27c71e_30c8_4ceb_8c1c_5641e066c0a4
+#   python purge.py --patient-id 2e27c71e-30c8-4ceb-8c1c-5641e066c0a4
+#   python purge.py --json-file "FHIR Data/FHIR JSON/Abbott_Pok_14.json"
+#   python main.py --replace --json-folder corrected/        (purge the bundles of the files, then ingest them again)
+# The nodes of a patient are the nodes of the bundles that wrote its Patient node or a node that refers to it.
+#
+# One MATCH ... DETACH DELETE of a whole bundle holds all its nodes, relationships and locks in one transaction and
+# can run out of transaction memory. The ids of the nodes are read first, and the nodes are deleted in batches of
+# batch_size rows, each batch in its own transaction, concurrency transactions at the same time. Property nodes are
+# deleted before the resource nodes, so fewer transactions wait for the locks of the same resource. A transaction
+# that fails with a transient error (e.g. a deadlock between two batches) is tried again by the driver, and split
+# with --adaptive (see upload_controller).
+# Nodes that all bundles share (Code nodes, see terminology) are not tagged and never purged. Resources that the
+# registry (see resource_registry) writes once belong to the first bundle, so --replace does not work with --registry.
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import cypher_generator
+import graph_helper
+import instrumentation
+import json_stream
+import neo4j_schema
+import property_serializer
+from graph import Graph
+
+BUNDLE_ID_PROPERTY = "bundle_id"
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_CONCURRENCY = 4
+
+tag_bundles = False
+
+
+# Set whether the nodes get their bundle id. Worker processes do this in their initializer (see pipeline.init_worker).
+def set_tag_bundles(enabled):
+    global tag_bundles
+    tag_bundles = enabled
+
+
+def get_tag_bundles():
+    return tag_bundles
+
+
+# Add the bundle id to every node of a graph. Shared nodes are not written by one bundle and are not tagged.
+def tag_bundle_nodes(graph):
+    bundle_id = graph.get_graph_id()
+    if not bundle_id:
+        return
+    for node in graph.get_nodes_properties_unnested():
+        node.add_node_property({BUNDLE_ID_PROPERTY: bundle_id})
+
+
+# Bundle id of a Bundle json file: the graph id of the fullUrl of its first entry. None if it has no entries.
+def get_bundle_id(json_path):
+    try:
+        first_entry = next(json_stream.iter_bundle_entries(json_path), None)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read the bundle id of {json_path}: {e}")
+        return None
+    if first_entry is None:
+        return None
+    graph = Graph()
+    graph.set_graph_id(first_entry.get("fullUrl", ""))
+    return graph.get_graph_id()
+
+
+# Return the ids of the bundles that wrote a Patient node of the patient with this resource id, or a node with a
+# reference edge to it. The Patient node has the fullUrl of its entry, or the id Patient_<id> with --incremental.
+def find_patient_bundle_ids(driver, patient_id):
+    query = ("MATCH (p:Patient) WHERE p.fullUrl IN $full_urls RETURN p.{0} AS bundle_id "
+             "UNION MATCH (p:Patient {{id: $node_id}}) RETURN p.{0} AS bundle_id "
+             "UNION MATCH (n)-->(p:Patient) WHERE p.fullUrl IN $full_urls RETURN n.{0} AS bundle_id "
+             "UNION MATCH (n)-->(p:Patient {{id: $node_id}}) RETURN n.{0} AS bundle_id").format(BUNDLE_ID_PROPERTY)
+    records = driver.run_read_query(query, full_urls=[f"urn:uuid:{patient_id}", f"Patient/{patient_id}"],
+                                    node_id=graph_helper.make_node_id("Patient", patient_id))
+    return sorted({record["bundle_id"] for record in records if record["bundle_id"]})
+
+
+# Return the labels with an index on BUNDLE_ID_PROPERTY (see neo4j_schema). Only these labels have tagged nodes.
+def find_tagged_labels(driver):
+    query = ("SHOW INDEXES YIELD entityType, labelsOrTypes, properties "
+             "WHERE entityType = 'NODE' AND properties = [$property] RETURN labelsOrTypes[0] AS label")
+    return sorted({record["label"] for record in driver.run_read_query(query, property=BUNDLE_ID_PROPERTY)})
+
+
+# Return a dict, key is a node label, value is the list of ids of the nodes of the bundle with this label.
+# labels: the labels to search, see find_tagged_labels. One query finds the nodes of all labels with index seeks.
+def find_bundle_node_ids(driver, bundle_id, labels):
+    if not labels:
+        return {}
+    query = " UNION ALL ".join("MATCH (n:`{}` {{{}: $bundle_id}}) RETURN {} AS label, n.id AS id".format(
+        label, BUNDLE_ID_PROPERTY, property_serializer.quote_string(label)) for label in labels)
+    ids_by_label = {}
+    for record in driver.run_read_query(query, bundle_id=bundle_id):
+        ids_by_label.setdefault(record["label"], []).append(record["id"])
+    return ids_by_label
+
+
+# Return two lists of (query, rows) delete batches: the batches of the Property nodes, and those of the other nodes.
+def build_purge_batches(bundle_id, ids_by_label, batch_size=DEFAULT_BATCH_SIZE):
+    property_batches = []
+    resource_batches = []
+    for label, ids in ids_by_label.items():
+        query = cypher_generator.build_delete_bundle_nodes_batch_query(label, BUNDLE_ID_PROPERTY)
+        rows = [{'id': node_id, 'bundle_id': bundle_id} for node_id in ids]
+        batches = property_batches if label == neo4j_schema.PROPERTY_LABEL else resource_batches
+        for chunk in cypher_generator.split_rows_into_chunks(rows, batch_size):
+            batches.append((query, chunk))
+    return property_batches, resource_batches
+
+
+# Run every batch in its own transaction, concurrency at the same time. Raises the first error after all batches
+# have run.
+def run_batches_concurrently(driver, batches, concurrency=DEFAULT_CONCURRENCY):
+    errors = []
+
+    def run_batch(batch):
+        try:
+            driver.run_cypher_batches([batch])
+        except Exception as e:
+            errors.append(e)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run_batch, batches))
+    if errors:
+        raise errors[0]
+
+
+# Delete all nodes of the bundles with their relationships. Returns the number of deleted nodes.
+@instrumentation.timed("purge_bundles")
+def purge_bundles(driver, bundle_ids, batch_size=DEFAULT_BATCH_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    number_of_nodes = 0
+    labels = find_tagged_labels(driver) if bundle_ids else []
+    if bundle_ids and not labels:
+        print("No label has an index on the bundle id, upload with --tag-bundles first")
+    for bundle_id in bundle_ids:
+        ids_by_label = find_bundle_node_ids(driver, bundle_id, labels)
+        if not ids_by_label:
+            print(f"No nodes of bundle {bundle_id} found")
+            continue
+        for batches in build_purge_batches(bundle_id, ids_by_label, batch_size):
+            run_batches_concurrently(driver, batches, concurrency)
+        bundle_nodes = sum(len(ids) for ids in ids_by_label.values())
+        print(f"{bundle_nodes} nodes of bundle {bundle_id} have been deleted")
+        instrumentation.log_event("bundle_purged", bundle_id=bundle_id, nodes=bundle_nodes)
+        number_of_nodes += bundle_nodes
+    instrumentation.add_count("purged_nodes", number_of_nodes)
+    return number_of_nodes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Delete the nodes of bundles or patients that were uploaded with "
+                                                 "--tag-bundles, see purge.py.")
+    parser.add_argument("--bundle-id", action="append", default=[], help="Id of a bundle (its graph id).")
+    parser.add_argument("--patient-id", action="append", default=[], help="Resource id of a Patient.")
+    parser.add_argument("--json-file", action="append", default=[], help="Bundle json file whose nodes are deleted.")
+    parser.add_argument("--config", default='neo4j_config.txt', help="Neo4j config file.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of nodes that are deleted in one transaction.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Number of delete transactions that run at the same time.")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Split delete transactions that fail with a transient error, see upload_controller.py.")
+    args = parser.parse_args()
+    if not args.bundle_id and not args.patient_id and not args.json_file:
+        parser.error("give at least one --bundle-id, --patient-id or --json-file")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    return args
+
+
+if __name__ == '__main__':
+    import neo4j_driver
+    import upload_controller
+    args = parse_args()
+    controller = None
+    if args.adaptive:
+        controller = upload_controller.UploadController(initial_rows=args.batch_size, max_in_flight=args.concurrency)
+    driver = neo4j_driver.Neo4jDriver(args.config, controller=controller)
+    driver.connect()
+    bundle_ids = list(args.bundle_id)
+    for json_path in args.json_file:
+        bundle_id = get_bundle_id(json_path)
+        if bundle_id:
+            bundle_ids.append(bundle_id)
+    for patient_id in args.patient_id:
+        patient_bundle_ids = find_patient_bundle_ids(driver, patient_id)
+        if not patient_bundle_ids:
+            print(f"No bundle of patient {patient_id} found")
+        bundle_ids.extend(patient_bundle_ids)
+    number_of_nodes = purge_bundles(driver, list(dict.fromkeys(bundle_ids)), args.batch_size, args.concurrency)
+    print(f"{number_of_nodes} nodes have been deleted")
+    driver.close()
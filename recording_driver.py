@@ -0,0 +1,107 @@
+# Upload sink without a Neo4j server. RecordingDriver has the upload methods of neo4j_driver.Neo4jDriver, so it can be
+# passed wherever a driver is uploaded to (main.process_json_files_one_by_one, pipeline.run_pipeline, benchmark.py).
+# It counts the queries and rows it gets, and keeps them if record is True, so the throughput of the conversion and
+# the pipeline can be measured, and its output checked, without a database.
+import threading
+import time
+
+import batch_artifact
+import instrumentation
+import upload_controller
+
+
+class RecordingDriver:
+    # record: keep every (query, rows) pair, rows is None for a statement.
+    # latency: seconds to wait per query, to simulate the round trip to a server.
+    # transaction_size, controller: see neo4j_driver.Neo4jDriver, the transactions are counted.
+    def __init__(self, record=False, latency=0.0, transaction_size=None, controller=None):
+        self.record = record
+        self.latency = latency
+        self.transaction_size = transaction_size
+        self.controller = controller
+        self.number_of_transactions = 0
+        # Upload threads of the pipeline share one driver.
+        self.lock = threading.Lock()
+        self.queries = []
+        self.number_of_queries = 0
+        self.number_of_rows = 0
+        self.schema_labels = set()
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def add_query(self, query, rows=None):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.number_of_queries += 1
+            self.number_of_rows += len(rows) if rows is not None else 1
+            if self.record:
+                self.queries.append((query, rows))
+
+    def run_cypher_query(self, query):
+        self.add_query(query)
+
+    # See neo4j_driver.Neo4jDriver.run_in_transactions, without transient errors.
+    def run_in_transactions(self, queries, run_query, start_chunk=0, on_commit=None):
+        upload = upload_controller.create_upload(queries, self.transaction_size, self.controller, start_chunk,
+                                                 on_commit)
+        for chunk in upload:
+            start = time.perf_counter()
+            with upload.get_in_flight():
+                for query in chunk:
+                    run_query(query)
+            with self.lock:
+                self.number_of_transactions += 1
+            upload.commit(chunk, None, time.perf_counter() - start)
+
+    @instrumentation.timed("run_cypher_queries")
+    def run_cypher_queries(self, queries, start_chunk=0, on_commit=None):
+        def run_query(query):
+            self.add_query(query)
+            instrumentation.add_count("uploaded_statements")
+        self.run_in_transactions(queries, run_query, start_chunk, on_commit)
+
+    @instrumentation.timed("run_cypher_batches")
+    def run_cypher_batches(self, batches, start_chunk=0, on_commit=None):
+        def run_batch(batch):
+            query, rows = batch
+            self.add_query(query, rows)
+            instrumentation.add_count("uploaded_rows", len(rows))
+        self.run_in_transactions(batches, run_batch, start_chunk, on_commit)
+
+    def run_batch_artifact(self, file_path, batch_size=None):
+        self.run_cypher_batches(batch_artifact.read_batches_from_file(file_path, batch_size))
+
+    def ensure_schema(self, labels, unique=False):
+        with self.lock:
+            self.schema_labels.update(labels)
+
+    def ensure_owner_index(self, owner_property):
+        pass
+
+    def get_queries(self):
+        return self.queries
+
+    def get_number_of_transactions(self):
+        return self.number_of_transactions
+
+    def get_number_of_queries(self):
+        return self.number_of_queries
+
+    # Rows of the batches plus one per statement.
+    def get_number_of_rows(self):
+        return self.number_of_rows
+
+    def get_schema_labels(self):
+        return self.schema_labels
+
+    def reset(self):
+        with self.lock:
+            self.queries = []
+            self.number_of_queries = 0
+            self.number_of_rows = 0
+            self.number_of_transactions = 0
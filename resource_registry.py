@@ -0,0 +1,157 @@
+# Global resource registry: which resources have already been written, across all bundles of a run.
+#
+# Every Graph is built from one bundle, so without the registry
+#   - a shared resource (the same Organization or Practitioner in 10k patient bundles) is written 10k times, and
+#   - a reference to a resource in another bundle ('Organization/123', 'urn:uuid:...') finds no node and is dropped.
+# The registry keeps the node id of every written resource under its keys ('ResourceType/id' and fullUrl).
+# A shared resource that is already in the registry is not written again: the edges of later bundles point to the
+# node that was written first. A reference that is not in the bundle is looked up in the registry, and becomes an
+# edge to the existing node. Only resources of earlier bundles whose upload has committed can be found this way, so
+# an edge never points to a resource whose upload fails later. With several workers, a reference to a bundle that is
+# still being uploaded is not resolved, so the result of a bundle depends on the timing of the workers.
+#
+# The registry is a SQLite database, in memory or in a file. A file survives a restart, and worker processes that
+# use the same file share it. A shared resource is claimed with one INSERT, so only one process writes it.
+# The claims of a bundle are pending until its upload has committed (see pipeline.record_committed_bundle). If the
+# upload fails, they are released (see pipeline.record_failed_bundle), so a later bundle or run writes the resource
+# again: the bundles in between only MERGEd its id, and the MERGE of the full node fills it in.
+import sqlite3
+import threading
+
+import graph_helper
+from graph import Node
+
+DEFAULT_SHARED_RESOURCE_TYPES = ("Organization", "Practitioner", "PractitionerRole", "Location")
+
+# The registry used by pipeline.convert_source_to_graph, or None. In worker processes it is opened once by the pool
+# initializer (see pipeline.init_worker).
+registry = None
+
+
+class ResourceRegistry:
+    def __init__(self, registry_file_path=None, shared_resource_types=DEFAULT_SHARED_RESOURCE_TYPES):
+        self.registry_file_path = registry_file_path
+        self.shared_resource_types = set(shared_resource_types)
+        # Other processes can hold the write lock of a registry file for a moment. Bundles can be converted in
+        # several threads (see pipeline.run_async_pipeline), so the connection is shared under a lock.
+        self.connection = sqlite3.connect(registry_file_path if registry_file_path else ":memory:", timeout=60,
+                                          check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS resources (reference TEXT PRIMARY KEY, "
+                                "node_id TEXT NOT NULL, node_type TEXT NOT NULL, node_name TEXT NOT NULL, "
+                                "source TEXT, committed INTEGER NOT NULL DEFAULT 1)")
+        # Registry files of earlier versions have no claims, all their resources are committed.
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(resources)")]
+        if "committed" not in columns:
+            self.connection.execute("ALTER TABLE resources ADD COLUMN source TEXT")
+            self.connection.execute("ALTER TABLE resources ADD COLUMN committed INTEGER NOT NULL DEFAULT 1")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS resources_source ON resources (source, committed)")
+        self.connection.commit()
+        self.number_of_reused_nodes = 0
+
+    def close(self):
+        self.connection.close()
+
+    # Return (node id, node type, node name) of a reference, or None if it is not in the registry.
+    # committed_only: ignore the pending claims of bundles whose upload has not committed yet.
+    def get_node_info(self, reference, committed_only=False):
+        with self.lock:
+            return self.find_node_info(reference, committed_only)
+
+    # get_node_info without the lock, for callers that hold it.
+    def find_node_info(self, reference, committed_only=False):
+        query = "SELECT node_id, node_type, node_name FROM resources WHERE reference = ?"
+        if committed_only:
+            query += " AND committed = 1"
+        row = self.connection.execute(query, (reference,)).fetchone()
+        if row is None:
+            key = graph_helper.reduce_reference(reference)
+            if key is not None and key != reference:
+                row = self.connection.execute(query, (key,)).fetchone()
+        return row
+
+    # Return an external node for a reference to a committed resource of an earlier bundle, or None.
+    # Used as resolve_external of graph_helper.convert_json_to_graph.
+    def resolve(self, reference):
+        node_info = self.get_node_info(reference, committed_only=True)
+        if node_info is None:
+            return None
+        node_id, node_type, node_name = node_info
+        node = Node(name=node_name, node_type=node_type, properties={}, fullUrl=reference, isExternalNode=True)
+        node.set_id(node_id)
+        return node
+
+    # The keys of a resource node: 'ResourceType/id' and its fullUrl.
+    def get_reference_keys(self, node):
+        keys = []
+        resource_id = node.get_properties().get('id')
+        if resource_id:
+            keys.append(f"{node.get_node_type()}/{resource_id}")
+        if node.get_fullUrl() and node.get_fullUrl() not in keys:
+            keys.append(node.get_fullUrl())
+        return keys
+
+    # Register the resources of a graph (after build_property_nodes_for_each_node), and remove the shared resources
+    # that are already registered, together with their property nodes. Edges to a removed resource point to the
+    # node that was registered first.
+    # source: the bundle of the graph. Its claims are pending until commit_claims or release_claims.
+    def add_graph(self, graph, source=None):
+        # A shared resource node is MERGEd, because an edge of another process can MERGE it before it is written.
+        graph.set_merge_resource_nodes(True)
+        reused_nodes = []
+        with self.lock, self.connection:
+            for node in graph.get_nodes_properties_unnested():
+                if node.get_isPropertyNode():
+                    continue
+                keys = self.get_reference_keys(node)
+                if not keys:
+                    continue
+                node_info = (node.get_id(), node.get_node_type(), node.get_name(), source)
+                if node.get_node_type() in self.shared_resource_types:
+                    claimed = self.connection.execute(
+                        "INSERT OR IGNORE INTO resources (reference, node_id, node_type, node_name, source, "
+                        "committed) VALUES (?, ?, ?, ?, ?, 0)", (keys[0],) + node_info).rowcount == 1
+                    if not claimed:
+                        graph.set_node_properties_unnested_id(node, self.find_node_info(keys[0])[0])
+                        reused_nodes.append(node)
+                        continue
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO resources (reference, node_id, node_type, node_name, source, committed) "
+                    "VALUES (?, ?, ?, ?, ?, 0)", [(key,) + node_info for key in keys])
+        graph_helper.remove_resource_nodes(graph, reused_nodes)
+        self.number_of_reused_nodes += len(reused_nodes)
+        return reused_nodes
+
+    # The upload of the bundle has committed: its claims are final.
+    def commit_claims(self, source):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE resources SET committed = 1 WHERE source = ? AND committed = 0",
+                                    (source,))
+
+    # The upload of the bundle has failed: the resources it claimed are written again by the next bundle that has
+    # them.
+    def release_claims(self, source):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM resources WHERE source = ? AND committed = 0", (source,))
+
+    # Release the claims that a crashed run left pending. Only when no other process uses the registry file.
+    def release_pending_claims(self):
+        with self.lock, self.connection:
+            return self.connection.execute("DELETE FROM resources WHERE committed = 0").rowcount
+
+    # Number of shared resource nodes that were not written again by this process.
+    def get_number_of_reused_nodes(self):
+        return self.number_of_reused_nodes
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM resources").fetchone()[0]
+
+
+def set_registry(resource_registry):
+    global registry
+    registry = resource_registry
+
+
+def get_registry():
+    return registry
@@ -1,4 +1,15 @@
 
+import os
+
+# '*' in a rule matches every resource type, e.g.
+#   Observation OBSERVATION_REFERS_TO *
+#   * REFERS_TO *        (default for all pairs without a more specific rule, instead of UNDEFINED)
+WILDCARD = '*'
+
+# rules.txt next to this file, so the program does not depend on the current working directory.
+DEFAULT_RULE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.txt")
+
+
 class Rule:
     def __init__(self, rule_file_path):
         self.rules = self.read_rules_from_file(rule_file_path)
@@ -9,6 +20,9 @@ class Rule:
             for line in file:
                 # Split the line into tokens based on whitespace
                 tokens = line.strip().split()
+                # Lines starting with '#' are comments
+                if tokens and tokens[0].startswith('#'):
+                    continue
                 # Check if the line has at least three tokens and ends with a semicolon
                 if len(tokens) >= 3:
                     # Extract the first, second, and third tokens
@@ -19,3 +33,51 @@ class Rule:
 
     def get_rules(self):
         return self.rules
+
+    # Return the relationship type from source_type to target_type, or None if no rule matches.
+    # The most specific rule wins: (source, target), (source, *), (*, target), (*, *).
+    def get_edge_type(self, source_type, target_type):
+        rules = self.rules
+        edge_type = rules.get((source_type, target_type))
+        if edge_type is None:
+            edge_type = rules.get((source_type, WILDCARD))
+        if edge_type is None:
+            edge_type = rules.get((WILDCARD, target_type))
+        if edge_type is None:
+            edge_type = rules.get((WILDCARD, WILDCARD))
+        return edge_type
+
+    # Resource types named in the rules, without the wildcard.
+    def get_resource_types(self):
+        resource_types = set()
+        for source_type, target_type in self.rules.keys():
+            resource_types.add(source_type)
+            resource_types.add(target_type)
+        resource_types.discard(WILDCARD)
+        return resource_types
+
+
+# Rule registry: every rules file is parsed once per process, and parsed again only when its mtime changes.
+# Worker processes load it once in their initializer (see pipeline.init_worker).
+rule_cache = {}
+default_rule_file_path = DEFAULT_RULE_FILE_PATH
+
+
+def set_default_rule_file_path(rule_file_path):
+    global default_rule_file_path
+    default_rule_file_path = rule_file_path
+
+
+def get_default_rule_file_path():
+    return default_rule_file_path
+
+
+# Return the Rule of a rules file. rule_file_path=None uses the default rules file.
+def get_rule(rule_file_path=None):
+    path = os.path.abspath(rule_file_path if rule_file_path else default_rule_file_path)
+    mtime = os.path.getmtime(path)
+    cached = rule_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, Rule(path))
+        rule_cache[path] = cached
+    return cached[1]
@@ -0,0 +1,193 @@
+# Synthetic Synthea-like patient bundles for benchmarks (see benchmark.py), so the benchmark does not depend on which
+# sample files are in "FHIR Data/FHIR JSON".
+#
+# A bundle is a collection of patients. Every patient has a Patient resource and resources_per_patient - 1 clinical
+# resources (Encounter, Observation, Condition, Procedure, Immunization, MedicationRequest, DiagnosticReport) that
+# reference the patient and an encounter with urn:uuid references, like the Synthea sample files. All patients of a
+# bundle share one Organization. nesting_depth adds a chain of nested extensions of that depth to every resource, to
+# measure the unnesting of deeply nested resources.
+#
+# The bundles only depend on the seed, so every run of a benchmark converts the same data.
+# Usage: python synthetic_bundle.py --output "FHIR Data/Synthetic" --bundles 10 --patients 2 --resources 200 --depth 3
+import argparse
+import json
+import os
+import random
+import uuid
+
+DEFAULT_PATIENTS = 1
+DEFAULT_RESOURCES_PER_PATIENT = 200
+DEFAULT_NESTING_DEPTH = 1
+
+# (system, code, display) of the codes used in the generated resources.
+LOINC_CODES = [("http://loinc.org", "8302-2", "Body Height"),
+               ("http://loinc.org", "29463-7", "Body Weight"),
+               ("http://loinc.org", "39156-5", "Body Mass Index"),
+               ("http://loinc.org", "8480-6", "Systolic Blood Pressure"),
+               ("http://loinc.org", "8462-4", "Diastolic Blood Pressure"),
+               ("http://loinc.org", "2093-3", "Total Cholesterol"),
+               ("http://loinc.org", "4548-4", "Hemoglobin A1c/Hemoglobin.total in Blood"),
+               ("http://loinc.org", "2339-0", "Glucose")]
+SNOMED_CODES = [("http://snomed.info/sct", "44054006", "Diabetes"),
+                ("http://snomed.info/sct", "38341003", "Hypertension"),
+                ("http://snomed.info/sct", "195662009", "Acute viral pharyngitis (disorder)"),
+                ("http://snomed.info/sct", "10509002", "Acute bronchitis (disorder)"),
+                ("http://snomed.info/sct", "428191000124101", "Documentation of current medications")]
+CVX_CODES = [("http://hl7.org/fhir/sid/cvx", "140", "Influenza, seasonal, injectable, preservative free"),
+             ("http://hl7.org/fhir/sid/cvx", "113", "Td (adult) preservative free")]
+RXNORM_CODES = [("http://www.nlm.nih.gov/research/umls/rxnorm", "849727", "Naproxen sodium 220 MG [Aleve]"),
+                ("http://www.nlm.nih.gov/research/umls/rxnorm", "314076", "lisinopril 10 MG Oral Tablet")]
+
+# Share of the clinical resources of a patient per resource type, roughly as in the Synthea sample files.
+RESOURCE_TYPE_WEIGHTS = [("Encounter", 8), ("Observation", 60), ("Condition", 5), ("Procedure", 6),
+                         ("Immunization", 8), ("MedicationRequest", 5), ("DiagnosticReport", 8)]
+
+
+def make_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def make_codeable_concept(rng, codes):
+    system, code, display = rng.choice(codes)
+    return {"coding": [{"system": system, "code": code, "display": display}], "text": display}
+
+
+def make_date_time(rng):
+    return (f"{rng.randint(1990, 2020)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+            f"T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00+00:00")
+
+
+# An extension with a chain of nested extensions, nesting_depth levels deep.
+def make_nested_extension(rng, nesting_depth):
+    extension = {"url": "http://example.org/fhir/StructureDefinition/synthetic-extension",
+                 "valueString": f"value {rng.randint(0, 999)}"}
+    for level in range(nesting_depth - 1):
+        extension = {"url": f"http://example.org/fhir/StructureDefinition/synthetic-extension-{level}",
+                     "extension": [extension]}
+    return extension
+
+
+def make_resource(rng, resource_type, patient_url, encounter_url, observation_urls):
+    resource = {"resourceType": resource_type,
+                "meta": {"tag": [{"system": "https://smarthealthit.org/tags", "code": "synthea-7-2017"}]}}
+    if resource_type == "Encounter":
+        resource.update({"status": "finished", "class": {"code": "outpatient"},
+                         "type": [make_codeable_concept(rng, SNOMED_CODES)],
+                         "subject": {"reference": patient_url},
+                         "period": {"start": make_date_time(rng), "end": make_date_time(rng)}})
+    elif resource_type == "Observation":
+        resource.update({"status": "final",
+                         "category": [{"coding": [{"system": "http://hl7.org/fhir/observation-category",
+                                                   "code": "vital-signs"}]}],
+                         "code": make_codeable_concept(rng, LOINC_CODES),
+                         "subject": {"reference": patient_url}, "context": {"reference": encounter_url},
+                         "effectiveDateTime": make_date_time(rng),
+                         "valueQuantity": {"value": round(rng.uniform(1, 200), 2), "unit": "mg/dL",
+                                           "system": "http://unitsofmeasure.org", "code": "mg/dL"}})
+    elif resource_type == "Condition":
+        resource.update({"clinicalStatus": "active", "verificationStatus": "confirmed",
+                         "code": make_codeable_concept(rng, SNOMED_CODES),
+                         "subject": {"reference": patient_url}, "context": {"reference": encounter_url},
+                         "onsetDateTime": make_date_time(rng)})
+    elif resource_type == "Procedure":
+        resource.update({"status": "completed", "code": make_codeable_concept(rng, SNOMED_CODES),
+                         "subject": {"reference": patient_url}, "context": {"reference": encounter_url},
+                         "performedDateTime": make_date_time(rng)})
+    elif resource_type == "Immunization":
+        resource.update({"status": "completed", "notGiven": False,
+                         "vaccineCode": make_codeable_concept(rng, CVX_CODES),
+                         "patient": {"reference": patient_url}, "encounter": {"reference": encounter_url},
+                         "date": make_date_time(rng), "primarySource": True})
+    elif resource_type == "MedicationRequest":
+        resource.update({"status": "active", "intent": "order",
+                         "medicationCodeableConcept": make_codeable_concept(rng, RXNORM_CODES),
+                         "subject": {"reference": patient_url}, "context": {"reference": encounter_url},
+                         "authoredOn": make_date_time(rng)})
+    elif resource_type == "DiagnosticReport":
+        resource.update({"status": "final", "code": make_codeable_concept(rng, LOINC_CODES),
+                         "subject": {"reference": patient_url}, "context": {"reference": encounter_url},
+                         "effectiveDateTime": make_date_time(rng),
+                         "result": [{"reference": url} for url in observation_urls[-3:]]})
+    return resource
+
+
+def make_patient(rng):
+    return {"resourceType": "Patient",
+            "meta": {"tag": [{"system": "https://smarthealthit.org/tags", "code": "synthea-7-2017"}]},
+            "name": [{"use": "official", "family": f"Family{rng.randint(1, 999)}",
+                      "given": [f"Given{rng.randint(1, 999)}"]}],
+            "telecom": [{"system": "phone", "value": f"555-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}",
+                         "use": "home"}],
+            "gender": rng.choice(["male", "female"]),
+            "birthDate": f"{rng.randint(1920, 2015)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "address": [{"line": [f"{rng.randint(1, 999)} Main Street"], "city": "Boston", "state": "MA",
+                         "postalCode": "02108", "country": "US"}]}
+
+
+# Return one bundle (a dict like a Synthea sample file).
+def generate_bundle(patients=DEFAULT_PATIENTS, resources_per_patient=DEFAULT_RESOURCES_PER_PATIENT,
+                    nesting_depth=DEFAULT_NESTING_DEPTH, seed=0):
+    rng = random.Random(seed)
+    entries = []
+
+    def add_entry(resource):
+        resource_id = make_uuid(rng)
+        resource["id"] = resource_id
+        if nesting_depth > 0:
+            resource.setdefault("extension", []).append(make_nested_extension(rng, nesting_depth))
+        entries.append({"fullUrl": f"urn:uuid:{resource_id}", "resource": resource})
+        return f"urn:uuid:{resource_id}"
+
+    organization_url = add_entry({"resourceType": "Organization", "name": "Synthetic Provider",
+                                  "type": [{"coding": [{"system": "http://hl7.org/fhir/ValueSet/organization-type",
+                                                        "code": "prov", "display": "Healthcare Provider"}]}]})
+    resource_types = [resource_type for resource_type, weight in RESOURCE_TYPE_WEIGHTS]
+    weights = [weight for resource_type, weight in RESOURCE_TYPE_WEIGHTS]
+    for _ in range(patients):
+        patient_url = add_entry(make_patient(rng))
+        encounter = make_resource(rng, "Encounter", patient_url, None, [])
+        encounter["serviceProvider"] = {"reference": organization_url}
+        encounter_url = add_entry(encounter)
+        observation_urls = []
+        for _ in range(max(resources_per_patient - 2, 0)):
+            resource_type = rng.choices(resource_types, weights)[0]
+            if resource_type == "DiagnosticReport" and not observation_urls:
+                resource_type = "Observation"
+            resource = make_resource(rng, resource_type, patient_url, encounter_url, observation_urls)
+            if resource_type == "Encounter":
+                resource["serviceProvider"] = {"reference": organization_url}
+            url = add_entry(resource)
+            if resource_type == "Encounter":
+                encounter_url = url
+            elif resource_type == "Observation":
+                observation_urls.append(url)
+    return {"resourceType": "Bundle", "type": "collection", "entry": entries}
+
+
+# Write number_of_bundles bundles to Synthetic_<n>.json files in folder_path and return their paths.
+# Bundle n is generated with the seed seed + n.
+def save_bundles(folder_path, number_of_bundles, patients=DEFAULT_PATIENTS,
+                 resources_per_patient=DEFAULT_RESOURCES_PER_PATIENT, nesting_depth=DEFAULT_NESTING_DEPTH, seed=0):
+    os.makedirs(folder_path, exist_ok=True)
+    json_path_list = []
+    for number in range(number_of_bundles):
+        json_path = f"{folder_path}/Synthetic_{number:05d}.json"
+        with open(json_path, "w") as json_file:
+            json.dump(generate_bundle(patients, resources_per_patient, nesting_depth, seed + number), json_file)
+        json_path_list.append(json_path)
+    return json_path_list
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic Synthea-like FHIR bundles.")
+    parser.add_argument("--output", default='FHIR Data/Synthetic', help="Folder of the generated json files.")
+    parser.add_argument("--bundles", type=int, default=10, help="Number of bundles.")
+    parser.add_argument("--patients", type=int, default=DEFAULT_PATIENTS, help="Patients per bundle.")
+    parser.add_argument("--resources", type=int, default=DEFAULT_RESOURCES_PER_PATIENT,
+                        help="Resources per patient, including the Patient resource.")
+    parser.add_argument("--depth", type=int, default=DEFAULT_NESTING_DEPTH,
+                        help="Depth of the nested extension added to every resource, 0 adds none.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first bundle.")
+    args = parser.parse_args()
+    paths = save_bundles(args.output, args.bundles, args.patients, args.resources, args.depth, args.seed)
+    print(f"{len(paths)} bundles have been saved at {args.output}")
@@ -0,0 +1,127 @@
+# Shared Code nodes for terminology codes.
+#
+# Without this, every Coding ({'system': 'http://loinc.org', 'code': '8302-2', 'display': 'Body Height'}) under every
+# resource becomes its own Property node. With shared codes, each distinct (system, code) is one Code node, which is
+# MERGEd on its id across all bundles, and a resource links to it with a HAS_CODE relationship:
+#   (observation1)-[:HAS_CODE]->(:Code {system: 'http://loinc.org', code: '8302-2', display: 'Body Height'})
+# "All patients with code X" is then an index lookup of one Code node.
+#
+# Every process keeps an LRU cache of the codes whose Code node is committed in the database. A code in the cache is
+# not written as a node again: the HAS_CODE relationship MERGEs the Code node by its id only. A code is added to the
+# cache only after the upload of a bundle that wrote its full node has committed (see pipeline.record_committed_bundle),
+# so a failed upload never leaves a Code node without system and code. Until then every bundle writes the full node,
+# which is MERGEd on its id, so writing it twice does no harm. The uploads run in the main process, so the caches of
+# worker processes stay empty and their bundles always write the full nodes.
+import hashlib
+import threading
+from collections import OrderedDict
+
+from graph import Edge, Node
+
+CODE_LABEL = "Code"
+HAS_CODE = "HAS_CODE"
+DEFAULT_CACHE_SIZE = 100000
+# The elements of a FHIR Coding. A Quantity (valueQuantity, doseQuantity, Age, ...) also has system and code, but
+# its value, unit and comparator would be lost on a Code node, so it is not a Coding.
+CODING_KEYS = frozenset(['system', 'code', 'display', 'version', 'userSelected', 'extension'])
+
+
+class CodeCache:
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.codes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Bundles are converted and uploaded in different threads (see pipeline.run_async_pipeline).
+        self.lock = threading.Lock()
+
+    # Return True if the Code node of the code id is committed.
+    def contains(self, code_id):
+        with self.lock:
+            if code_id in self.codes:
+                self.codes.move_to_end(code_id)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    # Add the code ids of committed Code nodes.
+    def add(self, code_ids):
+        with self.lock:
+            for code_id in code_ids:
+                self.codes[code_id] = None
+                self.codes.move_to_end(code_id)
+            while len(self.codes) > self.max_size:
+                self.codes.popitem(last=False)
+
+    def get_hits(self):
+        return self.hits
+
+    def get_misses(self):
+        return self.misses
+
+    def __len__(self):
+        return len(self.codes)
+
+
+shared_codes = False
+code_cache = CodeCache()
+
+
+# Turn shared Code nodes on or off for this process. Worker processes do this in their initializer
+# (see pipeline.init_worker).
+def set_shared_codes(enabled, cache_size=DEFAULT_CACHE_SIZE):
+    global shared_codes, code_cache
+    shared_codes = enabled
+    code_cache = CodeCache(cache_size)
+
+
+def get_shared_codes():
+    return shared_codes
+
+
+def get_code_cache():
+    return code_cache
+
+
+# A Coding has a system and a code, and no other keys than CODING_KEYS. Its extension is not kept on the Code node.
+def is_coding(value):
+    if not isinstance(value, dict) or not value.get('system') or not value.get('code'):
+        return False
+    return CODING_KEYS.issuperset(value)
+
+
+# Id of the Code node, e.g. Code_0beec7b5ea3f0fdbc95d. It is a hash, because system and code can contain any
+# character.
+def make_code_id(system, code):
+    return CODE_LABEL + "_" + hashlib.sha1(f"{system}|{code}".encode('utf-8')).hexdigest()[:20]
+
+
+# Return the Code node of a Coding in this graph, and add it to the graph if it is not there yet.
+# A code that is committed (in the code cache) becomes an external node: it is not written again.
+def get_code_node(graph, coding):
+    system = str(coding.get('system'))
+    code = str(coding.get('code'))
+    code_id = make_code_id(system, code)
+    code_node = graph.find_shared_node(code_id)
+    if code_node is None:
+        properties = {'system': system, 'code': code}
+        if coding.get('display') is not None:
+            properties['display'] = coding.get('display')
+        if coding.get('version') is not None:
+            properties['version'] = coding.get('version')
+        code_node = Node(name=f"{CODE_LABEL.lower()}_{code}", node_type=CODE_LABEL, properties=properties,
+                         isExternalNode=code_cache.contains(code_id))
+        code_node.set_id(code_id)
+        graph.add_shared_node(code_node)
+    return code_node
+
+
+# Return the ids of the Code nodes that a graph writes in full, to be added to the code cache after its upload.
+def get_written_code_ids(graph):
+    return [node.get_id() for node in graph.get_shared_nodes() if node.get_node_type() == CODE_LABEL]
+
+
+# Add a HAS_CODE edge from the resource node to the Code node of the Coding.
+def add_code_edge(graph, resource_node, coding):
+    graph.add_edge(Edge(resource_node, get_code_node(graph, coding), edge_type=HAS_CODE))
@@ -0,0 +1,350 @@
+# Transactions of the upload, for every driver (neo4j_driver.Neo4jDriver, neo4j_driver.AsyncNeo4jDriver,
+# recording_driver.RecordingDriver). The drivers only run and commit the transactions, which queries go into the next
+# transaction, what happens after a transient error and when a commit is saved is decided here:
+#   - create_upload returns a FixedUpload (the queries in transactions of --transaction-size queries) or an
+#     AdaptiveUpload (see below). A driver runs every transaction of the upload, and calls split after a transient
+#     error and commit after the commit.
+#   - RetryPolicy gives the delays before a transaction is tried again.
+#
+# Adaptive transaction size of the upload (--adaptive). Instead of a fixed --transaction-size, the queries of a bundle
+# are committed in transactions of a number of rows that the UploadController adjusts while the upload runs, like the
+# AIMD (additive increase, multiplicative decrease) of TCP:
+#   - a full transaction that commits within the target latency makes the next ones larger: twice as large until the
+#     first decrease (slow start), then increase_rows rows larger.
+#   - a transaction that takes longer than the target latency, or fails with a transient error (deadlock, lock
+#     timeout, out of memory), makes the next ones decrease_factor times as large.
+# A failed transaction is split into two halves, which are tried next, down to one row, which is tried again after
+# the delays of the RetryPolicy of the driver. At most max_in_flight transactions of all upload threads or coroutines
+# run at the same time.
+#
+# A row is one statement, or one row of the $rows of a batch: a batch is cut into parts when a transaction ends in
+# the middle of it. The checkpoint journal (see checkpoint) counts the committed rows of a bundle instead of its
+# transactions, so --resume continues after the last committed row. Resume with --adaptive if the last run used it.
+import asyncio
+import collections
+import contextlib
+import statistics
+import threading
+
+import instrumentation
+
+DEFAULT_INITIAL_ROWS = 1000
+DEFAULT_MIN_ROWS = 1
+DEFAULT_MAX_ROWS = 100000
+DEFAULT_INCREASE_ROWS = 500
+DEFAULT_DECREASE_FACTOR = 0.5
+# Seconds of a commit. Longer transactions hold their locks and the heap of the server too long.
+DEFAULT_TARGET_LATENCY = 1.0
+DEFAULT_MAX_RETRIES = 3
+# Seconds before the first retry. The delay doubles with every retry.
+DEFAULT_RETRY_DELAY = 1.0
+DEFAULT_MAX_IN_FLIGHT = 4
+# The settled size is the median size of the last commits.
+RECENT_COMMITS = 50
+
+
+# Rows of a query: 1 for a statement, the rows of a (query, rows) batch.
+def get_number_of_rows(query):
+    return 1 if isinstance(query, str) else len(query[1])
+
+
+# Split the queries of a bundle into the queries of its transactions: all in one transaction if transaction_size is
+# None, else transaction_size queries (statements or batches) per transaction.
+def split_into_transactions(queries, transaction_size=None):
+    queries = list(queries)
+    if not queries:
+        return []
+    if not transaction_size:
+        return [queries]
+    return [queries[i:i + transaction_size] for i in range(0, len(queries), transaction_size)]
+
+
+# Retries of one transaction that failed with a transient error: at most max_retries, after retry_delay seconds,
+# twice as long before every next one.
+class RetryPolicy:
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, retry_delay=DEFAULT_RETRY_DELAY):
+        self.max_retries = max_retries
+        self.delay = retry_delay
+        self.attempt = 0
+
+    # Return the seconds to wait before the transaction is tried again after error, or None if no retry is left.
+    def next_delay(self, error):
+        if self.attempt >= self.max_retries:
+            return None
+        self.attempt += 1
+        delay = self.delay
+        self.delay *= 2
+        print(f"Transient error, retry {self.attempt}/{self.max_retries} in {delay} s: {error}")
+        return delay
+
+
+# Position in a list of queries, counted in rows.
+class UploadCursor:
+    def __init__(self, queries, start_row=0):
+        self.queries = queries
+        self.index = 0
+        # Rows of the query at index that were taken before.
+        self.offset = 0
+        self.take(start_row)
+
+    # Return the queries of the next size rows. A batch that does not fit is cut, the rest comes next.
+    def take(self, size):
+        chunk = []
+        rows = 0
+        while self.index < len(self.queries) and rows < size:
+            query = self.queries[self.index]
+            remaining = get_number_of_rows(query) - self.offset
+            if remaining <= size - rows:
+                chunk.append(query if self.offset == 0 else (query[0], query[1][self.offset:]))
+                rows += remaining
+                self.index += 1
+                self.offset = 0
+            else:
+                # Only a batch has more than one row.
+                end = self.offset + size - rows
+                chunk.append((query[0], query[1][self.offset:end]))
+                rows = size
+                self.offset = end
+        return chunk
+
+
+# Split the queries of a transaction into two halves with the same number of rows. None if it has only one row.
+def split_transaction(chunk):
+    rows = sum(get_number_of_rows(query) for query in chunk)
+    if rows <= 1:
+        return None
+    cursor = UploadCursor(chunk)
+    return cursor.take(rows // 2), cursor.take(rows)
+
+
+class UploadController:
+    def __init__(self, initial_rows=DEFAULT_INITIAL_ROWS, min_rows=DEFAULT_MIN_ROWS, max_rows=DEFAULT_MAX_ROWS,
+                 target_latency=DEFAULT_TARGET_LATENCY, increase_rows=DEFAULT_INCREASE_ROWS,
+                 decrease_factor=DEFAULT_DECREASE_FACTOR, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.size = min(max(initial_rows, min_rows), max_rows)
+        self.target_latency = target_latency
+        self.increase_rows = increase_rows
+        self.decrease_factor = decrease_factor
+        self.max_in_flight = max_in_flight
+        self.slow_start = True
+        # The upload threads of the pipeline share the controller.
+        self.lock = threading.Lock()
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        # Created on first use, on the event loop of the asynchronous upload.
+        self.async_in_flight = None
+        self.recent_sizes = collections.deque(maxlen=RECENT_COMMITS)
+        self.number_of_commits = 0
+        self.number_of_failures = 0
+        self.number_of_splits = 0
+        self.committed_rows = 0
+        self.commit_seconds = 0.0
+        self.smallest_size = self.size
+        self.largest_size = self.size
+
+    # Rows of the next transaction.
+    def get_size(self):
+        return self.size
+
+    def get_max_in_flight(self):
+        return self.max_in_flight
+
+    # Semaphore of the transactions in flight, to be held while a transaction runs.
+    def get_in_flight(self):
+        return self.in_flight
+
+    def get_async_in_flight(self):
+        if self.async_in_flight is None:
+            self.async_in_flight = asyncio.Semaphore(self.max_in_flight)
+        return self.async_in_flight
+
+    def set_size(self, size):
+        self.size = min(max(int(size), self.min_rows), self.max_rows)
+        self.smallest_size = min(self.smallest_size, self.size)
+        self.largest_size = max(self.largest_size, self.size)
+        instrumentation.set_gauge("transaction_rows", self.size)
+
+    # rows: the rows of the transaction that failed or took too long.
+    def decrease(self, rows):
+        self.slow_start = False
+        self.set_size(min(self.size, rows) * self.decrease_factor)
+
+    # A transaction of rows rows was committed after seconds.
+    def record_commit(self, rows, seconds):
+        with self.lock:
+            self.number_of_commits += 1
+            self.committed_rows += rows
+            self.commit_seconds += seconds
+            self.recent_sizes.append(rows)
+            if seconds > self.target_latency:
+                self.decrease(rows)
+            elif rows >= self.size:
+                # Only a full transaction shows that the size is fine, the last one of a bundle is usually smaller.
+                self.set_size(self.size * 2 if self.slow_start else self.size + self.increase_rows)
+
+    def record_failure(self, rows):
+        with self.lock:
+            self.number_of_failures += 1
+            self.decrease(rows)
+        instrumentation.add_count("transient_failures")
+
+    def record_split(self):
+        with self.lock:
+            self.number_of_splits += 1
+        instrumentation.add_count("transaction_splits")
+
+    # Median rows of the last commits.
+    def get_settled_size(self):
+        with self.lock:
+            return int(statistics.median(self.recent_sizes)) if self.recent_sizes else self.size
+
+    def format_report(self):
+        rows_per_second = self.committed_rows / self.commit_seconds if self.commit_seconds else 0
+        return (f"Adaptive transactions: settled at {self.get_settled_size()} rows per transaction "
+                f"(next {self.size}, range {self.smallest_size}-{self.largest_size}), "
+                f"{self.number_of_commits} commits, {self.number_of_failures} transient failures, "
+                f"{self.number_of_splits} splits, {rows_per_second:.0f} rows/s per transaction")
+
+
+# The transactions of one upload (see neo4j_driver.Neo4jDriver.run_in_transactions). A driver iterates over the
+# transactions, runs each one with get_max_retries retries while it holds get_in_flight (get_async_in_flight in a
+# coroutine), and then calls commit with the results of its queries, or split after a transient error.
+# on_commit(committed, total): called after every commit, see checkpoint.
+class TransactionUpload:
+    def __init__(self, on_commit=None):
+        self.on_commit = on_commit
+        self.results = []
+
+    def __iter__(self):
+        while True:
+            chunk = self.next_transaction()
+            if not chunk:
+                return
+            yield chunk
+
+    # Return the queries of the next transaction, an empty list at the end.
+    def next_transaction(self):
+        raise NotImplementedError
+
+    # Retries of a transaction after a transient error, None for the retries of the driver.
+    def get_max_retries(self, chunk):
+        return None
+
+    def get_in_flight(self):
+        return contextlib.nullcontext()
+
+    def get_async_in_flight(self):
+        return contextlib.nullcontext()
+
+    # After a transient error that the retries did not resolve: return True if the transaction is tried again in
+    # smaller parts, False if the error is raised.
+    def split(self, chunk, error):
+        return False
+
+    # The transaction with the queries of chunk was committed after seconds. result: the list of the results of its
+    # queries, or None.
+    def commit(self, chunk, result, seconds):
+        if result is not None:
+            self.results.extend(result)
+        instrumentation.add_count("transactions")
+        committed, total = self.record_commit(chunk, seconds)
+        if self.on_commit is not None:
+            self.on_commit(committed, total)
+
+    # Return (committed, total) after a commit.
+    def record_commit(self, chunk, seconds):
+        raise NotImplementedError
+
+    # The results of the queries of all committed transactions, in order.
+    def get_results(self):
+        return self.results
+
+
+# The queries in transactions of transaction_size queries (see split_into_transactions), each one tried again with
+# the retries of the driver. start_chunk: skip the transactions that were committed before. on_commit counts
+# transactions.
+class FixedUpload(TransactionUpload):
+    def __init__(self, queries, transaction_size=None, start_chunk=0, on_commit=None):
+        super().__init__(on_commit)
+        self.chunks = split_into_transactions(queries, transaction_size)
+        self.next_chunk = start_chunk
+        self.committed_chunks = start_chunk
+
+    def next_transaction(self):
+        if self.next_chunk >= len(self.chunks):
+            return []
+        self.next_chunk += 1
+        return self.chunks[self.next_chunk - 1]
+
+    def record_commit(self, chunk, seconds):
+        self.committed_chunks += 1
+        return self.committed_chunks, len(self.chunks)
+
+
+# The queries in transactions of the size of the controller. A transaction that fails with a transient error is split
+# in two halves, which are tried next, and only a transaction of one row is tried again with the retries of the
+# driver. start_row: skip the rows that were committed before. on_commit counts rows.
+class AdaptiveUpload(TransactionUpload):
+    def __init__(self, controller, queries, start_row=0, on_commit=None):
+        super().__init__(on_commit)
+        self.controller = controller
+        queries = list(queries)
+        self.total_rows = sum(get_number_of_rows(query) for query in queries)
+        self.cursor = UploadCursor(queries, start_row)
+        self.committed_rows = start_row
+        # Halves of failed transactions, the next one last.
+        self.split_chunks = []
+
+    def next_transaction(self):
+        if self.split_chunks:
+            return self.split_chunks.pop()
+        return self.cursor.take(self.controller.get_size())
+
+    # A transaction that can be split is not tried again as a whole.
+    def get_max_retries(self, chunk):
+        return 0 if sum(get_number_of_rows(query) for query in chunk) > 1 else None
+
+    def get_in_flight(self):
+        return self.controller.get_in_flight()
+
+    def get_async_in_flight(self):
+        return self.controller.get_async_in_flight()
+
+    def split(self, chunk, error):
+        self.controller.record_failure(sum(get_number_of_rows(query) for query in chunk))
+        halves = split_transaction(chunk)
+        if halves is None:
+            return False
+        self.split_chunks.extend(reversed(halves))
+        self.controller.record_split()
+        print(f"Transient error, the transaction is split and tried again: {error}")
+        return True
+
+    def record_commit(self, chunk, seconds):
+        rows = sum(get_number_of_rows(query) for query in chunk)
+        self.controller.record_commit(rows, seconds)
+        self.committed_rows += rows
+        return self.committed_rows, self.total_rows
+
+
+# The upload of queries with the controller, or in transactions of transaction_size queries without one.
+# start: the committed transactions, or rows with a controller, of an earlier upload (see checkpoint).
+def create_upload(queries, transaction_size=None, controller=None, start=0, on_commit=None):
+    if controller is not None:
+        return AdaptiveUpload(controller, queries, start, on_commit)
+    return FixedUpload(queries, transaction_size, start, on_commit)
+
+
+# Like the registry (see resource_registry.get_registry), the controller is shared by all uploads of the process.
+# None uploads in transactions of --transaction-size.
+upload_controller = None
+
+
+def set_upload_controller(controller):
+    global upload_controller
+    upload_controller = controller
+
+
+def get_upload_controller():
+    return upload_controller